@@ -27,6 +27,7 @@ class Command(BaseCommand):
         with TemporaryDirectory() as tmp:
             logger.info('Downloading latest production backup...')
             db_path, log_path, tunes_path = backup.download_latest_production_backup(to_dir=tmp)
+            tune_segment_paths = backup.download_latest_production_tune_segments(to_dir=tmp)
             
             logger.info('Applying database...')
             with tarfile.open(name=db_path, mode='r:bz2') as tar:
@@ -45,5 +46,8 @@ class Command(BaseCommand):
             logger.info('Applying tune...')
             with tarfile.open(name=tunes_path, mode='r:bz2') as tar:
                 tar.extractall(path='/')
+            for path in tune_segment_paths:
+                with tarfile.open(name=path, mode='r:bz2') as tar:
+                    tar.extractall(path='/')
         
         logger.info('Apply Backup finished.')
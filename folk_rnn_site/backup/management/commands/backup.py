@@ -13,6 +13,8 @@ from google.oauth2 import service_account
 from django.core.management.base import BaseCommand
 from django.core.management import call_command
 
+from composer.tune_store import tune_store
+
 SCOPES = ['https://www.googleapis.com/auth/drive']
 SERVICE_ACCOUNT_FILE = 'folkrnn-gdrive.json'
 
@@ -53,6 +55,7 @@ class Command(BaseCommand):
         
         logger.info('Backing up tunes...')
         self.archive_store_folder('/var/opt/folk_rnn_task/tunes')
+        self.archive_store_tune_segments()
         logger.info('Backing up logs...')
         self.archive_store_folder('/var/log/folk_rnn_webapp/')
         logger.info('Backing up database...')
@@ -128,30 +131,78 @@ class Command(BaseCommand):
             # Archive to tar
             with tarfile.open(fileobj=f, mode='x:bz2') as tar:
                 tar.add(folder_path)
-            # Store in Google Drive
-            body = {
-                'name': folder_name + backup_suffix() + '.tar.gz',
-                }
-            media_body = apiclient.http.MediaIoBaseUpload(f, 
-                                            mimetype='application/gzip', 
-                                            resumable=True,
-                                            )
-            request = self.drive.files().create(
-                                body=body,
-                                media_body=media_body,
-                                )
-            try: 
-                response = None
-                while response is None:
-                    status, response = request.next_chunk()
-            except apiclient.errors.HttpError as e:
-              if e.resp.status in [404]:
-                logger.error(f'archive_store_folder: 404, {e}') # It should... # Start the upload all over again.
-              elif e.resp.status in [500, 502, 503, 504]:
-                logger.error(f'archive_store_folder: 5xx, {e}') # It should... # Call next_chunk() again, but use an exponential backoff for repeated errors.
-              else:
-                logger.error(f'archive_store_folder: {e}') # It should... # Do not retry. Log the error and fail.
-        return body['name']
+            name = folder_name + backup_suffix() + '.tar.gz'
+            self.store_archive(f, name)
+        return name
+
+    def archive_store_tune_segments(self):
+        """
+        Archive and store in Google Drive the tune store's segments.
+        A sealed segment doesn't change, so is stored once. The active segment is stored each time,
+        read with the store locked, so its index has no record beyond its pack.
+        Returns names of uploaded files
+        """
+        names = []
+        segments = tune_store.segments()
+        for number in segments:
+            sealed = number != segments[-1]
+            paths = tune_store.segment_paths(number)
+            stored_marker_path = paths[0] + '.stored'
+            if sealed and os.path.exists(stored_marker_path):
+                continue
+            if sealed:
+                files = [(path, None) for path in paths]
+            else:
+                with tune_store.locked():
+                    files = []
+                    for path in paths:
+                        with open(path, 'rb') as f:
+                            files.append((path, f.read()))
+            with SpooledTemporaryFile() as f:
+                # Archive to tar
+                with tarfile.open(fileobj=f, mode='x:bz2') as tar:
+                    for path, data in files:
+                        if data is None:
+                            tar.add(path)
+                        else:
+                            info = tar.gettarinfo(path)
+                            info.size = len(data)
+                            tar.addfile(info, BytesIO(data))
+                name = (f'tune_segment_{number:06}' if sealed else 'tune_segment_active') + backup_suffix() + '.tar.gz'
+                if self.store_archive(f, name) and sealed:
+                    open(stored_marker_path, 'w').close()
+            names.append(name)
+        return names
+
+    def store_archive(self, f, name):
+        """
+        Store the archive file in Google Drive
+        Returns True if stored
+        """
+        body = {
+            'name': name,
+            }
+        media_body = apiclient.http.MediaIoBaseUpload(f, 
+                                        mimetype='application/gzip', 
+                                        resumable=True,
+                                        )
+        request = self.drive.files().create(
+                            body=body,
+                            media_body=media_body,
+                            )
+        try: 
+            response = None
+            while response is None:
+                status, response = request.next_chunk()
+        except apiclient.errors.HttpError as e:
+          if e.resp.status in [404]:
+            logger.error(f'store_archive: 404, {e}') # It should... # Start the upload all over again.
+          elif e.resp.status in [500, 502, 503, 504]:
+            logger.error(f'store_archive: 5xx, {e}') # It should... # Call next_chunk() again, but use an exponential backoff for repeated errors.
+          else:
+            logger.error(f'store_archive: {e}') # It should... # Do not retry. Log the error and fail.
+          return False
+        return True
 
     def _list_stored_files(self):
         next_page_token = 'no token for first page'
@@ -228,6 +279,25 @@ class Command(BaseCommand):
                     name.append(download_path)
                 break
         return ([x[3] for x in names])
+
+    def download_latest_production_tune_segments(self, to_dir=''):
+        """
+        Download the tune store's segments, i.e. the latest of the active segment and every sealed segment.
+        Returns paths of downloaded files, to be extracted in order
+        """
+        latest = {}
+        # relies on _list_stored_files's newest-first ordering request
+        for file_info in self._list_stored_files():
+            name = file_info.get('name')
+            if name.startswith('tune_segment_') and '_backup_production_' in name:
+                latest.setdefault(name.split('_backup_')[0], file_info)
+        paths = []
+        # The active segment first, as once sealed that segment is stored in full
+        for segment in sorted(latest, key=lambda x: (x != 'tune_segment_active', x)):
+            download_path = os.path.join(to_dir, latest[segment]['name'])
+            self.download_file(latest[segment]['id'], download_path)
+            paths.append(download_path)
+        return paths
                     
     def delete_file(self, file_id):
         """
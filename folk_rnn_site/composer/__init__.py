@@ -6,13 +6,98 @@ FOLKRNN_MAX_SEED = 1000000
 
 ABC2ABC_PATH = '/usr/bin/abc2abc'
 
+# Format ABC in-process, falling back to abc2abc for ABC not handled. See folk_rnn_site/abc_format.py
+ABC_FORMAT_IN_PROCESS = True
+
+# abc2abc invocations run concurrently, tunes formatted per invocation, seconds before an invocation is abandoned
+ABC2ABC_POOL_SIZE = 2
+ABC2ABC_BATCH_SIZE = 16
+ABC2ABC_TIMEOUT = 10
+
 # folk_rnn task
 
-FOLKRNN_INSTANCE_CACHE_COUNT = 2
+# Seconds between each process polling MODEL_PATH for models added, changed or removed, see rnn_models.ModelRegistry
+FOLKRNN_MODEL_POLL_INTERVAL = 10
+
+# Memory budget for the models a folk_rnn worker holds, as bytes of their weights. Least recently used are evicted beyond it
+FOLKRNN_MODEL_CACHE_BYTES = 512 * 1024 * 1024
+
+# Models a folk_rnn worker loads at start, before it takes generations from its channels, in this order until the budget.
+# Models not in the worker's group are skipped. None for all the worker's models, see FOLKRNN_WORKER_GROUPS
+FOLKRNN_PRELOAD_MODELS = None
+
+# Tunes generated together, stepped as one batch. 0 for one tune at a time via folk_rnn's Folk_RNN
+FOLKRNN_BATCH_SIZE = 8
+
+# Per model file name, the engine generating its tunes: 'batched' for composer's BatchedFolkRNN, 'folk_rnn' for folk_rnn's Folk_RNN.
+# 'gemm' for BatchedFolkRNN with one matrix product per batch: faster for larger batches, but a tune's tokens can then depend
+# on its batch, so it may not be as per Folk_RNN, nor as cached or pregenerated. See generation.BatchedFolkRNN
+# Models not listed are generated with 'batched' unless FOLKRNN_BATCH_SIZE is 0. Compare engines with bench_generate --engine
+FOLKRNN_ENGINES = {}
+
+# Memory budget, per model, for LSTM states reached after prime tokens. 0 disables the cache
+FOLKRNN_PRIME_CACHE_BYTES = 8 * 1024 * 1024
+
+# Processes a folk_rnn worker generates tunes with, one submission each, i.e. without the continuous batching of FOLKRNN_BATCH_SIZE.
+# 0 to generate in the worker process, None for one per CPU core
+FOLKRNN_PROCESSES = 0
+
+# Worker group: model file names. Each model in a group is sent to a channel of its own, folk_rnn.<model>, 
+# served by that group's workers, i.e. `runfolkrnnworker <group>`. So a worker holds only its models.
+# Models not in a group are sent to the shared folk_rnn channel, served by workers not in a group.
+# e.g. {'2': ['thesession_with_repeats.pickle']}. Workers on a host should scale with its CPU cores.
+FOLKRNN_WORKER_GROUPS = {}
+
+# Limits on a tune's generation, tokens generated and seconds, beyond which it is truncated to its last bar.
+# Per model, these are the defaults for models whose job spec doesn't set 'max_tokens' or 'max_seconds'
+FOLKRNN_MAX_TOKENS = 500
+FOLKRNN_MAX_SECONDS = 20
+
+# Tunes pregenerated per model for its default parameters, while the workers are idle. 0 disables pregeneration
+FOLKRNN_PREGENERATE_POOL_SIZE = 16
+# Pregenerations with the workers at once, i.e. the capacity taken from compose requests arriving meanwhile
+FOLKRNN_PREGENERATE_MAX_IN_FLIGHT = 1
+# Seconds between the pools being checked as visitors connect, rather than per connection. A claim always checks its pool
+FOLKRNN_PREGENERATE_REFILL_INTERVAL = 60
+
+# Variations composed at once by compose_batch, i.e. tunes differing only by seed, generated as one batch
+FOLKRNN_COMPOSE_BATCH_MAX = 8
+
+# Finished tunes held in memory for the result cache, per server process. 0 disables the cache
+FOLKRNN_RESULT_CACHE_COUNT = 1024
+
+# Generated ABC is published to websocket clients once this many tokens, or this many seconds, have accrued
+FOLKRNN_STREAM_FLUSH_TOKENS = 4
+FOLKRNN_STREAM_FLUSH_INTERVAL = 0.1
+
+# Tunes waiting for the folk_rnn workers are served in turn by session.
+# Tunes with the workers at once, overall (i.e. workers × FOLKRNN_BATCH_SIZE, or × FOLKRNN_PROCESSES with a process pool) and per session.
+FOLKRNN_QUEUE_MAX_IN_FLIGHT = 8
+FOLKRNN_QUEUE_SESSION_MAX_IN_FLIGHT = 2
+# Tunes waiting, beyond which compose requests are rejected
+FOLKRNN_QUEUE_MAX_DEPTH = 100
+# Seconds after which a tune with the workers is presumed lost
+FOLKRNN_QUEUE_IN_FLIGHT_TIMEOUT = 300
+
+# Seconds the ABC generated so far is kept for clients joining mid-generation, after the last addition
+FOLKRNN_PROGRESS_TTL = 10 * 60
+
+# Seconds after a tune's last listener leaves before its generation is cancelled, i.e. time for a client to reconnect
+FOLKRNN_CANCEL_GRACE = 10
+
+# Bytes of generated tunes packed into a tune store segment before it is sealed and the next begun
+TUNE_STORE_SEGMENT_BYTES = 16 * 1024 * 1024
+
+# Seconds between each process writing its metrics snapshot to METRICS_PATH, see folk_rnn_site/metrics.py
+METRICS_SNAPSHOT_INTERVAL = 10
 
 STORE_PATH = '/var/opt/folk_rnn_task'
 MODEL_PATH = os.path.join(STORE_PATH, 'models')
-TUNE_PATH = os.path.join(STORE_PATH, 'tunes')
+MODEL_INDEX_PATH = os.path.join(STORE_PATH, 'model_index.json') # model metadata, see rnn_models.model_index
+BUNDLE_PATH = os.path.join(STORE_PATH, 'bundles') # memory-mappable models, see model_bundle.py
+TUNE_PATH = os.path.join(STORE_PATH, 'tunes') # as two files per tune, before the tune store
+TUNE_STORE_PATH = os.path.join(STORE_PATH, 'tune_store') # segments of packed tunes, see tune_store.py
+METRICS_PATH = os.path.join(STORE_PATH, 'metrics') # per-process snapshots, see folk_rnn_site/metrics.py
 
 FOLKRNN_TUNE_TITLE = None
 FOLKRNN_TUNE_TITLE_CLIENT = 'Folk RNN Tune №'
@@ -27,18 +112,17 @@ try:
 except OSError:
     pass
 
-# import here as rnn_models imports above constants
-from .rnn_models import models_json
-static_path = os.path.join(os.path.dirname(__file__), 'static')
-with open(os.path.join(static_path, 'folk_rnn_models.js'), 'w') as f:
-    js =  '// Auto-generated by composer package \n'
-    js += '// See __init__.py, rnn_models.py \n'
-    js += ' \n'
-    js += 'if (typeof folkrnn == "undefined") \n'
-    js += '    folkrnn = {}; \n'
-    js += ' \n'
-    js += f'folkrnn.tuneTitle = "{FOLKRNN_TUNE_TITLE_CLIENT}"; \n'
-    js += f'folkrnn.maxSeed = {FOLKRNN_MAX_SEED}; \n'
-    js += 'folkrnn.models = ' + models_json() + '; \n'
-    f.write(js)
-    
\ No newline at end of file
+try:
+    os.makedirs(TUNE_STORE_PATH)
+except OSError:
+    pass
+
+try:
+    os.makedirs(BUNDLE_PATH)
+except OSError:
+    pass
+
+try:
+    os.makedirs(METRICS_PATH)
+except OSError:
+    pass
@@ -1,29 +1,104 @@
-import os
-import subprocess
 import json
 import logging
+from time import monotonic
+from random import sample
+from types import SimpleNamespace
 from django.utils.timezone import now
+from django.utils.dateparse import parse_datetime
 from channels.consumer import SyncConsumer
 from channels.exceptions import StopConsumer
-from channels.generic.websocket import JsonWebsocketConsumer
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.db import database_sync_to_async
 from asgiref.sync import async_to_sync
 
-from composer.rnn_models import folk_rnn_cached, l_for_m_header
-from composer import ABC2ABC_PATH, TUNE_PATH, FOLKRNN_TUNE_TITLE
-from composer.models import RNNTune, Session
+from composer.rnn_models import model_cache, model_registry, model_since, engine_for_model, BATCHED_ENGINES, l_for_m_header, models
+from composer.generation import Generation, GenerationCancelled, GenerationBudget, GenerationScheduler, generate, truncate_to_bar
+from composer.process_pool import GenerationProcessPool
+from composer.result_cache import ResultCache, result_key
+from composer.progress import append_progress, get_progress, clear_progress, add_listener, remove_listener, is_abandoned
+from composer.fair_queue import FairShareQueue
+from composer.tune_store import tune_store
+from composer.worker_routing import model_channel
+from composer import FOLKRNN_MAX_SEED, FOLKRNN_COMPOSE_BATCH_MAX, FOLKRNN_TUNE_TITLE, FOLKRNN_BATCH_SIZE, FOLKRNN_PROCESSES, FOLKRNN_RESULT_CACHE_COUNT
+from composer import FOLKRNN_STREAM_FLUSH_TOKENS, FOLKRNN_STREAM_FLUSH_INTERVAL
+from composer import FOLKRNN_PREGENERATE_MAX_IN_FLIGHT, FOLKRNN_PREGENERATE_REFILL_INTERVAL, FOLKRNN_QUEUE_IN_FLIGHT_TIMEOUT
+from composer.models import RNNTune, Session, PregeneratedTune
+from composer.pregeneration import pregeneration_tune, models_to_pregenerate, claim_pregenerated
 from composer.forms import ComposeForm
-
-ABC2ABC_COMMAND = [
-            ABC2ABC_PATH, 
-            'stdin', # a special filename revealed by looking at the source code!
-            '-e', # -e for no error checking
-            '-s', # -s to re-space
-            '-n', '4' # -n 4 for newline every four bars
-            ]
+from folk_rnn_site.abc_format import abc2abc
+from folk_rnn_site.metrics import metrics
 
 logger = logging.getLogger(__name__)
 logger_use = logging.getLogger('composer.use')
 
+# One process pool or scheduler per worker process, shared by its FolkRNNConsumer instances
+generation_process_pool = GenerationProcessPool(FOLKRNN_PROCESSES) if FOLKRNN_PROCESSES != 0 else None
+generation_scheduler = GenerationScheduler(FOLKRNN_BATCH_SIZE) if FOLKRNN_BATCH_SIZE and not generation_process_pool else None
+
+# The queue, the positions last sent, and the models being pregenerated, for the one FolkRNNQueueConsumer process
+fair_share_queue = FairShareQueue()
+queue_positions_sent = {}
+pregenerating = {} # model: time dispatched
+refilled = None # time of the last refill as a visitor connected
+
+# One result cache per server process, shared by its ComposerConsumer instances
+result_cache = ResultCache() if FOLKRNN_RESULT_CACHE_COUNT else None
+if result_cache:
+    model_registry.add_listener(result_cache.invalidate)
+
+class TuneABC:
+    '''
+    Machinery to build ABC incrementally from folk-rnn tokens.
+    The ABC is published in deltas, i.e. what has been added since the last publish, 
+    at the offset it starts at.
+    '''
+    def __init__(self, tune):
+        self.abc = f'X:{tune.id}\n'
+        if FOLKRNN_TUNE_TITLE:
+            self.abc += f'T:{FOLKRNN_TUNE_TITLE}{tune.id}\n'
+        self.in_header = True
+        self.header_tokens = []
+        self.published = 0
+        self.published_time = monotonic()
+        self.unpublished_tokens = 0
+    
+    def publish_due(self):
+        return (self.unpublished_tokens >= FOLKRNN_STREAM_FLUSH_TOKENS 
+                or monotonic() - self.published_time >= FOLKRNN_STREAM_FLUSH_INTERVAL)
+    
+    def publish(self):
+        '''
+        Return (offset, abc) of the ABC added since the last publish.
+        '''
+        offset = self.published
+        self.published = len(self.abc)
+        self.published_time = monotonic()
+        self.unpublished_tokens = 0
+        return offset, self.abc[offset:]
+    
+    def add_token(self, token):
+        # Ensure valid ABC
+        # - In header, have L (opt), M (req), K, (req) info fields on new lines, in that order.
+        # - In body, any info field should be in square brackets, if it's not already.
+        # This code tries its best to cope with ill-formed ABC produced by folk-rnn, i.e. probablistic ordering.
+        # Further complicating things, info-fields have to be modelled as either header or in-line, and this hasn't been done consistently between models
+        if self.in_header:
+            if token.strip('[]')[0:2] in ['L:', 'M:', 'K:']:
+                self.header_tokens.append(token.strip('[]'))
+            else:
+                self.in_header = False
+                for header in [ 'L:', 'M:', 'K:']:
+                    header_token_candidates = [x for x in self.header_tokens if x.startswith(header)]
+                    if header_token_candidates:
+                        self.abc += header_token_candidates[0] + '\n'
+                    elif header in ['M:', 'K:']:
+                        self.abc += header + 'none\n'
+        if not self.in_header:
+            if token[0:2] in ['M:', 'K:', 'L:']:
+                token = f'[{ token }]'
+            self.abc += token
+        self.unpublished_tokens += 1
+
 class FolkRNNConsumer(SyncConsumer):
 
     def folkrnn_generate(self, event):
@@ -31,11 +106,38 @@ class FolkRNNConsumer(SyncConsumer):
         Generate the tune, pulling parameters from the database, and writing back
         the result. Will also notify consumers with group 'tune_x' of abc updates 
         as the generation proceeds, and generation completion.
+        With a process pool or batching, the generation is handed to the pool or scheduler 
+        and this returns once it has room for it, i.e. before the generation has finished.
+        If no client is listening for the tune, it is cancelled, before or during generation.
+        If the tune exceeds the model's limits on tokens or time, it is truncated to its last bar.
+        With 'ids' rather than 'id', the tunes are variations composed together, and are generated together.
         '''
-        tune = RNNTune.objects.get(id=event['id'])
+        tunes = [x for x in map(self.prepare_generation, event['ids'] if 'ids' in event else [event['id']]) if x]
+        if len(tunes) == 1:
+            self.generate(*tunes[0])
+        elif tunes:
+            self.generate_batch(tunes)
+    
+    def prepare_generation(self, tune_id):
+        '''
+        Start the tune's generation, returning (tune, on_token, on_finish) to generate it with.
+        Returns None if the tune is not to be generated, i.e. finished or cancelled.
+        '''
+        tune = RNNTune.objects.get(id=tune_id)
+        
+        if tune.rnn_finished is not None or async_to_sync(is_abandoned)(self.channel_layer, tune.id):
+            try:
+                if tune.rnn_finished is None:
+                    cancel_generation(self.channel_layer, tune)
+            finally:
+                self.send_queue_finished(tune)
+            return None
         
         tune.rnn_started = now()
         tune.save()
+        model_label = tune.rnn_model_name.replace('.pickle', '')
+        metrics.observe('folkrnn_queue_wait_seconds', (tune.rnn_started - tune.requested).total_seconds(), model=model_label)
+        started = monotonic()
         
         async_to_sync(self.channel_layer.group_send)(
                                 f'tune_{tune.id}',
@@ -45,76 +147,232 @@ class FolkRNNConsumer(SyncConsumer):
                                     'tune': tune.plain_dict(),
                                 })
         
-        # Machinery to build ABC incrementally, notifying consumers of abc updates.
-        abc = f'X:{tune.id}\n'
-        if FOLKRNN_TUNE_TITLE:
-            abc += f'T:{FOLKRNN_TUNE_TITLE}{tune.id}\n'
-        in_header = True
-        header_tokens = []
-        def on_token(token):
-            nonlocal abc, header_tokens, in_header
-            # Ensure valid ABC
-            # - In header, have L (opt), M (req), K, (req) info fields on new lines, in that order.
-            # - In body, any info field should be in square brackets, if it's not already.
-            # This code tries its best to cope with ill-formed ABC produced by folk-rnn, i.e. probablistic ordering.
-            # Further complicating things, info-fields have to be modelled as either header or in-line, and this hasn't been done consistently between models
-            if in_header:
-                if token.strip('[]')[0:2] in ['L:', 'M:', 'K:']:
-                    header_tokens.append(token.strip('[]'))
-                else:
-                    in_header = False
-                    for header in [ 'L:', 'M:', 'K:']:
-                        header_token_candidates = [x for x in header_tokens if x.startswith(header)]
-                        if header_token_candidates:
-                            abc += header_token_candidates[0] + '\n'
-                        elif header in ['M:', 'K:']:
-                            abc += header + 'none\n'
-            if not in_header:
-                if token[0:2] in ['M:', 'K:', 'L:']:
-                    token = f'[{ token }]'
-                abc += token
-            async_to_sync(self.channel_layer.group_send)(
+        # Build ABC incrementally, notifying consumers of abc updates.
+        tune_abc = TuneABC(tune)
+        async def publish_abc(offset, abc):
+            await append_progress(self.channel_layer, tune.id, abc)
+            await self.channel_layer.group_send(
                                     f'tune_{tune.id}',
                                     {
                                         'type': 'generation_status',
                                         'status': 'new_abc',
                                         'tune_id': tune.id,
+                                        'offset': offset,
                                         'abc': abc,
                                     })
+        def publish():
+            offset, abc = tune_abc.publish()
+            if abc:
+                publish_start = monotonic()
+                async_to_sync(publish_abc)(offset, abc)
+                metrics.observe('folkrnn_publish_seconds', monotonic() - publish_start)
+        # Stop generating if over budget, checked every token, or abandoned, checked as the abc is published
+        model = models()[tune.rnn_model_name]
+        budget = GenerationBudget(model['max_tokens'], model['max_seconds'])
+        tokens = []
+        cancelled = False
+        truncated = False
+        def on_token(token):
+            nonlocal cancelled, truncated
+            if cancelled or truncated:
+                raise GenerationCancelled
+            if budget.exceeded(len(tokens)):
+                truncated = True
+                raise GenerationCancelled
+            if not tokens:
+                metrics.observe('folkrnn_first_token_seconds', monotonic() - started, model=model_label)
+            tokens.append(token)
+            tune_abc.add_token(token)
+            if tune_abc.publish_due():
+                publish()
+                cancelled = async_to_sync(is_abandoned)(self.channel_layer, tune.id)
+                if cancelled:
+                    raise GenerationCancelled
+        def on_finish(tune_tokens, over_budget=False):
+            nonlocal truncated
+            # Over budget as checked by a pool process, see GenerationProcessPool
+            truncated = truncated or over_budget
+            metrics.inc('folkrnn_tokens_total', len(tokens), model=model_label)
+            metrics.observe('folkrnn_tokens_per_second', len(tokens) / max(monotonic() - started, 1e-6), model=model_label)
+            metrics.inc('folkrnn_tunes_total', model=model_label, outcome='cancelled' if cancelled else 'truncated' if truncated else 'failed' if tune_tokens is None else 'finished')
+            try:
+                if cancelled:
+                    cancel_generation(self.channel_layer, tune)
+                elif tune_tokens is None and not truncated:
+                    fail_generation(self.channel_layer, tune)
+                elif truncated:
+                    logger.info(f'Generation truncated for tune {tune.id}, over budget at {len(tokens)} tokens')
+                    tune_tokens = truncate_to_bar(tokens)
+                    truncated_abc = TuneABC(tune)
+                    for token in tune_tokens:
+                        truncated_abc.add_token(token)
+                    tune.rnn_truncated = True
+                    self.folkrnn_finish(tune, tune_tokens, truncated_abc.abc)
+                else:
+                    publish()
+                    self.folkrnn_finish(tune, tune_tokens, tune_abc.abc)
+            finally:
+                self.send_queue_finished(tune)
         
-        # Do the generation
-        folk_rnn = folk_rnn_cached(tune.rnn_model_name)
-        folk_rnn.seed_tune(tune.prime_tokens if len(tune.prime_tokens) > 0 else None)
-        tune_tokens = folk_rnn.generate_tune(
-                                    random_number_generator_seed=tune.seed, 
+        return tune, on_token, on_finish
+    
+    def generate(self, tune, on_token, on_finish):
+        '''
+        Generate the tune with the process pool, scheduler, or in this process, as per the model's engine.
+        on_token is called with each token, and may raise GenerationCancelled to stop the generation.
+        on_finish is called with the tune tokens, or as per the engine on cancellation, or None on failure.
+        '''
+        if generation_process_pool:
+            generation_process_pool.submit(tune, on_token, on_finish)
+        elif engine_for_model(tune.rnn_model_name) in BATCHED_ENGINES:
+            try:
+                generation = Generation(
+                                    model_cache.get(tune.rnn_model_name),
+                                    prime_tokens=tune.prime_tokens,
+                                    seed=tune.seed,
                                     temperature=tune.temp,
-                                    on_token_callback=on_token
+                                    on_token=on_token,
+                                    on_finish=on_finish,
                                     )
-        
-        # Save out raw folk-rnn output
+            except GenerationCancelled:
+                on_finish(None)
+                return
+            if generation_scheduler:
+                generation_scheduler.submit(tune.rnn_model_name, generation)
+            else:
+                generate([generation])
+        else:
+            folk_rnn = model_cache.get(tune.rnn_model_name)
+            folk_rnn.seed_tune(tune.prime_tokens if len(tune.prime_tokens) > 0 else None)
+            try:
+                tune_tokens = folk_rnn.generate_tune(
+                                            random_number_generator_seed=tune.seed, 
+                                            temperature=tune.temp,
+                                            on_token_callback=on_token
+                                            )
+            except GenerationCancelled:
+                tune_tokens = None
+            except Exception:
+                logger.exception(f'Generation failed for tune {tune.id}')
+                tune_tokens = None
+            on_finish(tune_tokens)
+    
+    def generate_batch(self, tunes):
+        '''
+        Generate the tunes, which must share the same model, together: as one batch with the process 
+        pool, scheduler, or in this process, as per the model's engine. With folk_rnn's Folk_RNN, in turn.
+        tunes - (tune, on_token, on_finish) of each, as per generate()
+        '''
+        rnn_model_name = tunes[0][0].rnn_model_name
+        if generation_process_pool:
+            generation_process_pool.submit_batch(tunes)
+        elif engine_for_model(rnn_model_name) in BATCHED_ENGINES:
+            # The one instance, as a batch is stepped with one, see GenerationScheduler
+            folk_rnn = model_cache.get(rnn_model_name)
+            generations = []
+            for tune, on_token, on_finish in tunes:
+                try:
+                    generations.append(Generation(
+                                            folk_rnn,
+                                            prime_tokens=tune.prime_tokens,
+                                            seed=tune.seed,
+                                            temperature=tune.temp,
+                                            on_token=on_token,
+                                            on_finish=on_finish,
+                                            ))
+                except GenerationCancelled:
+                    on_finish(None)
+            if generation_scheduler:
+                for generation in generations:
+                    generation_scheduler.submit(rnn_model_name, generation)
+            elif generations:
+                generate(generations)
+        else:
+            for tune in tunes:
+                self.generate(*tune)
+    
+    def folkrnn_pregenerate(self, event):
+        '''
+        Generate a tune for the model's default parameters, for the pool of pregenerated tunes.
+        Tunes truncated are discarded, as truncation on time isn't reproducible.
+        '''
+        rnn_tune = pregeneration_tune(event['model'])
+        tune = SimpleNamespace(
+                        id=f"pregenerate_{event['model']}_{rnn_tune.seed}",
+                        rnn_model_name=rnn_tune.rnn_model_name,
+                        prime_tokens=rnn_tune.prime_tokens,
+                        seed=rnn_tune.seed,
+                        temp=rnn_tune.temp,
+                        )
+        model = models()[tune.rnn_model_name]
+        budget = GenerationBudget(model['max_tokens'], model['max_seconds'])
+        tune_abc = TuneABC(SimpleNamespace(id=0))
+        token_count = 0
+        truncated = False
+        def on_token(token):
+            nonlocal token_count, truncated
+            if truncated or budget.exceeded(token_count):
+                truncated = True
+                raise GenerationCancelled
+            token_count += 1
+            tune_abc.add_token(token)
+        def on_finish(tune_tokens, over_budget=False):
+            try:
+                if truncated or over_budget:
+                    logger.info(f'Pregeneration of {tune.id} truncated, discarded')
+                    return
+                if tune_tokens is None:
+                    logger.error(f'Pregeneration of {tune.id} failed')
+                    return
+                PregeneratedTune.objects.create(
+                                    rnn_model_name=rnn_tune.rnn_model_name,
+                                    seed=rnn_tune.seed,
+                                    temp=rnn_tune.temp,
+                                    unitnotelength=rnn_tune.unitnotelength,
+                                    meter=rnn_tune.meter,
+                                    key=rnn_tune.key,
+                                    abc=abc2abc(tune_abc.abc, respace=True, bars_per_line=4, check_errors=False),
+                                    raw=' '.join(tune_tokens),
+                                    )
+            except Exception:
+                logger.exception(f'Pregeneration of {tune.id} failed')
+            finally:
+                async_to_sync(self.channel_layer.send)('folk_rnn_queue', {
+                                                        'type': 'queue.pregenerated',
+                                                        'model': event['model'],
+                                                        })
+        self.generate(tune, on_token, on_finish)
+    
+    def send_queue_finished(self, tune):
+        '''
+        Tell the queue the tune is no longer with the workers.
+        '''
+        async_to_sync(self.channel_layer.send)('folk_rnn_queue', {
+                                                'type': 'queue.finished',
+                                                'id': tune.id,
+                                                })
+    
+    def folkrnn_finish(self, tune, tune_tokens, abc):
+        '''
+        Save and format the generated tune, and notify consumers generation has finished.
+        '''
         model_name = tune.rnn_model_name.replace('.pickle', '')
-        tune_path_raw = os.path.join(TUNE_PATH, f'{model_name}_{tune.id}_raw')
-        with open(tune_path_raw, 'w') as f:
-            f.write(' '.join(tune_tokens))
+        raw = ' '.join(tune_tokens)
         
         # Format the incrementally built ABC
         try:
-            abc_bytes = abc.encode()
-            result = subprocess.run(
-                        ABC2ABC_COMMAND,
-                        input=abc_bytes, 
-                        stdout=subprocess.PIPE,
-                        )
-            abc = result.stdout.decode()
+            format_start = monotonic()
+            abc = abc2abc(abc, respace=True, bars_per_line=4, check_errors=False)
+            metrics.observe('folkrnn_format_seconds', monotonic() - format_start)
         except:
             # do something, probably marking in DB
             logger.warning(f'ABC2ABC failed in folk_rnn_task for id:{tune.id}')
+            # Save out raw folk-rnn output regardless
+            tune_store.put(tune.id, model_name, raw, '')
             return
         
-        # Save the formatted, incrementally built ABC
-        tune_path = os.path.join(TUNE_PATH, f'{model_name}_{tune.id}')
-        with open(tune_path, 'w') as f:
-            f.write(abc)
+        # Save raw folk-rnn output and the formatted, incrementally built ABC
+        tune_store.put(tune.id, model_name, raw, abc)
         
         # Save that ABC to the database
         tune.abc = abc
@@ -135,17 +393,236 @@ class FolkRNNConsumer(SyncConsumer):
     def stop(self, event):
         raise StopConsumer
 
-class ComposerConsumer(JsonWebsocketConsumer):
+class FolkRNNQueueConsumer(SyncConsumer):
+    '''
+    The queue between compose requests and the folk_rnn workers. 
+    Tunes are sent to the workers in turn by session, with caps on tunes with the workers overall 
+    and per session, and compose requests are rejected if too many tunes are waiting.
+    Tunes waiting are sent their queue position as it changes.
+    Tunes are sent to their model's channel, see worker_routing.py
+    With nothing waiting, the workers' spare capacity is used to pregenerate tunes, see pregeneration.py
+    Holds the queue in memory, so only one instance should run, i.e. `runworker folk_rnn_queue`
+    '''
+    def queue_enqueue(self, event):
+        '''
+        Queue the tune, or with 'ids' the tunes as a batch, i.e. variations composed together.
+        A batch is rejected whole if the queue hasn't room for all of it.
+        '''
+        tune_ids = event['ids'] if 'ids' in event else [event['id']]
+        if not fair_share_queue.enqueue(event['session'], *tune_ids):
+            logger.warning(f"Queue full, tunes {tune_ids} rejected")
+            RNNTune.objects.filter(id__in=tune_ids).delete()
+            for tune_id in tune_ids:
+                async_to_sync(self.channel_layer.group_send)(
+                                            f"tune_{tune_id}",
+                                            {
+                                                'type': 'generation_status',
+                                                'status': 'rejected',
+                                                'tune_id': tune_id,
+                                            })
+        self.dispatch()
+    
+    def queue_finished(self, event):
+        fair_share_queue.finished(event['id'])
+        self.dispatch()
+    
+    def queue_pregenerated(self, event):
+        pregenerating.pop(event['model'], None)
+        self.dispatch()
+    
+    def queue_refill(self, event):
+        '''
+        Pregenerate if idle, e.g. as a pregenerated tune has been claimed.
+        As visitors connect, at most every FOLKRNN_PREGENERATE_REFILL_INTERVAL, as checking the pools counts them.
+        '''
+        global refilled
+        if event.get('connect'):
+            if refilled is not None and monotonic() - refilled < FOLKRNN_PREGENERATE_REFILL_INTERVAL:
+                return
+            refilled = monotonic()
+        self.dispatch()
+    
+    def dispatch(self):
+        to_dispatch = fair_share_queue.dispatch()
+        while to_dispatch:
+            batches = {} # batch: tune ids, tunes not in a batch alone
+            for tune_id in to_dispatch:
+                # Skip tunes no client is listening for, freeing their place for another
+                if async_to_sync(is_abandoned)(self.channel_layer, tune_id):
+                    fair_share_queue.finished(tune_id)
+                    tune = get_tune(tune_id)
+                    if tune:
+                        cancel_generation(self.channel_layer, tune)
+                    continue
+                batches.setdefault(fair_share_queue.batch_of(tune_id) or tune_id, []).append(tune_id)
+            model_names = dict(RNNTune.objects.filter(id__in=to_dispatch).values_list('id', 'rnn_model_name'))
+            for tune_ids in batches.values():
+                if tune_ids[0] not in model_names:
+                    # Deleted meanwhile
+                    for tune_id in tune_ids:
+                        fair_share_queue.finished(tune_id)
+                    continue
+                event = {'type': 'folkrnn.generate'}
+                if len(tune_ids) == 1:
+                    event['id'] = tune_ids[0]
+                else:
+                    event['ids'] = tune_ids
+                async_to_sync(self.channel_layer.send)(model_channel(model_names[tune_ids[0]]), event)
+            to_dispatch = fair_share_queue.dispatch()
+        positions = fair_share_queue.positions()
+        for tune_id, position in positions.items():
+            if queue_positions_sent.get(tune_id) != position:
+                async_to_sync(self.channel_layer.group_send)(
+                                        f'tune_{tune_id}',
+                                        {
+                                            'type': 'generation_status',
+                                            'status': 'queue_position',
+                                            'tune_id': tune_id,
+                                            'position': position,
+                                        })
+        queue_positions_sent.clear()
+        queue_positions_sent.update(positions)
+        
+        if not positions:
+            self.dispatch_pregeneration()
+    
+    def dispatch_pregeneration(self):
+        expired = monotonic() - FOLKRNN_QUEUE_IN_FLIGHT_TIMEOUT
+        for model in [k for k, v in pregenerating.items() if v < expired]:
+            del pregenerating[model]
+        
+        spare = min(
+                FOLKRNN_PREGENERATE_MAX_IN_FLIGHT - len(pregenerating),
+                fair_share_queue.max_in_flight - len(fair_share_queue.in_flight) - len(pregenerating),
+                )
+        if spare <= 0:
+            return
+        for model in [x for x in models_to_pregenerate() if x not in pregenerating][:spare]:
+            pregenerating[model] = monotonic()
+            async_to_sync(self.channel_layer.send)(model_channel(model), {
+                                                    'type': 'folkrnn.pregenerate', 
+                                                    'model': model,
+                                                    })
+
+def cancel_generation(channel_layer, tune):
+    '''
+    Mark the tune as cancelled, as no client is listening for it. Nothing is saved out.
+    Any client that has since registered for it has it queued again, see ComposerConsumer.
+    '''
+    logger.info(f'Generation cancelled for tune {tune.id}, no client listening')
+    tune.rnn_cancelled = now()
+    tune.save()
+    async_to_sync(clear_progress)(channel_layer, tune.id)
+    async_to_sync(channel_layer.group_send)(
+                            f'tune_{tune.id}',
+                            {
+                                'type': 'generation_status',
+                                'status': 'cancelled',
+                                'tune_id': tune.id,
+                            })
 
-    def connect(self):
-        self.accept()
-        try:
-            id_int = int(self.scope['path'][1:])
-            self.session = Session.objects.get(id=id_int).id
-        except (ValueError, TypeError, Session.DoesNotExist):
-            self.session = Session.objects.create().id
+def fail_generation(channel_layer, tune):
+    '''
+    Drop the tune, as its generation failed, telling any client, as per a tune the queue rejects.
+    '''
+    logger.error(f'Generation failed for tune {tune.id}')
+    RNNTune.objects.filter(id=tune.id).delete()
+    async_to_sync(clear_progress)(channel_layer, tune.id)
+    async_to_sync(channel_layer.group_send)(
+                            f'tune_{tune.id}',
+                            {
+                                'type': 'generation_status',
+                                'status': 'failed',
+                                'tune_id': tune.id,
+                            })
+
+def uncancel_tune(tune_id):
+    '''
+    Clear the tune's cancellation, returning True if it was cancelled.
+    Only one caller gets True, so only one queues it again.
+    '''
+    return RNNTune.objects.filter(id=tune_id, rnn_cancelled__isnull=False).update(rnn_cancelled=None, rnn_started=None) > 0
+
+def get_or_create_session(path):
+    '''
+    Return the id of the session in the websocket path, or a new session if none.
+    Returns (session id, created)
+    '''
+    try:
+        return Session.objects.get(id=int(path[1:])).id, False
+    except (ValueError, TypeError, Session.DoesNotExist):
+        return Session.objects.create().id, True
+
+def get_tune(tune_id):
+    '''
+    Return the RNNTune, or None if tune_id is invalid
+    '''
+    try:
+        return RNNTune.objects.get(id=tune_id)
+    except (TypeError, ValueError, RNNTune.DoesNotExist):
+        return None
+
+def tune_from_form(cleaned_data):
+    '''
+    Return an unsaved RNNTune as per the compose form.
+    '''
+    tune = RNNTune()
+    tune.rnn_model_name = cleaned_data['model']
+    tune.seed = cleaned_data['seed']
+    tune.temp = cleaned_data['temp']
+    tune.meter = cleaned_data['meter']
+    tune.key = cleaned_data['key']
+    tune.unitnotelength = cleaned_data['unitnotelength']
+    tune.start_abc = cleaned_data['start_abc']
+    return tune
+
+def create_variations(tune, count):
+    '''
+    Save count variations of the unsaved tune, its seed then random seeds, with one insert.
+    Returns the tunes
+    '''
+    seeds = [tune.seed] + [x for x in sample(range(FOLKRNN_MAX_SEED + 1), count) if x != tune.seed][:count - 1]
+    variations = [
+        RNNTune(
+            rnn_model_name=tune.rnn_model_name,
+            seed=seed,
+            temp=tune.temp,
+            meter=tune.meter,
+            key=tune.key,
+            # generate appropriate L header if none specfifed by compose UI
+            unitnotelength=tune.unitnotelength or l_for_m_header(tune.meter, seed, tune.rnn_model_name),
+            start_abc=tune.start_abc,
+            )
+        for seed in seeds
+        ]
+    return RNNTune.objects.bulk_create(variations)
+
+def save_from_cache(tune, cached_tune_id=None, raw=None):
+    '''
+    Save out as per folk_rnn worker, for a tune composed from the result cache, or pregenerated.
+    '''
+    model_name = tune.rnn_model_name.replace('.pickle', '')
+    try:
+        if raw is None:
+            raw, _ = tune_store.get(cached_tune_id, model_name)
+        tune_store.put(tune.id, model_name, raw, tune.abc)
+    except (OSError, TypeError):
+        logger.warning(f'compose_from_cache: could not save files for tune {tune.id} from {cached_tune_id or "pregenerated"}')
+    tune.rnn_finished = now()
+    tune.save()
+
+class ComposerConsumer(AsyncJsonWebsocketConsumer):
+    '''
+    The composer page's websocket. Runs on the event loop, only ORM and file 
+    access is run in threads, so a connection doesn't hold a thread between messages.
+    '''
+
+    async def connect(self):
+        await self.accept()
+        self.session, created = await database_sync_to_async(get_or_create_session)(self.scope['path'])
+        if created:
             logger.info(f"New session; {self.session}. Path was {self.scope['path']}")
-            self.send_json({
+            await self.send_json({
                         'command': 'set_session',
                         'session_id': self.session,
                         })
@@ -155,88 +632,203 @@ class ComposerConsumer(JsonWebsocketConsumer):
         if hasattr(self, 'abc_sent'):
             print('Surprise! These are not created on connect!')
         self.abc_sent = {}
+        self.listening = set() # tune ids counted as listened for, see progress.add_listener
+        
+        # A visitor may well compose, so have the pregenerated tunes ready
+        await self.channel_layer.send('folk_rnn_queue', {'type': 'queue.refill', 'connect': True})
     
-    def generation_status(self, message):
+    async def generation_status(self, message):
         if message['status'] in ['start', 'finish']:
             self.log_use(f"Generate {message['status']} for tune {message['tune']['id']}")
             
+            if message['status'] == 'finish' and result_cache and not message['tune']['rnn_truncated']:
+                tune = message['tune']
+                since = model_since(tune['rnn_model_name'])
+                # Not if maybe generated with the model's previous version
+                if since and parse_datetime(tune['rnn_started']) >= since:
+                    key = result_key(tune['rnn_model_name'], tune['seed'], tune['temp'], tune['prime_tokens'])
+                    result_cache.put(key, tune['abc'], tune['id'])
+            
             message['command'] = message.pop('type')
-            self.send_json(message)
+            await self.send_json(message)
         elif message['status'] == 'new_abc':
             '''
-            Send unsent tokens to the client, i.e. realtime update of generation.
-            A websocket will typically connect mid-generation, so broadcasting all 
-            the abc internally and then sending only what is new guarantees complete 
-            abc for the client with minimal network overhead or server complexity.
+            Send unsent abc to the client, i.e. realtime update of generation.
+            The abc arrives in deltas, each at an offset into the tune's abc.
+            A websocket connecting mid-generation is sent the abc so far from the
+            tune's progress buffer on register. Should abc still be missed, it is
+            then not streamed, the client getting the complete abc on finish.
             '''
-            to_send = message['abc'].replace(self.abc_sent[message['tune_id']], '')
-            self.abc_sent[message['tune_id']] += to_send
-            self.send_json({
-                        'command': 'add_token',
-                        'token': to_send,
-                        'tune_id': message['tune_id']
-                        })
+            await self.send_abc(message['tune_id'], message['offset'], message['abc'])
+        elif message['status'] == 'cancelled':
+            # Registered since the worker found no client listening, so queue it again
+            if message['tune_id'] in self.abc_sent:
+                await self.requeue(message['tune_id'])
+        elif message['status'] in ['queue_position', 'rejected', 'failed']:
+            if message['status'] in ['rejected', 'failed']:
+                self.log_use(f"Generate {message['status']} for tune {message['tune_id']}")
+                self.abc_sent.pop(message['tune_id'], None)
+                await self.channel_layer.group_discard(
+                                            f"tune_{message['tune_id']}", 
+                                            self.channel_name
+                                            )
+            message['command'] = message.pop('type')
+            await self.send_json(message)
+    
+    async def send_abc(self, tune_id, offset, abc):
+        '''
+        Send the client the abc it doesn't already have.
+        '''
+        sent = self.abc_sent.get(tune_id)
+        if sent is None:
+            return
+        if offset > sent:
+            logger.debug(f'send_abc: tune {tune_id} abc from {sent} missed, not streaming')
+            self.abc_sent[tune_id] = None
+            return
+        to_send = abc[sent - offset:]
+        if not to_send:
+            return
+        self.abc_sent[tune_id] = offset + len(abc)
+        await self.send_json({
+                    'command': 'add_token',
+                    'token': to_send,
+                    'offset': sent,
+                    'tune_id': tune_id,
+                    })
         
-    def receive_json(self, content):
+    async def receive_json(self, content):
         logger.debug(f'{id(self)} – receive_json: {content}')
         if content['command'] == 'register_for_tune':
-            try:
-                tune = RNNTune.objects.get(id=content['tune_id'])
-            except (TypeError, RNNTune.DoesNotExist):
+            tune = await database_sync_to_async(get_tune)(content['tune_id'])
+            if tune is None:
                 logger.debug('invalid tune_id')
                 return
             
             self.log_use(f"Show tune {tune.id}")
-            self.abc_sent[tune.id] = ''
-            async_to_sync(self.channel_layer.group_add)(
+            # Already registered if composed here, and so already sent
+            already_registered = tune.id in self.abc_sent
+            await self.channel_layer.group_add(
                                         f"tune_{tune.id}", 
                                         self.channel_name
                                         )
-            if (tune.rnn_finished is not None):
-                self.send_json({
+            if already_registered:
+                return
+            # Read after joining the group, so no abc is missed in between
+            await database_sync_to_async(tune.refresh_from_db)()
+            if tune.rnn_finished is None:
+                await self.listen(tune.id)
+            if tune.rnn_cancelled is not None:
+                self.abc_sent[tune.id] = content.get('offset', 0)
+                await self.requeue(tune.id)
+            elif tune.rnn_finished is not None:
+                self.abc_sent[tune.id] = None
+                await self.send_json({
                     'command': 'generation_status',
                     'status': 'finish',
                     'tune': tune.plain_dict(),
                 })
+            else:
+                # Send any abc generated so far the client doesn't have, i.e. joining mid-generation or reconnecting
+                offset = content.get('offset', 0)
+                self.abc_sent[tune.id] = offset
+                if tune.rnn_started is not None:
+                    abc = await get_progress(self.channel_layer, tune.id, offset)
+                    await self.send_abc(tune.id, offset, abc)
         if content['command'] == 'unregister_for_tune':
             self.log_use(f"Hide tune {content['tune_id']}")
             try:
                 del self.abc_sent[content['tune_id']]
             except KeyError:
                 logger.warning(f"unregister_for_tune: tune {content['tune_id']} not in abc_sent")
-            async_to_sync(self.channel_layer.group_discard)(
+            await self.channel_layer.group_discard(
                                         f"tune_{content['tune_id']}", 
                                         self.channel_name
                                         )
+            await self.unlisten(content['tune_id'])
         if content['command'] == 'compose':
             form = ComposeForm(content['data'])
             if form.is_valid():
-                tune = RNNTune()
-                tune.rnn_model_name = form.cleaned_data['model']
-                tune.seed = form.cleaned_data['seed']
-                tune.temp = form.cleaned_data['temp']
-                tune.meter = form.cleaned_data['meter']
-                tune.key = form.cleaned_data['key']
-                tune.unitnotelength = form.cleaned_data['unitnotelength']
-                tune.start_abc = form.cleaned_data['start_abc']
+                tune = tune_from_form(form.cleaned_data)
+                # with the seed left to chance, use that of a pregenerated tune if any
+                pregenerated = None
+                if content['data'].get('auto_seed') and tune.unitnotelength == '':
+                    pregenerated = await database_sync_to_async(claim_pregenerated)(tune)
+                    if pregenerated:
+                        tune.seed = pregenerated.seed
+                        tune.unitnotelength = pregenerated.unitnotelength
                 # generate appropriate L header if none specfifed by compose UI
                 if tune.unitnotelength == '':
                     tune.unitnotelength = l_for_m_header(tune.meter, tune.seed, tune.rnn_model_name)
-                tune.save()
+                await database_sync_to_async(tune.save)()
                 
-                self.log_use(f"Compose command. Tune {tune.id} created.")
-                
-                async_to_sync(self.channel_layer.send)('folk_rnn', {
-                                                        'type': 'folkrnn.generate', 
-                                                        'id': tune.id
-                                                        })
-                self.send_json({
-                    'command': 'add_tune',
-                    'tune': tune.plain_dict(),
-                    })
+                cached = await database_sync_to_async(result_cache.get)(tune) if result_cache and not pregenerated else None
+                if pregenerated:
+                    self.log_use(f"Compose command. Tune {tune.id} created. Pregenerated.")
+                    metrics.inc('folkrnn_tunes_total', model=tune.rnn_model_name.replace('.pickle', ''), outcome='pregenerated')
+                    await self.send_json({
+                        'command': 'add_tune',
+                        'tune': tune.plain_dict(),
+                        })
+                    await self.compose_from_cache(tune, pregenerated.abc, raw=pregenerated.raw)
+                    await self.channel_layer.send('folk_rnn_queue', {'type': 'queue.refill'})
+                elif cached:
+                    self.log_use(f"Compose command. Tune {tune.id} created. Cached as tune {cached[1]}.")
+                    metrics.inc('folkrnn_tunes_total', model=tune.rnn_model_name.replace('.pickle', ''), outcome='cached')
+                    await self.send_json({
+                        'command': 'add_tune',
+                        'tune': tune.plain_dict(),
+                        })
+                    await self.compose_from_cache(tune, *cached)
+                else:
+                    self.log_use(f"Compose command. Tune {tune.id} created.")
+                    
+                    await self.register_composed(tune.id)
+                    await self.channel_layer.send('folk_rnn_queue', {
+                                                    'type': 'queue.enqueue', 
+                                                    'id': tune.id,
+                                                    'session': self.session,
+                                                    })
+                    await self.send_json({
+                        'command': 'add_tune',
+                        'tune': tune.plain_dict(),
+                        })
             else:
                 self.log_use(f"Compose command data had errors: {form.errors}")
                 logger.info(f'receive_json.compose: invalid form data\n{form.errors}')
+        if content['command'] == 'compose_batch':
+            form = ComposeForm(content['data'])
+            try:
+                count = int(content['count'])
+            except (KeyError, TypeError, ValueError):
+                count = 0
+            if form.is_valid() and 0 < count <= FOLKRNN_COMPOSE_BATCH_MAX:
+                tunes = await database_sync_to_async(create_variations)(tune_from_form(form.cleaned_data), count)
+                self.log_use(f"Compose batch command. Tunes {', '.join(str(x.id) for x in tunes)} created.")
+                to_enqueue = []
+                for tune in tunes:
+                    cached = await database_sync_to_async(result_cache.get)(tune) if result_cache else None
+                    await self.send_json({
+                        'command': 'add_tune',
+                        'tune': tune.plain_dict(),
+                        })
+                    if cached:
+                        self.log_use(f"Tune {tune.id} cached as tune {cached[1]}.")
+                        metrics.inc('folkrnn_tunes_total', model=tune.rnn_model_name.replace('.pickle', ''), outcome='cached')
+                        await self.compose_from_cache(tune, *cached)
+                    else:
+                        await self.register_composed(tune.id)
+                        to_enqueue.append(tune.id)
+                if to_enqueue:
+                    # One queue entry, so generated together as one batch
+                    await self.channel_layer.send('folk_rnn_queue', {
+                                                    'type': 'queue.enqueue', 
+                                                    'ids': to_enqueue,
+                                                    'session': self.session,
+                                                    })
+            else:
+                self.log_use(f"Compose batch command data had errors: {form.errors}, count {content.get('count')}")
+                logger.info(f'receive_json.compose_batch: invalid form data or count\n{form.errors}')
         if content['command'] == 'notification':
             if content['type'] == 'state_change':
                 # untrusted input
@@ -254,13 +846,89 @@ class ComposerConsumer(JsonWebsocketConsumer):
             else:
                 logger.warning('Unknown notification')
         
-    def disconnect(self, close_code):
+    async def register_composed(self, tune_id):
+        '''
+        Register for the tune just composed, before generation starts, so no abc is missed.
+        '''
+        self.abc_sent[tune_id] = 0
+        await self.channel_layer.group_add(
+                                    f"tune_{tune_id}", 
+                                    self.channel_name
+                                    )
+        await self.listen(tune_id)
+    
+    async def compose_from_cache(self, tune, abc, cached_tune_id=None, raw=None):
+        '''
+        Complete the tune with the ABC previously generated for the same parameters, 
+        skipping the folk_rnn worker. The ABC is sent to the client as if generated.
+        The raw folk-rnn output is that of the cached tune, or as given, i.e. pregenerated.
+        '''
+        self.abc_sent[tune.id] = 0
+        await self.channel_layer.group_add(
+                                    f"tune_{tune.id}", 
+                                    self.channel_name
+                                    )
+        
+        tune.rnn_started = now()
+        await database_sync_to_async(tune.save)()
+        await self.generation_status({
+                                'type': 'generation_status',
+                                'status': 'start',
+                                'tune': tune.plain_dict(),
+                                })
+        
+        tune.abc = abc
+        tune.header_x = tune.id
+        if FOLKRNN_TUNE_TITLE:
+            tune.title = f'{FOLKRNN_TUNE_TITLE}{tune.id}'
+        await self.generation_status({
+                                'type': 'generation_status',
+                                'status': 'new_abc',
+                                'tune_id': tune.id,
+                                'offset': 0,
+                                'abc': tune.abc,
+                                })
+        
+        await database_sync_to_async(save_from_cache)(tune, cached_tune_id, raw)
+        await self.generation_status({
+                                'type': 'generation_status',
+                                'status': 'finish',
+                                'tune': tune.plain_dict(),
+                                })
+    
+    async def listen(self, tune_id):
+        if tune_id not in self.listening:
+            self.listening.add(tune_id)
+            await add_listener(self.channel_layer, tune_id)
+    
+    async def unlisten(self, tune_id):
+        if tune_id in self.listening:
+            self.listening.remove(tune_id)
+            await remove_listener(self.channel_layer, tune_id)
+    
+    async def requeue(self, tune_id):
+        '''
+        Queue a cancelled tune again, as a client is now listening for it.
+        Generation is deterministic, so the abc the client has is still valid.
+        '''
+        if await database_sync_to_async(uncancel_tune)(tune_id):
+            self.log_use(f"Generate requeued for cancelled tune {tune_id}")
+            await self.listen(tune_id)
+            await self.channel_layer.send('folk_rnn_queue', {
+                                            'type': 'queue.enqueue', 
+                                            'id': tune_id,
+                                            'session': self.session,
+                                            })
+    
+    async def disconnect(self, close_code):
         self.log_use("Disconnect")
         for tune_id in self.abc_sent:
-            async_to_sync(self.channel_layer.group_discard)(
+            await self.channel_layer.group_discard(
                                             f'tune_{tune_id}', 
                                             self.channel_name
                                             )
+        for tune_id in list(self.listening):
+            await self.unlisten(tune_id)
     
     def log_use(self, message):
-        logger_use.info(message, extra={'session': self.session})
\ No newline at end of file
+        logger_use.info(message, extra={'session': self.session})
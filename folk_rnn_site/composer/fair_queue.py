@@ -0,0 +1,97 @@
+from collections import OrderedDict, deque
+from time import monotonic
+
+from composer import FOLKRNN_QUEUE_MAX_IN_FLIGHT, FOLKRNN_QUEUE_SESSION_MAX_IN_FLIGHT, FOLKRNN_QUEUE_MAX_DEPTH, FOLKRNN_QUEUE_IN_FLIGHT_TIMEOUT
+
+class FairShareQueue:
+    '''
+    Tunes waiting for the folk_rnn workers, served round-robin by session.
+    max_in_flight - tunes with the workers at once, i.e. matching the workers' capacity
+    session_max_in_flight - tunes with the workers at once per session
+    max_depth - tunes waiting, beyond which more are rejected
+    in_flight_timeout - seconds after which a tune with the workers is presumed lost, e.g. the worker died
+    Tunes enqueued as a batch, i.e. variations composed together, are dispatched together as capacity
+    allows, and count as one against their session's cap.
+    '''
+    def __init__(self,
+            max_in_flight=FOLKRNN_QUEUE_MAX_IN_FLIGHT,
+            session_max_in_flight=FOLKRNN_QUEUE_SESSION_MAX_IN_FLIGHT,
+            max_depth=FOLKRNN_QUEUE_MAX_DEPTH,
+            in_flight_timeout=FOLKRNN_QUEUE_IN_FLIGHT_TIMEOUT,
+            ):
+        self.max_in_flight = max_in_flight
+        self.session_max_in_flight = session_max_in_flight
+        self.max_depth = max_depth
+        self.in_flight_timeout = in_flight_timeout
+        self.pending = OrderedDict() # session: deque of tune ids, sessions in turn order
+        self.in_flight = {} # tune id: (session, time dispatched)
+        self.batches = {} # tune id: batch, for tunes enqueued as a batch
+
+    def __len__(self):
+        return sum(len(x) for x in self.pending.values())
+
+    def enqueue(self, session, *tune_ids):
+        '''
+        Queue the tune, or several tunes as a batch, i.e. all or none of them.
+        Returns False if rejected, i.e. the queue is full or would be.
+        '''
+        if len(self) + len(tune_ids) > self.max_depth:
+            return False
+        self.pending.setdefault(session, deque()).extend(tune_ids)
+        if len(tune_ids) > 1:
+            for tune_id in tune_ids:
+                self.batches[tune_id] = tune_ids[0]
+        return True
+
+    def finished(self, tune_id):
+        self.in_flight.pop(tune_id, None)
+        self.batches.pop(tune_id, None)
+
+    def batch_of(self, tune_id):
+        return self.batches.get(tune_id)
+
+    def session_in_flight(self, session):
+        return len({self.batches.get(k, k) for k, (x, _) in self.in_flight.items() if x == session})
+
+    def dispatch(self):
+        '''
+        Return the tune ids to send to the workers now, in order.
+        '''
+        expired = monotonic() - self.in_flight_timeout
+        for tune_id in [k for k, v in self.in_flight.items() if v[1] < expired]:
+            self.finished(tune_id)
+
+        to_dispatch = []
+        while len(self.in_flight) < self.max_in_flight:
+            session = next((x for x in self.pending if self.session_in_flight(x) < self.session_max_in_flight), None)
+            if session is None:
+                break
+            tune_ids = [self.pending[session].popleft()]
+            batch = self.batches.get(tune_ids[0])
+            while (batch is not None
+                    and self.pending[session]
+                    and self.batches.get(self.pending[session][0]) == batch
+                    and len(self.in_flight) + len(tune_ids) < self.max_in_flight):
+                tune_ids.append(self.pending[session].popleft())
+            if self.pending[session]:
+                self.pending.move_to_end(session)
+            else:
+                del self.pending[session]
+            for tune_id in tune_ids:
+                self.in_flight[tune_id] = (session, monotonic())
+            to_dispatch += tune_ids
+        return to_dispatch
+
+    def positions(self):
+        '''
+        Return {tune id: position} for the tunes waiting, 1 being next, taking turns by session.
+        '''
+        positions = {}
+        queues = [list(x) for x in self.pending.values()]
+        position = 1
+        for turn in range(max((len(x) for x in queues), default=0)):
+            for queue in queues:
+                if turn < len(queue):
+                    positions[queue[turn]] = position
+                    position += 1
+        return positions
@@ -11,7 +11,7 @@ class ChoiceFieldNoValidation(forms.ChoiceField):
         pass
 
 class ComposeForm(forms.Form):
-    model = forms.ChoiceField(choices=rnn_choices())
+    model = forms.ChoiceField(choices=rnn_choices) # called per form, so models added since are offered
     temp = forms.DecimalField(min_value=0.01, max_value=10, decimal_places=2, initial=1)
     seed = forms.IntegerField(min_value=0, max_value=FOLKRNN_MAX_SEED, initial=lambda : randint(0, FOLKRNN_MAX_SEED))
     unitnotelength = ChoiceFieldNoValidation(choices=())
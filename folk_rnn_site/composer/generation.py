@@ -0,0 +1,475 @@
+import threading
+import queue
+import logging
+import itertools
+import re
+from collections import OrderedDict
+from time import monotonic
+
+import numpy as np
+
+from composer.model_bundle import QuantizedWeights
+
+logger = logging.getLogger(__name__)
+
+# As per folk_rnn's Folk_RNN.generate_tune, a runaway tune is stopped at this length
+MAX_SEQUENCE_LENGTH = 1000
+
+# Bar line tokens a tune can end on, e.g. | || |] :|
+bar_end_token_regex = re.compile(r'^:*\|+\]?$')
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+def rows_dot(x, weights):
+    '''
+    np.dot() of each row of x on its own, i.e. a vector-matrix product per row as per folk_rnn's Folk_RNN.
+    A matrix-matrix product of the rows together is accumulated by BLAS in a different order,
+    so a row's result would differ in its last bits depending on the other rows.
+    '''
+    return np.stack([np.dot(row, weights) for row in x])
+
+def dense(weights):
+    '''
+    The weights matrix as an array, i.e. a QuantizedWeights dequantized for the one product.
+    '''
+    return weights[:] if isinstance(weights, QuantizedWeights) else weights
+
+def is_header_token(token):
+    return token.strip('[]')[0:2] in ['L:', 'M:', 'K:']
+
+class PrimeStateCache:
+    '''
+    The LSTM states reached by priming the network with token sequences.
+    Keys are token index sequences from the start token, values the state to step
+    that sequence's last token with, i.e. having consumed all but the last token.
+    Bounded by the total bytes of the states held, least recently used evicted first.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.states = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def put(self, sequence, state):
+        key = tuple(sequence)
+        with self.lock:
+            if key in self.states:
+                self.states.move_to_end(key)
+                return
+            # Copy, as state rows are views of the whole batch's arrays
+            state = [(np.array(hid), np.array(cell)) for hid, cell in state]
+            nbytes = sum(hid.nbytes + cell.nbytes for hid, cell in state)
+            if nbytes > self.max_bytes:
+                return
+            self.states[key] = state
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.states.popitem(last=False)
+                self.nbytes -= sum(hid.nbytes + cell.nbytes for hid, cell in evicted)
+
+    def longest_prefix(self, sequence):
+        '''
+        Return (prefix, state) for the longest cached prefix of the sequence, or (None, None)
+        '''
+        with self.lock:
+            for length in range(len(sequence), 1, -1):
+                key = tuple(sequence[:length])
+                if key in self.states:
+                    self.states.move_to_end(key)
+                    return list(key), self.states[key]
+        return None, None
+
+class BatchedFolkRNN:
+    '''
+    The folk-rnn LSTM network, stepped for many tunes at once.
+    Each row of the state matrices is a tune, so the elementwise arithmetic of a step is
+    done once for the batch. The products with the weights are per row, see rows_dot(),
+    so the arithmetic per row is as per folk_rnn's Folk_RNN, and a tune's tokens do
+    not depend on which other tunes it was batched with.
+    With gemm, the products are one matrix-matrix product for the batch, and a tune's prime tokens
+    are ingested before generation, see ingest(). BLAS then accumulates in an order depending on
+    the rows, so a tune's logits differ in their last bits by batch, and very occasionally a sampled
+    token. Such a tune is then not exactly as per Folk_RNN, nor as cached or pregenerated.
+    Weights matrices that are QuantizedWeights are held as such, e.g. memory-mapped from a bundle,
+    and dequantized a matrix at a time for each product, see model_bundle.py
+    '''
+    def __init__(self, token2idx, param_values, num_layers, wildcard_token='*', prime_cache_bytes=0, gemm=False):
+        self.token2idx = token2idx
+        self.idx2token = {v: k for k, v in token2idx.items()}
+        self.vocab_size = len(token2idx)
+        self.start_idx = token2idx['<s>']
+        self.end_idx = token2idx['</s>']
+        self.wildcard_token = wildcard_token
+        self.num_layers = num_layers
+
+        # Lasagne parameter order: the (fixed, identity) embedding, then per LSTM layer
+        # W_in, W_hid, b for each of the input, forget, cell, output gates, then cell_init, hid_init.
+        # Then the dense output layer W, b.
+        self.layers = []
+        for jj in range(num_layers):
+            p = param_values[1 + jj*14 : 1 + (jj+1)*14]
+            self.layers.append({
+                'Wxi': p[0], 'Whi': p[1], 'bi': p[2],
+                'Wxf': p[3], 'Whf': p[4], 'bf': p[5],
+                'Wxc': p[6], 'Whc': p[7], 'bc': p[8],
+                'Wxo': p[9], 'Who': p[10], 'bo': p[11],
+                'cell_init': p[12], 'hid_init': p[13],
+                })
+        self.output_W = param_values[num_layers*14 + 1]
+        self.output_b = param_values[num_layers*14 + 2]
+
+        self.prime_cache = PrimeStateCache(prime_cache_bytes) if prime_cache_bytes else None
+        self.gemm = gemm
+
+    @property
+    def nbytes(self):
+        '''
+        The bytes of the weights held, i.e. as stored if quantized.
+        '''
+        return sum(x.nbytes for layer in self.layers for x in layer.values()) + self.output_W.nbytes + self.output_b.nbytes
+
+    def dot(self, x, weights):
+        '''
+        The product of the rows of x with the weights matrix, per row or as one, as per gemm.
+        '''
+        weights = dense(weights)
+        return np.dot(x, weights) if self.gemm else rows_dot(x, weights)
+
+    @classmethod
+    def from_job_spec(cls, job_spec, **kwargs):
+        return cls(
+            job_spec['token2idx'],
+            job_spec['param_values'],
+            job_spec['num_layers'],
+            **kwargs
+            )
+
+    def initial_state(self):
+        '''
+        Return the (hid, cell) state of each layer for a new tune, i.e. a batch of one.
+        '''
+        return [(np.reshape(layer['hid_init'], (1, -1)), np.reshape(layer['cell_init'], (1, -1))) for layer in self.layers]
+
+    def step(self, token_idxs, state):
+        '''
+        Advance the network one token for every row of the batch.
+        token_idxs - the input token index for each row
+        state - list per layer of (hid, cell), each array of shape (rows, units)
+        Returns the new state
+        '''
+        new_state = []
+        x = None
+        for jj, layer in enumerate(self.layers):
+            htm1, ctm1 = state[jj]
+            if jj == 0:
+                # One-hot input: the product with the input weights is a selection of rows
+                xi, xf, xc, xo = (layer[w][token_idxs] for w in ['Wxi', 'Wxf', 'Wxc', 'Wxo'])
+            else:
+                xi, xf, xc, xo = (self.dot(x, layer[w]) for w in ['Wxi', 'Wxf', 'Wxc', 'Wxo'])
+            it = sigmoid(xi + self.dot(htm1, layer['Whi']) + layer['bi'])
+            ft = sigmoid(xf + self.dot(htm1, layer['Whf']) + layer['bf'])
+            ct = ft * ctm1 + it * np.tanh(xc + self.dot(htm1, layer['Whc']) + layer['bc'])
+            ot = sigmoid(xo + self.dot(htm1, layer['Who']) + layer['bo'])
+            ht = ot * np.tanh(ct)
+            new_state.append((ht, ct))
+            x = ht
+        return new_state
+
+    def ingest(self, token_idxs, state):
+        '''
+        Advance the network through a sequence of tokens for a batch of one, i.e. a tune's prime tokens.
+        As per step() a token at a time, but a layer at a time: each layer runs through the whole
+        sequence before the next, its input projections for every timestep made as one matrix-matrix
+        product. So as per gemm, the state differs from stepping in its last bits.
+        Returns the new state
+        '''
+        new_state = []
+        x = None
+        for jj, layer in enumerate(self.layers):
+            htm1, ctm1 = state[jj]
+            if jj == 0:
+                xi, xf, xc, xo = (layer[w][token_idxs] for w in ['Wxi', 'Wxf', 'Wxc', 'Wxo'])
+            else:
+                xi, xf, xc, xo = (np.dot(x, dense(layer[w])) for w in ['Wxi', 'Wxf', 'Wxc', 'Wxo'])
+            Whi, Whf, Whc, Who = (dense(layer[w]) for w in ['Whi', 'Whf', 'Whc', 'Who'])
+            hids = []
+            for t in range(len(token_idxs)):
+                it = sigmoid(xi[t:t+1] + np.dot(htm1, Whi) + layer['bi'])
+                ft = sigmoid(xf[t:t+1] + np.dot(htm1, Whf) + layer['bf'])
+                ctm1 = ft * ctm1 + it * np.tanh(xc[t:t+1] + np.dot(htm1, Whc) + layer['bc'])
+                ot = sigmoid(xo[t:t+1] + np.dot(htm1, Who) + layer['bo'])
+                htm1 = ot * np.tanh(ctm1)
+                hids.append(htm1)
+            new_state.append((htm1, ctm1))
+            x = np.concatenate(hids)
+        return new_state
+
+    def logits(self, hid):
+        '''
+        The output layer activations for each row of top layer hid state.
+        '''
+        return self.dot(hid, self.output_W) + self.output_b
+
+    @staticmethod
+    def probabilities(logits, temperature):
+        '''
+        The next token probability distribution for a row of output layer activations.
+        '''
+        logits = logits / temperature
+        exp = np.exp(logits - np.max(logits))
+        return exp / np.sum(exp)
+
+class GenerationCancelled(Exception):
+    '''
+    Raised by an on_token callback to stop the generation, on_finish is then called with the tokens so far.
+    '''
+
+class GenerationBudget:
+    '''
+    Limits on a tune's generation, see models() 'max_tokens' and 'max_seconds'.
+    The clock starts on the first check, i.e. as generation starts, not when queued.
+    '''
+    def __init__(self, max_tokens, max_seconds):
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+        self.deadline = None
+
+    def exceeded(self, token_count):
+        if self.deadline is None:
+            self.deadline = monotonic() + self.max_seconds
+        return token_count >= self.max_tokens or monotonic() > self.deadline
+
+def truncate_to_bar(tune_tokens):
+    '''
+    Return the tune tokens up to and including the last bar line, i.e. a valid ABC ending.
+    Without any bar line, just the header tokens.
+    '''
+    for index in range(len(tune_tokens) - 1, -1, -1):
+        if bar_end_token_regex.match(tune_tokens[index]):
+            return tune_tokens[:index + 1]
+    return list(itertools.takewhile(is_header_token, tune_tokens))
+
+class Generation:
+    '''
+    The state of one tune's generation: its tokens so far, sampling rng and LSTM state.
+    on_token is called with each token as generated, including prime tokens.
+    on_finish is called with the list of tune tokens once generation is complete, or None if it failed.
+    If the folk_rnn has a prime cache, generation resumes from the longest cached 
+    prefix of the prime tokens, and caches the states reached after the header 
+    prime tokens and after all the prime tokens up to any wildcard.
+    If the folk_rnn steps with gemm, the prime tokens up to any wildcard are then ingested
+    here, rather than stepped a token at a time with the batch.
+    Once stepped, the state is a row of the batch's state, see step_generations.
+    '''
+    def __init__(self, folk_rnn, prime_tokens=None, seed=42, temperature=1.0, on_token=None, on_finish=None):
+        self.folk_rnn = folk_rnn
+        self.rng = np.random.RandomState(seed)
+        self.temperature = temperature
+        self.on_token = on_token
+        self.on_finish = on_finish
+        self.prime = []
+        if prime_tokens:
+            self.prime = [None if x == folk_rnn.wildcard_token else folk_rnn.token2idx[x] for x in prime_tokens.split()]
+        self.sequence = [folk_rnn.start_idx]
+        self.batch_state = None
+        self.batch_row = None
+        self.state = folk_rnn.initial_state()
+        self.finished = False
+
+        self.cache_lengths = set()
+        if folk_rnn.prime_cache:
+            forced = list(itertools.takewhile(lambda x: x is not None, self.prime))
+            header = list(itertools.takewhile(lambda x: is_header_token(folk_rnn.idx2token[x]), forced))
+            self.cache_lengths = {1 + len(header), 1 + len(forced)} - {1}
+            sequence, state = folk_rnn.prime_cache.longest_prefix([folk_rnn.start_idx] + forced)
+            if sequence:
+                self.sequence = sequence
+                self.state = state
+                if self.on_token:
+                    for token_idx in sequence[1:]:
+                        self.on_token(folk_rnn.idx2token[token_idx])
+
+        if folk_rnn.gemm:
+            forced_sequence = [folk_rnn.start_idx] + list(itertools.takewhile(lambda x: x is not None, self.prime))
+            # In chunks ending where states are to be cached
+            for length in sorted(self.cache_lengths | {len(forced_sequence)}):
+                if length <= len(self.sequence):
+                    continue
+                start = len(self.sequence)
+                self.state = folk_rnn.ingest(np.array(forced_sequence[start - 1:length - 1]), self.state)
+                self.sequence = forced_sequence[:length]
+                if folk_rnn.prime_cache:
+                    self.cache_prime_state()
+                if self.on_token:
+                    for token_idx in forced_sequence[start:length]:
+                        self.on_token(folk_rnn.idx2token[token_idx])
+
+    @property
+    def state(self):
+        '''
+        The (hid, cell) state of each layer, as a batch of one.
+        '''
+        if self.batch_state is None:
+            return self.own_state
+        return [(hid[self.batch_row:self.batch_row+1], cell[self.batch_row:self.batch_row+1]) for hid, cell in self.batch_state]
+
+    @state.setter
+    def state(self, state):
+        self.own_state = state
+        self.batch_state = None
+
+    def cache_prime_state(self):
+        '''
+        Cache the state if at the end of the header or all of the forced prime tokens.
+        '''
+        if len(self.sequence) in self.cache_lengths:
+            self.folk_rnn.prime_cache.put(self.sequence, self.state)
+
+    @property
+    def needs_sample(self):
+        '''
+        True if the next token is to be sampled, False if it is a (non-wildcard) prime token.
+        '''
+        position = len(self.sequence) - 1
+        return position >= len(self.prime) or self.prime[position] is None
+
+    def advance(self, logits=None):
+        '''
+        Choose the next token, given this generation's row of output layer activations.
+        The activations are only needed if the next token is to be sampled.
+        '''
+        if self.needs_sample:
+            p = self.folk_rnn.probabilities(logits, self.temperature)
+            token_idx = self.rng.choice(self.folk_rnn.vocab_size, p=p)
+        else:
+            token_idx = self.prime[len(self.sequence) - 1]
+
+        if token_idx == self.folk_rnn.end_idx:
+            self.finish()
+            return
+        self.sequence.append(token_idx)
+        if self.on_token:
+            self.on_token(self.folk_rnn.idx2token[token_idx])
+        if len(self.sequence) >= MAX_SEQUENCE_LENGTH:
+            self.finish()
+
+    def finish(self):
+        self.finished = True
+        if self.on_finish:
+            self.on_finish(self.tune_tokens)
+
+    def fail(self):
+        '''
+        Finish without a tune, as generation failed. Not if already finished, e.g. on_finish having failed.
+        '''
+        if self.finished:
+            return
+        self.finished = True
+        if self.on_finish:
+            try:
+                self.on_finish(None)
+            except Exception:
+                logger.exception('Generation on_finish failed')
+
+    @property
+    def tune_tokens(self):
+        return [self.folk_rnn.idx2token[x] for x in self.sequence[1:]]
+
+def step_generations(generations):
+    '''
+    Advance all the generations, which must share the same folk_rnn, by one token.
+    '''
+    folk_rnn = generations[0].folk_rnn
+    if folk_rnn.prime_cache:
+        for g in generations:
+            g.cache_prime_state()
+    token_idxs = np.array([g.sequence[-1] for g in generations])
+    batch_state = generations[0].batch_state
+    if batch_state is not None and all(g.batch_state is batch_state for g in generations):
+        # Stepped together last time, so the batch's state as is, or its rows still generating
+        rows = [g.batch_row for g in generations]
+        state = batch_state if rows == list(range(len(batch_state[0][0]))) else [(hid[rows], cell[rows]) for hid, cell in batch_state]
+    else:
+        state = [
+            (np.concatenate([g.state[jj][0] for g in generations]), np.concatenate([g.state[jj][1] for g in generations]))
+            for jj in range(folk_rnn.num_layers)
+            ]
+    state = folk_rnn.step(token_idxs, state)
+    # Only the rows about to sample need the output layer
+    sample_rows = [row for row, g in enumerate(generations) if g.needs_sample]
+    logits = dict(zip(sample_rows, folk_rnn.logits(state[-1][0][sample_rows]))) if sample_rows else {}
+    for row, g in enumerate(generations):
+        g.batch_state = state
+        g.batch_row = row
+        try:
+            g.advance(logits.get(row))
+        except GenerationCancelled:
+            g.finish()
+        except Exception:
+            logger.exception('Generation failed')
+            g.fail()
+
+def generate(generations):
+    '''
+    Run the generations, which must share the same folk_rnn, to completion as one batch.
+    Returns the generations' tune tokens.
+    '''
+    active = list(generations)
+    while active:
+        step_generations(active)
+        active = [g for g in active if not g.finished]
+    return [g.tune_tokens for g in generations]
+
+class GenerationScheduler:
+    '''
+    Continuous batching of generations.
+    Generations submitted for the same model are stepped together as one batch, i.e. for the same
+    instance of the model: those from before a model changed finish with the weights they started with.
+    New generations join the batch between steps, finished ones leave it.
+    Models with generations in progress take turns, a step at a time.
+    submit() blocks while max_batch_size generations are in progress, so a worker
+    doesn't take more from the channel layer than it can work on.
+    '''
+    def __init__(self, max_batch_size):
+        self.max_batch_size = max_batch_size
+        self.slots = threading.BoundedSemaphore(max_batch_size)
+        self.pending = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, rnn_model_name, generation):
+        self.slots.acquire()
+        self.pending.put((rnn_model_name, generation))
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='GenerationScheduler', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        batches = OrderedDict()
+        while True:
+            # Join any new generations, waiting for one if there is nothing else to do
+            try:
+                while True:
+                    rnn_model_name, generation = self.pending.get(block=not batches)
+                    batches.setdefault((rnn_model_name, generation.folk_rnn), []).append(generation)
+            except queue.Empty:
+                pass
+
+            for key in list(batches):
+                rnn_model_name, _ = key
+                batch = batches[key]
+                try:
+                    step_generations(batch)
+                except Exception:
+                    logger.exception(f'Step failed for {rnn_model_name}, dropping batch of {len(batch)}')
+                    for generation in batch:
+                        generation.fail()
+                still_active = [g for g in batch if not g.finished]
+                for _ in range(len(batch) - len(still_active)):
+                    self.slots.release()
+                if still_active:
+                    batches[key] = still_active
+                else:
+                    del batches[key]
@@ -0,0 +1,179 @@
+import json
+import resource
+from time import monotonic
+from types import SimpleNamespace
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from composer import FOLKRNN_PRIME_CACHE_BYTES
+from composer.rnn_models import models, load_job_spec, engine_for_model, BATCHED_ENGINES, token_for_info_field
+from composer.generation import BatchedFolkRNN, Generation, generate
+from composer.model_bundle import dequantized
+from composer.consumers import TuneABC
+from folk_rnn_site.abc_format import abc2abc
+
+# metric: True if higher is better
+COMPARED_METRICS = {
+    'cold_load_seconds': False,
+    'priming_seconds_p50': False,
+    'token_latency_seconds_p50': False,
+    'token_latency_seconds_p90': False,
+    'token_latency_seconds_p99': False,
+    'format_seconds_p50': False,
+    'tunes_per_second': True,
+    'peak_rss_bytes': False,
+}
+
+def percentiles(name, values):
+    if not values:
+        return {}
+    return {f'{name}_p{q}': float(np.percentile(values, q)) for q in (50, 90, 99)}
+
+class Command(BaseCommand):
+    """
+    Benchmark generation, offline. A Django management command.
+    i.e `python3.6 /folk_rnn_webapp/folk_rnn_site/manage.py bench_generate --output bench.json`
+
+    Runs a fixed matrix of models × seeds × temperatures × prime tokens, as per the
+    folk_rnn worker but without the channel layer, i.e. no redis, no websocket.
+    Each tune is generated, built into ABC token by token, and formatted.
+    With --batch-size, BatchedFolkRNN generates that many tunes at once, as per FOLKRNN_BATCH_SIZE,
+    to compare with one at a time, i.e. as per FOLKRNN_BATCH_SIZE = 0.
+    Reports as JSON, per model: cold load time, priming time, per-token latency
+    percentiles, formatting time and tunes/sec; overall tunes/sec and peak RSS.
+    With --compare, metrics worse than a previous run's by more than --threshold are
+    reported as regressions, and the command fails.
+    """
+    help = 'Benchmark generation over a fixed matrix of models, seeds, temperatures and prime tokens'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', help='Model file names, default all')
+        parser.add_argument('--seeds', default='1,42,123', help='Comma separated')
+        parser.add_argument('--temps', default='0.5,1.0,2.0', help='Comma separated')
+        parser.add_argument('--engine', choices=['batched', 'gemm', 'folk_rnn', 'configured'], default='batched', help="Composer's BatchedFolkRNN, as such with one matrix product per batch, folk_rnn's Folk_RNN, or per model as per FOLKRNN_ENGINES")
+        parser.add_argument('--batch-size', type=int, default=1, help="Tunes BatchedFolkRNN generates at once, default 1")
+        parser.add_argument('--output', help='Write the results to this JSON file, as well as stdout')
+        parser.add_argument('--compare', help='A previous run\'s JSON file, to compare with')
+        parser.add_argument('--threshold', type=float, default=0.1, help='Fraction worse than the previous run that is a regression, default 0.1')
+
+    def handle(self, *args, **options):
+        '''
+        Process the command (i.e. the django manage.py entrypoint)
+        '''
+        seeds = [int(x) for x in options['seeds'].split(',')]
+        temps = [float(x) for x in options['temps'].split(',')]
+        model_names = options['models'] or list(models())
+
+        results = {
+            'config': {'seeds': seeds, 'temps': temps, 'engine': options['engine'], 'batch_size': options['batch_size'], 'models': model_names},
+            'models': {},
+        }
+        total_tunes = 0
+        total_time = 0.0
+        for rnn_model_name in model_names:
+            engine_name = engine_for_model(rnn_model_name) if options['engine'] == 'configured' else options['engine']
+            model_result = self.bench_model(rnn_model_name, seeds, temps, engine_name, options['batch_size'])
+            total_tunes += model_result.pop('tunes')
+            total_time += model_result.pop('time')
+            results['models'][rnn_model_name] = model_result
+        results['tunes_per_second'] = total_tunes / total_time if total_time else 0.0
+        results['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # Linux reports KiB
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        self.stdout.write(output)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            regressions = self.compare(baseline, results, options['threshold'])
+            for regression in regressions:
+                self.stderr.write(f'Regression: {regression}')
+            if regressions:
+                raise CommandError(f'{len(regressions)} regressions beyond {options["threshold"]:.0%}')
+            self.stdout.write(f'No regressions beyond {options["threshold"]:.0%} of {options["compare"]}')
+
+    def bench_model(self, rnn_model_name, seeds, temps, engine_name, batch_size=1):
+        start = monotonic()
+        job_spec = load_job_spec(rnn_model_name)
+        if engine_name in BATCHED_ENGINES:
+            engine = BatchedFolkRNN.from_job_spec(job_spec, prime_cache_bytes=FOLKRNN_PRIME_CACHE_BYTES, gemm=engine_name == 'gemm')
+        else:
+            from folk_rnn import Folk_RNN
+            engine = Folk_RNN(job_spec['token2idx'], dequantized(job_spec['param_values']), job_spec['num_layers'], '*')
+        cold_load = monotonic() - start
+
+        model = models()[rnn_model_name]
+        header = ' '.join([
+                    token_for_info_field(f"M:{model['default_meter']}", rnn_model_name),
+                    token_for_info_field(f"K:{model['default_mode']}", rnn_model_name),
+                    ])
+        primes = ['', header]
+
+        matrix = [(prime_tokens, seed, temp) for prime_tokens in primes for seed in seeds for temp in temps]
+        if engine_name not in BATCHED_ENGINES:
+            batch_size = 1
+        priming_times = []
+        token_latencies = []
+        format_times = []
+        tunes = 0
+        start = monotonic()
+        for batch_start in range(0, len(matrix), batch_size):
+            batch = []
+            for prime_tokens, seed, temp in matrix[batch_start:batch_start + batch_size]:
+                tune_abc = TuneABC(SimpleNamespace(id=tunes + len(batch)))
+                token_times = []
+                def on_token(token, tune_abc=tune_abc, token_times=token_times):
+                    token_times.append(monotonic())
+                    tune_abc.add_token(token)
+                batch.append((prime_tokens, seed, temp, tune_abc, token_times, on_token))
+            batch_start_time = monotonic()
+            if engine_name in BATCHED_ENGINES:
+                generate([Generation(engine, prime_tokens=prime_tokens, seed=seed, temperature=temp, on_token=on_token) for prime_tokens, seed, temp, _, _, on_token in batch])
+            else:
+                prime_tokens, seed, temp, _, _, on_token = batch[0]
+                engine.seed_tune(prime_tokens if prime_tokens else None)
+                engine.generate_tune(random_number_generator_seed=seed, temperature=temp, on_token_callback=on_token)
+            for prime_tokens, seed, temp, tune_abc, token_times, _ in batch:
+                prime_count = len(prime_tokens.split())
+                if prime_count and len(token_times) >= prime_count:
+                    priming_times.append(token_times[prime_count - 1] - batch_start_time)
+                sampled_times = [batch_start_time] + token_times if not prime_count else token_times[prime_count - 1:]
+                token_latencies += list(np.diff(sampled_times))
+
+                format_start = monotonic()
+                abc2abc(tune_abc.abc, respace=True, bars_per_line=4, check_errors=False)
+                format_times.append(monotonic() - format_start)
+                tunes += 1
+        elapsed = monotonic() - start
+
+        result = {'engine': engine_name, 'cold_load_seconds': cold_load, 'tunes_per_second': tunes / elapsed if elapsed else 0.0}
+        result.update(percentiles('priming_seconds', priming_times))
+        result.update(percentiles('token_latency_seconds', token_latencies))
+        result.update(percentiles('format_seconds', format_times))
+        result['token_latency_seconds_mean'] = float(np.mean(token_latencies)) if token_latencies else None
+        result['tunes'] = tunes
+        result['time'] = elapsed
+        return result
+
+    @staticmethod
+    def compare(baseline, results, threshold):
+        '''
+        Return descriptions of the metrics worse in results than baseline by more than threshold.
+        '''
+        regressions = []
+        compared = [('overall', baseline, results)]
+        compared += [(x, baseline['models'][x], results['models'][x]) for x in results['models'] if x in baseline.get('models', {})]
+        for name, before_metrics, after_metrics in compared:
+            for metric, higher_is_better in COMPARED_METRICS.items():
+                before = before_metrics.get(metric)
+                after = after_metrics.get(metric)
+                if not before or after is None:
+                    continue
+                change = (after - before) / before
+                if (-change if higher_is_better else change) > threshold:
+                    regressions.append(f'{name} {metric} {before:.4g} → {after:.4g} ({change:+.0%})')
+        return regressions
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from composer.models_js import build_models_js
+
+class Command(BaseCommand):
+    """
+    Build the client's model data files. A Django management command.
+    i.e `python3.6 /folk_rnn_webapp/folk_rnn_site/manage.py build_models_js`
+    
+    Run before collectstatic, and whenever the models change.
+    """
+    help = 'Build the content-hashed folk_rnn_models.js and per-model vocabulary files'
+    
+    def handle(self, *args, **options):
+        '''
+        Process the command (i.e. the django manage.py entrypoint)
+        '''
+        written = build_models_js()
+        if written:
+            for filename in written:
+                self.stdout.write(f'Wrote {filename}')
+        else:
+            self.stdout.write('Up to date')
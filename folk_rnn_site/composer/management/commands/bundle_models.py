@@ -0,0 +1,52 @@
+import os
+import pickle
+
+from django.core.management.base import BaseCommand
+
+from composer import MODEL_PATH, BUNDLE_PATH
+from composer.model_bundle import bundle_paths, write_bundle, read_bundle_metadata, QUANTIZATIONS
+
+class Command(BaseCommand):
+    """
+    Convert the models in MODEL_PATH to bundles in BUNDLE_PATH. A Django management command.
+    i.e `python3.6 /folk_rnn_webapp/folk_rnn_site/manage.py bundle_models`
+    
+    A bundle is a JSON metadata file plus a flat weights file that workers memory-map,
+    so all workers on a host share one copy of each model's weights.
+    With --quantize, the weights matrices are stored at reduced precision, see model_bundle.py.
+    Whether a model's generation suffers for it can be checked with evaluate_quantization.
+    """
+    help = 'Build memory-mappable model bundles from the model pickle files'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', help='Model file names, default all in MODEL_PATH')
+        parser.add_argument('--force', action='store_true', help='Rebuild bundles that are up to date')
+        parser.add_argument('--quantize', choices=QUANTIZATIONS + ('none',), help="Store weights matrices at this precision, default as per the model's existing bundle")
+    
+    def handle(self, *args, **options):
+        '''
+        Process the command (i.e. the django manage.py entrypoint)
+        '''
+        for rnn_model_name in options['models'] or sorted(os.listdir(MODEL_PATH)):
+            model_path = os.path.join(MODEL_PATH, rnn_model_name)
+            metadata_path, weights_path = bundle_paths(BUNDLE_PATH, rnn_model_name)
+            try:
+                existing_quantization = read_bundle_metadata(metadata_path).get('quantization')
+            except (OSError, ValueError):
+                existing_quantization = None
+            quantization = existing_quantization if options['quantize'] is None else options['quantize']
+            quantization = None if quantization == 'none' else quantization
+            if (not options['force'] 
+                    and quantization == existing_quantization
+                    and os.path.exists(metadata_path) 
+                    and os.path.getmtime(metadata_path) >= os.path.getmtime(model_path)):
+                self.stdout.write(f'{rnn_model_name}: up to date')
+                continue
+            try:
+                with open(model_path, 'rb') as f:
+                    job_spec = pickle.load(f)
+                write_bundle(job_spec, metadata_path, weights_path, quantization=quantization)
+            except Exception as e:
+                self.stderr.write(f'{rnn_model_name}: failed, {e}')
+                continue
+            self.stdout.write(f'{rnn_model_name}: bundled{", " + quantization if quantization else ""}, {os.path.getsize(weights_path)} bytes of weights')
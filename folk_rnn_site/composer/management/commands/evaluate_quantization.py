@@ -0,0 +1,89 @@
+import os
+import json
+import pickle
+from time import monotonic
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from composer import MODEL_PATH
+from composer.rnn_models import models
+from composer.generation import BatchedFolkRNN, Generation, generate
+from composer.model_bundle import QUANTIZATIONS, quantize_job_spec
+
+def first_divergence(a, b):
+    '''
+    Return the index of the first token differing between the token sequences, or None if identical.
+    '''
+    for index, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return index
+    return None if len(a) == len(b) else min(len(a), len(b))
+
+class Command(BaseCommand):
+    """
+    Measure how quantized weights change generation, per model. A Django management command.
+    i.e `python3.6 /folk_rnn_webapp/folk_rnn_site/manage.py evaluate_quantization --seeds 200`
+
+    Each model generates a corpus of tunes, one per seed, at full precision and with its
+    weights quantized as per bundle_models --quantize. Reports the fraction of tunes whose
+    sampled tokens diverge, where they first diverge, the bytes of weights the batched engine
+    holds and its tokens/sec, to decide per model whether a quantized bundle is acceptable.
+    Quantized weights are dequantized a matrix at a time for each product, so the rates
+    measure that conversion against full precision. With the folk_rnn engine, weights are
+    dequantized as loaded, so it holds the full bytes and runs at the full rate whatever the quantization.
+    """
+    help = 'Compare generation with quantized weights to full precision, over a corpus of seeds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', help='Model file names, default all')
+        parser.add_argument('--quantize', choices=QUANTIZATIONS, nargs='+', default=list(QUANTIZATIONS))
+        parser.add_argument('--seeds', type=int, default=100, help='Tunes per model, seeded 0 to this')
+        parser.add_argument('--temp', type=float, default=1.0)
+        parser.add_argument('--output', help='Write the results to this JSON file, as well as stdout')
+
+    def handle(self, *args, **options):
+        '''
+        Process the command (i.e. the django manage.py entrypoint)
+        '''
+        seeds = range(options['seeds'])
+        results = {}
+        for rnn_model_name in options['models'] or list(models()):
+            # From the model file, as a bundle may already be quantized
+            with open(os.path.join(MODEL_PATH, rnn_model_name), 'rb') as f:
+                job_spec = pickle.load(f)
+            baseline, baseline_bytes, baseline_rate = self.generate_corpus(job_spec, seeds, options['temp'])
+            model_result = {'full': {
+                'weights_bytes': baseline_bytes,
+                'tokens_per_second': baseline_rate,
+                }}
+            for quantization in options['quantize']:
+                quantized_job_spec = quantize_job_spec(job_spec, quantization)
+                tunes, nbytes, rate = self.generate_corpus(quantized_job_spec, seeds, options['temp'])
+                divergences = [first_divergence(a, b) for a, b in zip(baseline, tunes)]
+                diverged = [x for x in divergences if x is not None]
+                model_result[quantization] = {
+                    'weights_bytes': nbytes,
+                    'tokens_per_second': rate,
+                    'diverged_fraction': len(diverged) / len(divergences),
+                    'first_divergence_median': float(np.median(diverged)) if diverged else None,
+                    'identical_token_fraction': sum(len(a) if d is None else d for a, d in zip(baseline, divergences)) / sum(len(a) for a in baseline),
+                    }
+            results[rnn_model_name] = model_result
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        self.stdout.write(output)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+
+    @staticmethod
+    def generate_corpus(job_spec, seeds, temperature):
+        '''
+        Return the tune tokens per seed, the bytes of weights held, as per load_engine, and the tokens generated per second.
+        '''
+        folk_rnn = BatchedFolkRNN.from_job_spec(job_spec)
+        start = monotonic()
+        tunes = generate([Generation(folk_rnn, seed=seed, temperature=temperature) for seed in seeds])
+        elapsed = monotonic() - start
+        return tunes, folk_rnn.nbytes, sum(len(x) for x in tunes) / elapsed if elapsed else 0.0
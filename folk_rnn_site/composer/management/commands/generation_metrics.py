@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from folk_rnn_site.metrics import METRICS, merged_snapshots, percentile
+
+class Command(BaseCommand):
+    """
+    Print generation metrics, as recorded by the server and worker processes. A Django management command.
+    i.e `python3.6 /folk_rnn_webapp/folk_rnn_site/manage.py generation_metrics`
+
+    Histograms are summarised by percentiles, estimated from their buckets.
+    Values are cumulative since each process started, see folk_rnn_site/metrics.py
+    """
+    help = 'Print percentiles of generation latencies, and counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--percentiles', default='50,90,99', help='Comma separated, e.g. 50,90,99')
+
+    def handle(self, *args, **options):
+        '''
+        Process the command (i.e. the django manage.py entrypoint)
+        '''
+        qs = [float(x) for x in options['percentiles'].split(',')]
+        merged = merged_snapshots()
+        for name, (metric_type, help_text, buckets) in METRICS.items():
+            series = merged.get(name)
+            if not series:
+                continue
+            self.stdout.write(f'{name} - {help_text}')
+            for key, value in sorted(series.items()):
+                if metric_type == 'counter':
+                    self.stdout.write(f'  {key or "all"}: {value}')
+                    continue
+                summary = ', '.join(f'p{q:g} {percentile(buckets, value, q / 100):.3f}' for q in qs)
+                mean = value[-2] / value[-1] if value[-1] else 0
+                self.stdout.write(f'  {key or "all"}: count {value[-1]}, mean {mean:.3f}, {summary}')
@@ -0,0 +1,60 @@
+import os
+import re
+
+from django.core.management.base import BaseCommand
+
+from composer import TUNE_PATH
+from composer.tune_store import tune_store
+
+tune_file_regex = re.compile(r'^(.+)_(\d+)_raw$')
+
+class Command(BaseCommand):
+    """
+    Pack the generated tune files in TUNE_PATH into the tune store. A Django management command.
+    i.e `python3.6 /folk_rnn_webapp/folk_rnn_site/manage.py pack_tunes --delete`
+
+    Tunes are packed in id order, and those already in the store are skipped, so it can be re-run.
+    With --delete, each tune's files are deleted once packed.
+    """
+    help = 'Pack the two files per generated tune in TUNE_PATH into the tune store'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete', action='store_true', help='Delete the files once packed')
+
+    def handle(self, *args, **options):
+        '''
+        Process the command (i.e. the django manage.py entrypoint)
+        '''
+        tunes = []
+        for filename in os.listdir(TUNE_PATH):
+            match = tune_file_regex.match(filename)
+            if match:
+                tunes.append((int(match.group(2)), match.group(1)))
+
+        counts = {'packed': 0, 'skipped': 0, 'unreadable': 0}
+        for tune_id, model_name in sorted(tunes):
+            raw_path = os.path.join(TUNE_PATH, f'{model_name}_{tune_id}_raw')
+            abc_path = os.path.join(TUNE_PATH, f'{model_name}_{tune_id}')
+            if tune_id in tune_store:
+                counts['skipped'] += 1
+            else:
+                try:
+                    with open(raw_path) as f:
+                        raw = f.read()
+                except OSError:
+                    counts['unreadable'] += 1
+                    continue
+                try:
+                    with open(abc_path) as f:
+                        abc = f.read()
+                except OSError:
+                    abc = '' # as per abc2abc failing in folk_rnn worker
+                tune_store.put(tune_id, model_name, raw, abc)
+                counts['packed'] += 1
+            if options['delete']:
+                for path in (raw_path, abc_path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+        self.stdout.write(f'Tunes: {counts}, segments: {len(tune_store.segments())}')
@@ -0,0 +1,39 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.core.management import call_command
+
+from composer.worker_routing import group_channels, group_models, preload_models
+from composer.rnn_models import model_cache
+from composer.consumers import generation_process_pool
+
+class Command(BaseCommand):
+    """
+    Run a folk_rnn worker for a worker group, as per FOLKRNN_WORKER_GROUPS. A Django management command.
+    i.e `python3.6 /folk_rnn_webapp/folk_rnn_site/manage.py runfolkrnnworker 1`
+
+    The worker listens on the channels of the group's models, and preloads only those models,
+    as per FOLKRNN_PRELOAD_MODELS, before it listens. So the first generations don't wait on loading.
+    A group not in FOLKRNN_WORKER_GROUPS, or none, listens on the shared folk_rnn channel.
+    """
+    help = "Run a folk_rnn worker on its worker group's channels"
+
+    def add_arguments(self, parser):
+        parser.add_argument('group', nargs='?', help='Worker group, e.g. the systemd instance')
+
+    def handle(self, *args, **options):
+        '''
+        Process the command (i.e. the django manage.py entrypoint)
+        '''
+        group = options['group']
+        # For the process pool, see GenerationProcessPool.start
+        os.environ['FOLKRNN_WORKER_GROUP'] = group or ''
+        channels = group_channels(group)
+        self.stdout.write(f"Worker group {group or 'none'}: channels {', '.join(channels)}; models {', '.join(group_models(group))}")
+        # With the pool, as it starts, i.e. loaded before its processes are forked, before runworker's threads
+        if generation_process_pool:
+            generation_process_pool.start()
+        else:
+            model_cache.preload(preload_models(group))
+        self.stdout.write(f"Preloaded {', '.join(model_cache.models) or 'no models'}")
+        call_command('runworker', *channels)
@@ -0,0 +1,103 @@
+import os
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+
+from composer import TUNE_PATH
+from composer.consumers import TuneABC
+from composer.tune_store import tune_store
+from folk_rnn_site.abc_format import format_abc, ABCFormatUnsupported
+from folk_rnn_site.abc2abc_pool import abc2abc_pool
+from archiver.models import Tune, Setting
+
+class Command(BaseCommand):
+    """
+    Verify the in-process ABC formatter against abc2abc. A Django management command.
+    i.e `python3.6 /folk_rnn_webapp/folk_rnn_site/manage.py verify_abc_format`
+
+    Generated tunes: the ABC is rebuilt from the raw folk-rnn output in the tune store, and TUNE_PATH
+    and formatted as per the folk_rnn worker, to compare with the stored abc2abc output.
+    With --archive, archive tunes and settings are checked for the same errors as abc2abc reports.
+    """
+    help = 'Compare in-process ABC formatting with abc2abc'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--archive', action='store_true', help='Also compare errors for archive tunes and settings, requires abc2abc')
+        parser.add_argument('--verbose', action='store_true', help='Show each mismatch')
+
+    def handle(self, *args, **options):
+        '''
+        Process the command (i.e. the django manage.py entrypoint)
+        '''
+        self.verbose = options['verbose']
+
+        counts = {'match': 0, 'mismatch': 0, 'unsupported': 0}
+        for name, tune_id, tune_tokens, stored in self.generated_tunes():
+            tune_abc = TuneABC(SimpleNamespace(id=tune_id))
+            for token in tune_tokens:
+                tune_abc.add_token(token)
+            try:
+                formatted = format_abc(tune_abc.abc, respace=True, bars_per_line=4, check_errors=False)
+            except ABCFormatUnsupported as e:
+                counts['unsupported'] += 1
+                self.report(name, f'unsupported, {e}')
+                continue
+            if formatted == stored:
+                counts['match'] += 1
+            else:
+                counts['mismatch'] += 1
+                self.report(name, self.first_difference(formatted, stored))
+        self.stdout.write(f'Generated tunes: {counts}')
+
+        if options['archive']:
+            counts = {'match': 0, 'mismatch': 0, 'unsupported': 0}
+            objs = list(Tune.objects.all()) + list(Setting.objects.all())
+            results = abc2abc_pool.format_many([x.abc for x in objs])
+            for obj, result in zip(objs, results):
+                try:
+                    formatted = format_abc(obj.abc)
+                except ABCFormatUnsupported as e:
+                    counts['unsupported'] += 1
+                    self.report(repr(obj), f'unsupported, {e}')
+                    continue
+                errors = [x for x in result.splitlines() if x.startswith(('%Warning : ', '%Error : '))]
+                formatted_errors = [x for x in formatted.splitlines() if x.startswith(('%Warning : ', '%Error : '))]
+                if errors == formatted_errors:
+                    counts['match'] += 1
+                else:
+                    counts['mismatch'] += 1
+                    self.report(repr(obj), f'errors {formatted_errors} not {errors}')
+            self.stdout.write(f'Archive: {counts}')
+            self.stdout.write(f'abc2abc: {abc2abc_pool.metrics()}')
+
+    @staticmethod
+    def generated_tunes():
+        '''
+        Return a generator of (name, tune id, raw tokens, stored ABC) of the generated tunes.
+        '''
+        for tune_id, model_name, raw, abc in tune_store.items():
+            if abc:
+                yield f'{model_name}_{tune_id}', tune_id, raw.split(), abc
+        for filename in sorted(os.listdir(TUNE_PATH)):
+            if not filename.endswith('_raw'):
+                continue
+            tune_id = filename[:-len('_raw')].rsplit('_', 1)[1]
+            try:
+                with open(os.path.join(TUNE_PATH, filename)) as f:
+                    tune_tokens = f.read().split()
+                with open(os.path.join(TUNE_PATH, filename[:-len('_raw')])) as f:
+                    stored = f.read()
+            except OSError:
+                continue
+            yield filename, tune_id, tune_tokens, stored
+
+    def report(self, name, message):
+        if self.verbose:
+            self.stdout.write(f'{name}: {message}')
+
+    @staticmethod
+    def first_difference(formatted, stored):
+        for line_number, (a, b) in enumerate(zip(formatted.splitlines(), stored.splitlines())):
+            if a != b:
+                return f'line {line_number + 1}, {a!r} not {b!r}'
+        return f'length {len(formatted)} not {len(stored)}'
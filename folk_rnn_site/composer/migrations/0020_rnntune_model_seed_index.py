@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('composer', '0019_rnntune_unitnotelength'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='rnntune',
+            index=models.Index(fields=['rnn_model_name', 'seed'], name='composer_rnntune_model_seed'),
+        ),
+    ]
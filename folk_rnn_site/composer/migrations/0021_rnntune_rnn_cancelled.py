@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('composer', '0020_rnntune_model_seed_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rnntune',
+            name='rnn_cancelled',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
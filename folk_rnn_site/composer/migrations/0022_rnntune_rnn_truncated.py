@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('composer', '0021_rnntune_rnn_cancelled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rnntune',
+            name='rnn_truncated',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('composer', '0022_rnntune_rnn_truncated'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PregeneratedTune',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rnn_model_name', models.CharField(default='', max_length=64)),
+                ('seed', models.IntegerField(default=42)),
+                ('temp', models.FloatField(default=1.0)),
+                ('unitnotelength', models.CharField(default='', max_length=7)),
+                ('meter', models.CharField(default='', max_length=7)),
+                ('key', models.CharField(default='', max_length=7)),
+                ('abc', models.TextField(default='')),
+                ('raw', models.TextField(default='')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,140 @@
+import os
+import json
+
+import numpy as np
+
+BUNDLE_METADATA_SUFFIX = '.json'
+BUNDLE_WEIGHTS_SUFFIX = '.weights'
+BUNDLE_ALIGNMENT = 64
+
+# Weights matrices can be stored as float16, or as int8 with a float32 scale per output unit
+QUANTIZATIONS = ('float16', 'int8')
+
+class QuantizedWeights:
+    '''
+    A weights matrix stored at reduced precision, i.e. in a bundle, dequantized to its original dtype
+    as used. numpy has no product of a float vector and an int8 or float16 matrix short of converting
+    the matrix, so BatchedFolkRNN converts a matrix for each product, holding only the quantized values,
+    e.g. memory-mapped and so shared between processes. Folk_RNN needs its weights dequantized as loaded,
+    so with that engine quantization saves disk space only.
+    Rows are inputs, columns output units, i.e. as per np.dot(x, weights).
+    '''
+    def __init__(self, values, dtype, scale=None):
+        self.values = values
+        self.dtype = np.dtype(dtype)
+        self.scale = scale
+        self.shape = values.shape
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    def __getitem__(self, rows):
+        values = self.values[rows].astype(self.dtype)
+        return values * self.scale if self.scale is not None else values
+
+    def dequantize(self):
+        return self[:]
+
+def quantize(param, quantization):
+    '''
+    Return the weights matrix param as QuantizedWeights.
+    '''
+    if quantization == 'float16':
+        return QuantizedWeights(param.astype(np.float16), param.dtype)
+    if quantization == 'int8':
+        scale = np.max(np.abs(param), axis=0) / 127
+        scale[scale == 0] = 1
+        values = np.clip(np.round(param / scale), -127, 127).astype(np.int8)
+        return QuantizedWeights(values, param.dtype, scale.astype(param.dtype))
+    raise ValueError(f'Unknown quantization {quantization}')
+
+def quantize_job_spec(job_spec, quantization):
+    '''
+    Return the job spec with its weights matrices quantized. Vectors, e.g. biases, are kept as is.
+    '''
+    job_spec = dict(job_spec)
+    job_spec['param_values'] = [quantize(np.asarray(x), quantization) if np.ndim(x) == 2 else x for x in job_spec['param_values']]
+    job_spec['quantization'] = quantization
+    return job_spec
+
+def dequantized(param_values):
+    '''
+    Return the param values as arrays, i.e. with any QuantizedWeights dequantized, as for Folk_RNN.
+    '''
+    return [x.dequantize() if isinstance(x, QuantizedWeights) else x for x in param_values]
+
+def bundle_paths(bundle_path, rnn_model_name):
+    '''
+    The metadata and weights file paths of the model's bundle.
+    '''
+    stem = os.path.join(bundle_path, rnn_model_name.replace('.pickle', ''))
+    return stem + BUNDLE_METADATA_SUFFIX, stem + BUNDLE_WEIGHTS_SUFFIX
+
+def write_bundle(job_spec, metadata_path, weights_path, quantization=None):
+    '''
+    Write the job spec as a model bundle: its param_values as one flat weights file, 
+    everything else plus the layout of the weights as a JSON metadata file.
+    With a quantization, the weights matrices are written at that reduced precision.
+    Written to temporary files and then moved, so a reader never sees a partial bundle.
+    '''
+    if quantization:
+        job_spec = quantize_job_spec(job_spec, quantization)
+    metadata = {k: v for k, v in job_spec.items() if k != 'param_values'}
+    metadata['quantization'] = quantization
+    metadata['params'] = []
+    offset = 0
+    with open(weights_path + '.tmp', 'wb') as f:
+        def write_array(array):
+            nonlocal offset
+            array = np.ascontiguousarray(array)
+            padding = -offset % BUNDLE_ALIGNMENT
+            f.write(b'\0' * padding)
+            offset += padding
+            layout = {
+                'dtype': array.dtype.str,
+                'shape': array.shape,
+                'offset': offset,
+                }
+            f.write(array.tobytes())
+            offset += array.nbytes
+            return layout
+        for param in job_spec['param_values']:
+            if isinstance(param, QuantizedWeights):
+                layout = write_array(param.values)
+                layout['compute_dtype'] = param.dtype.str
+                if param.scale is not None:
+                    layout['scale'] = write_array(param.scale)
+            else:
+                layout = write_array(param)
+            metadata['params'].append(layout)
+    with open(metadata_path + '.tmp', 'w') as f:
+        json.dump(metadata, f, default=lambda x: x.item())
+    os.replace(weights_path + '.tmp', weights_path)
+    os.replace(metadata_path + '.tmp', metadata_path)
+
+def read_bundle_metadata(metadata_path):
+    '''
+    Return the job spec of the model bundle, without param_values.
+    '''
+    with open(metadata_path) as f:
+        job_spec = json.load(f)
+    del job_spec['params']
+    return job_spec
+
+def read_bundle(metadata_path, weights_path):
+    '''
+    Return the job spec of the model bundle, with param_values as read-only views 
+    of the memory-mapped weights file. Processes mapping the same file share its pages.
+    Quantized weights matrices are QuantizedWeights of such views.
+    '''
+    with open(metadata_path) as f:
+        job_spec = json.load(f)
+    weights = np.memmap(weights_path, mode='r')
+    def view(layout):
+        return np.ndarray(shape=tuple(layout['shape']), dtype=np.dtype(layout['dtype']), buffer=weights, offset=layout['offset'])
+    job_spec['param_values'] = [
+        QuantizedWeights(view(x), x['compute_dtype'], view(x['scale']) if 'scale' in x else None) if 'compute_dtype' in x else view(x)
+        for x in job_spec.pop('params')
+        ]
+    return job_spec
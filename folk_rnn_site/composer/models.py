@@ -5,6 +5,12 @@ from django.urls import reverse
 from composer.rnn_models import token_for_info_field
 
 class RNNTune(ABCModel):
+    class Meta:
+        indexes = [
+            # Result cache lookup, see result_cache.py
+            models.Index(fields=['rnn_model_name', 'seed'], name='composer_rnntune_model_seed'),
+        ]
+    
     def __str__(self):
         return f'RNNTune {self.id}'
         
@@ -38,6 +44,8 @@ class RNNTune(ABCModel):
             'requested': self.requested.isoformat(),
             'rnn_started': self.rnn_started.isoformat() if self.rnn_started else None,
             'rnn_finished': self.rnn_finished.isoformat() if self.rnn_finished else None,
+            'rnn_cancelled': self.rnn_cancelled.isoformat() if self.rnn_cancelled else None,
+            'rnn_truncated': self.rnn_truncated,
             'abc': self.abc,
             'title': self.title,
             'id': self.id,
@@ -55,6 +63,22 @@ class RNNTune(ABCModel):
     requested = models.DateTimeField(auto_now_add=True)
     rnn_started = models.DateTimeField(null=True)
     rnn_finished = models.DateTimeField(null=True)
+    rnn_cancelled = models.DateTimeField(null=True) # Generation stopped or skipped, as no client was listening
+    rnn_truncated = models.BooleanField(default=False) # Generation stopped at the model's limits, see models()
     
 class Session(models.Model):
     started = models.DateTimeField(auto_now_add=True)
+
+class PregeneratedTune(models.Model):
+    '''
+    A tune generated ahead of being requested, for a model's default parameters. See pregeneration.py
+    '''
+    rnn_model_name = models.CharField(max_length=64, default='')
+    seed = models.IntegerField(default=42)
+    temp = models.FloatField(default=1.0)
+    unitnotelength = models.CharField(max_length=7, default='')
+    meter = models.CharField(max_length=7, default='')
+    key = models.CharField(max_length=7, default='')
+    abc = models.TextField(default='') # formatted, as per the folk_rnn worker
+    raw = models.TextField(default='') # folk-rnn output tokens
+    created = models.DateTimeField(auto_now_add=True)
@@ -0,0 +1,118 @@
+import os
+import re
+import threading
+import json
+import hashlib
+from collections import OrderedDict
+
+from django.conf import settings
+
+from composer import FOLKRNN_MAX_SEED, FOLKRNN_TUNE_TITLE_CLIENT
+from composer.rnn_models import models, model_registry
+
+STATIC_PATH = os.path.join(os.path.dirname(__file__), 'static')
+MANIFEST_PATH = os.path.join(STATIC_PATH, 'folk_rnn_models.manifest.json')
+built_file_regex = re.compile(r'^folk_rnn_(models|tokens_.+)\.[0-9a-f]{12}\.(js|json)$')
+
+def content_hash(content):
+    return hashlib.sha1(content.encode()).hexdigest()[:12]
+
+def replace_file(path, content):
+    '''
+    Write the file whole, i.e. a reader has the old file or the new.
+    Via a temporary file of this process and thread, as others may be writing it too.
+    '''
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def static_paths():
+    '''
+    composer's static folder, and STATIC_ROOT if there is one, i.e. as served without waiting on collectstatic.
+    '''
+    paths = [STATIC_PATH]
+    if settings.STATIC_ROOT and os.path.isdir(settings.STATIC_ROOT):
+        paths.append(settings.STATIC_ROOT)
+    return paths
+
+def write_static(filename, content):
+    '''
+    Write the file to the static folders, unless already there. 
+    Returns True if written to any.
+    '''
+    written = False
+    for static_path in static_paths():
+        path = os.path.join(static_path, filename)
+        if not os.path.exists(path):
+            replace_file(path, content)
+            written = True
+    return written
+
+def build_models_js():
+    '''
+    Build the client's model data as content-hashed static files, i.e. cacheable forever.
+    folk_rnn_models.<hash>.js - everything but the vocabularies, with the URL of each
+    folk_rnn_tokens_<model>.<hash>.json - a model's vocabulary, fetched by the client when that model is selected
+    Written to the static folders, see static_paths, as a rebuild on a model changing isn't followed by collectstatic.
+    Files are only written if their content has changed, and stale builds are removed.
+    The manifest is always written, naming the current folk_rnn_models.<hash>.js
+    Returns the list of files written.
+    '''
+    written = []
+    filenames = set()
+    client_models = OrderedDict()
+    for model_file_name, model in models().items():
+        tokens_json = json.dumps(sorted(model['tokens']))
+        tokens_filename = f"folk_rnn_tokens_{model_file_name.replace('.pickle', '')}.{content_hash(tokens_json)}.json"
+        if write_static(tokens_filename, tokens_json):
+            written.append(tokens_filename)
+        filenames.add(tokens_filename)
+        
+        client_model = {k: v for k, v in model.items() if k != 'tokens'}
+        client_model['tokens_url'] = settings.STATIC_URL + tokens_filename
+        client_models[model_file_name] = client_model
+    
+    js =  '// Auto-generated by composer package \n'
+    js += '// See models_js.py, rnn_models.py \n'
+    js += ' \n'
+    js += 'if (typeof folkrnn == "undefined") \n'
+    js += '    folkrnn = {}; \n'
+    js += ' \n'
+    js += f'folkrnn.tuneTitle = "{FOLKRNN_TUNE_TITLE_CLIENT}"; \n'
+    js += f'folkrnn.maxSeed = {FOLKRNN_MAX_SEED}; \n'
+    js += 'folkrnn.models = ' + json.dumps(client_models) + '; \n'
+    js_filename = f'folk_rnn_models.{content_hash(js)}.js'
+    if write_static(js_filename, js):
+        written.append(js_filename)
+    filenames.add(js_filename)
+    
+    # Even if the files are there, as the manifest may name another build, e.g. one since reverted
+    replace_file(MANIFEST_PATH, json.dumps({'folk_rnn_models.js': js_filename}))
+    
+    for static_path in static_paths():
+        for filename in os.listdir(static_path):
+            if built_file_regex.match(filename) and filename not in filenames:
+                try:
+                    os.remove(os.path.join(static_path, filename))
+                except FileNotFoundError:
+                    pass # i.e. removed by another process
+    
+    return written
+
+def models_js_filename():
+    '''
+    The file name of the current folk_rnn_models.<hash>.js, building it if there is none,
+    or the models have changed.
+    '''
+    model_registry.refresh()
+    try:
+        with open(MANIFEST_PATH) as f:
+            return json.load(f)['folk_rnn_models.js']
+    except (OSError, ValueError, KeyError):
+        build_models_js()
+        with open(MANIFEST_PATH) as f:
+            return json.load(f)['folk_rnn_models.js']
+
+# Rebuilt in the process that sees the change first, then as per the manifest in all
+model_registry.add_listener(lambda changed: build_models_js())
@@ -0,0 +1,75 @@
+'''
+Tunes generated ahead of being requested, while the folk_rnn workers are idle.
+Most compose requests are for a model's default parameters with a random seed,
+so a pool of these is kept per model. A compose request for the defaults that
+leaves the seed to chance is given the seed of a pooled tune, which is then
+already generated, exactly as it would have been. Pooled tunes of a model since
+changed are not given out, see model_since.
+'''
+from random import randint
+
+from composer import FOLKRNN_MAX_SEED, FOLKRNN_PREGENERATE_POOL_SIZE
+from composer.rnn_models import models, model_since, l_for_m_header
+from composer.models import RNNTune, PregeneratedTune
+
+DEFAULT_TEMP = 1.0
+
+def default_parameters(rnn_model_name):
+    '''
+    Return (meter, key) of the model's defaults, as per the compose UI.
+    '''
+    model = models()[rnn_model_name]
+    return f"M:{model['default_meter']}", f"K:{model['default_mode']}"
+
+def is_default(tune):
+    '''
+    True if the tune is requested with its model's default parameters, seed aside.
+    '''
+    meter, key = default_parameters(tune.rnn_model_name)
+    return (float(tune.temp) == DEFAULT_TEMP
+            and tune.meter == meter
+            and tune.key == key
+            and tune.start_abc == '')
+
+def pregeneration_tune(rnn_model_name):
+    '''
+    Return an unsaved RNNTune of the model's default parameters with a random seed, to pregenerate.
+    '''
+    meter, key = default_parameters(rnn_model_name)
+    seed = randint(0, FOLKRNN_MAX_SEED)
+    return RNNTune(
+                rnn_model_name=rnn_model_name,
+                seed=seed,
+                temp=DEFAULT_TEMP,
+                meter=meter,
+                key=key,
+                unitnotelength=l_for_m_header(meter, seed, rnn_model_name),
+                )
+
+def models_to_pregenerate():
+    '''
+    Return the models whose pools are short, shortest first.
+    '''
+    if not FOLKRNN_PREGENERATE_POOL_SIZE:
+        return []
+    counts = {x: PregeneratedTune.objects.filter(rnn_model_name=x, created__gte=model_since(x)).count() for x in models()}
+    return sorted((x for x in counts if counts[x] < FOLKRNN_PREGENERATE_POOL_SIZE), key=counts.get)
+
+def claim_pregenerated(tune):
+    '''
+    Return a pooled tune for the unsaved tune's model and parameters, removing it from the pool, or None.
+    '''
+    if not FOLKRNN_PREGENERATE_POOL_SIZE or not is_default(tune):
+        return None
+    candidates = PregeneratedTune.objects.filter(
+                        rnn_model_name=tune.rnn_model_name,
+                        created__gte=model_since(tune.rnn_model_name),
+                        temp=DEFAULT_TEMP,
+                        meter=tune.meter,
+                        key=tune.key,
+                        ).order_by('id')
+    for pregenerated in candidates[:4]:
+        # Only one claimant gets to delete it
+        if PregeneratedTune.objects.filter(id=pregenerated.id).delete()[0]:
+            return pregenerated
+    return None
@@ -0,0 +1,215 @@
+import os
+import threading
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from composer import FOLKRNN_STREAM_FLUSH_TOKENS
+from composer.rnn_models import model_cache, model_registry, models
+from composer.generation import BatchedFolkRNN, Generation, GenerationBudget, GenerationCancelled, generate
+from composer.worker_routing import preload_models
+
+logger = logging.getLogger(__name__)
+
+# Set in the parent before the pool's processes are forked
+relay_queue = None
+
+def generate_in_process(rnn_model_name, tunes, cancelled, budget):
+    '''
+    Generate tunes of the one model, in a pool process, as one batch if the engine batches.
+    tunes - (tune id, prime tokens, seed, temperature) of each
+    budget - (max tokens, max seconds) of each tune, as per GenerationBudget
+    Tokens are relayed to the parent as generated, then each tune's tokens as it finishes, None if it failed.
+    A tune over budget stops, here rather than as the parent catches up, and finishes as 'truncated'.
+    A tune stops early if in cancelled, checked every FOLKRNN_STREAM_FLUSH_TOKENS tokens.
+    '''
+    # Polled here too, as once forked the parent's invalidation isn't seen
+    model_registry.refresh()
+    engine = model_cache.get(rnn_model_name)
+    generations = [] # (tune id, Generation)
+    relayed = set() # tune ids finished
+    over_budget = set() # tune ids
+    for tune_id, prime_tokens, seed, temperature in tunes:
+        tokens = []
+        tune_budget = GenerationBudget(*budget)
+        def on_token(token, tune_id=tune_id, tokens=tokens, tune_budget=tune_budget):
+            if tune_budget.exceeded(len(tokens)):
+                over_budget.add(tune_id)
+                raise GenerationCancelled
+            tokens.append(token)
+            relay_queue.put((tune_id, 'token', token))
+            if len(tokens) % FOLKRNN_STREAM_FLUSH_TOKENS == 0 and tune_id in cancelled:
+                raise GenerationCancelled
+        def on_finish(tune_tokens, tune_id=tune_id):
+            relayed.add(tune_id)
+            relay_queue.put((tune_id, 'truncated' if tune_id in over_budget else 'finish', tune_tokens))
+        try:
+            if isinstance(engine, BatchedFolkRNN):
+                generations.append((tune_id, Generation(engine, prime_tokens=prime_tokens, seed=seed, temperature=temperature, on_token=on_token, on_finish=on_finish)))
+                continue
+            engine.seed_tune(prime_tokens if len(prime_tokens) > 0 else None)
+            tune_tokens = engine.generate_tune(random_number_generator_seed=seed, temperature=temperature, on_token_callback=on_token)
+        except GenerationCancelled:
+            tune_tokens = tokens
+        except Exception:
+            logger.exception(f'Generation failed for tune {tune_id}')
+            tune_tokens = None
+        on_finish(tune_tokens)
+    if generations:
+        generate([x for _, x in generations])
+        # e.g. on_finish failing, as a failed generation finishes with None
+        for tune_id, generation in generations:
+            if tune_id not in relayed:
+                relay_queue.put((tune_id, 'finish', None))
+
+def exit_worker():
+    '''
+    Exit this worker process, for systemd to restart it, see tools/systemd/worker-folkrnn@.service
+    '''
+    logging.shutdown()
+    os._exit(1)
+
+class GenerationProcessPool:
+    '''
+    Generation across CPU cores from one worker.
+    The worker's models are preloaded into the model cache, in this process, before the pool processes
+    are forked, as it starts, so every process shares the one copy of the weights. A model not preloaded is loaded
+    into the cache of the pool process generating it.
+    Tokens are relayed back through a queue, and the callbacks called here, on a relay thread.
+    An on_token callback raising GenerationCancelled stops the generation, as per Generation.
+    The model's budget is checked in the pool process too, and a tune stopped by it finishes with
+    on_finish(tune_tokens, over_budget=True), so its on_finish must take that.
+    A tune whose generation fails, or is lost with its process, finishes with on_finish(None).
+    A broken pool, i.e. a process having died, fails every tune with it and exits the worker, to be restarted
+    by systemd. Forking a new pool here would be with the worker's other threads running, see start().
+    Python 3.6's ProcessPoolExecutor can't take a forkserver context instead.
+    submit() blocks while every process is busy, so a worker doesn't take more
+    from the channel layer than it can work on. Tunes submitted together take one process,
+    and are generated as one batch.
+    '''
+    def __init__(self, processes=None):
+        self.processes = processes or os.cpu_count()
+        self.slots = threading.BoundedSemaphore(self.processes)
+        self.callbacks = {} # tune id: (on_token, on_finish, submission)
+        self.remaining = {} # submission: tunes not yet finished, the process slot released at 0
+        self.lock = threading.Lock()
+        self.executor = None
+        self.broken = False
+        self.cancelled = None # tune ids, shared with the pool processes
+
+    def start(self):
+        global relay_queue
+        # Only the models routed to this worker, see runfolkrnnworker
+        model_cache.preload(preload_models(os.environ.get('FOLKRNN_WORKER_GROUP') or None))
+        relay_queue = multiprocessing.Queue()
+        self.cancelled = multiprocessing.Manager().dict()
+        self.executor = ProcessPoolExecutor(max_workers=self.processes)
+        # Fork the processes now, rather than on the first submit, as a fork copies the locks other threads
+        # hold, e.g. the model cache's, metrics' and logging's, held forever in the child.
+        # So start before any other thread, see runfolkrnnworker
+        wait([self.executor.submit(os.getpid) for _ in range(self.processes)])
+        threading.Thread(target=self.relay, name='GenerationProcessPool', daemon=True).start()
+        logger.info(f'GenerationProcessPool: {self.processes} processes, {len(model_cache.models)} models preloaded')
+
+    def submit(self, tune, on_token, on_finish):
+        self.submit_batch([(tune, on_token, on_finish)])
+
+    def submit_batch(self, tunes):
+        '''
+        Generate the tunes, which must share the same model, in one process.
+        tunes - (tune, on_token, on_finish) of each
+        '''
+        with self.lock:
+            if self.executor is None:
+                self.start()
+        self.slots.acquire()
+        submission = tunes[0][0].id
+        tune_ids = [x.id for x, _, _ in tunes]
+        with self.lock:
+            self.remaining[submission] = len(tunes)
+            for tune, on_token, on_finish in tunes:
+                self.callbacks[tune.id] = (on_token, on_finish, submission)
+            executor = self.executor
+        try:
+            model = models()[tunes[0][0].rnn_model_name]
+            future = executor.submit(
+                            generate_in_process,
+                            tunes[0][0].rnn_model_name,
+                            [(x.id, x.prime_tokens, x.seed, x.temp) for x, _, _ in tunes],
+                            self.cancelled,
+                            (model['max_tokens'], model['max_seconds']),
+                            )
+        except Exception as e:
+            self.failed(tune_ids, executor, e)
+            return
+        future.add_done_callback(lambda f: self.done(tune_ids, executor, f))
+
+    def finished(self, tune_id):
+        '''
+        Forget the tune, releasing its process slot if the last of its submission.
+        Returns its callbacks, or None if already finished.
+        '''
+        with self.lock:
+            callbacks = self.callbacks.pop(tune_id, None)
+            if callbacks is None:
+                return None
+            self.cancelled.pop(tune_id, None)
+            submission = callbacks[2]
+            self.remaining[submission] -= 1
+            if self.remaining[submission] == 0:
+                del self.remaining[submission]
+                self.slots.release()
+        return callbacks
+
+    def done(self, tune_ids, executor, future):
+        # Success finishes via the relay, so the finish follows the last token
+        if future.exception():
+            self.failed(tune_ids, executor, future.exception())
+
+    def failed(self, tune_ids, executor, exception):
+        '''
+        Finish the tunes not yet finished with on_finish(None).
+        If the executor is broken, so are all its submissions: all finish, and the worker exits.
+        '''
+        logger.error(f'GenerationProcessPool: generation failed for tunes {tune_ids}', exc_info=exception)
+        broken = isinstance(exception, BrokenProcessPool)
+        if broken:
+            with self.lock:
+                # Once, as each of the executor's submissions fails
+                broken = not self.broken and self.executor is executor
+                if broken:
+                    self.broken = True
+                    tune_ids = list(self.callbacks)
+        for tune_id in tune_ids:
+            callbacks = self.finished(tune_id)
+            if callbacks is None:
+                continue
+            try:
+                callbacks[1](None)
+            except Exception:
+                logger.exception(f'GenerationProcessPool: callback failed for tune {tune_id}')
+        if broken:
+            logger.critical('GenerationProcessPool: pool broken, exiting for the worker to be restarted')
+            exit_worker()
+
+    def relay(self):
+        while True:
+            tune_id, kind, value = relay_queue.get()
+            callbacks = self.callbacks.get(tune_id)
+            if not callbacks:
+                continue
+            on_token, on_finish, _ = callbacks
+            try:
+                if kind == 'token':
+                    on_token(value)
+                elif not self.finished(tune_id):
+                    pass
+                elif kind == 'truncated':
+                    on_finish(value, over_budget=True)
+                else:
+                    on_finish(value)
+            except GenerationCancelled:
+                self.cancelled[tune_id] = True
+            except Exception:
+                logger.exception(f'GenerationProcessPool: callback failed for tune {tune_id}')
@@ -0,0 +1,148 @@
+import threading
+from time import monotonic, time
+
+from composer import FOLKRNN_PROGRESS_TTL, FOLKRNN_CANCEL_GRACE
+
+PROGRESS_KEY_PREFIX = 'folk_rnn:progress:'
+LISTENERS_KEY_PREFIX = 'folk_rnn:listeners:'
+ABANDONED_KEY_PREFIX = 'folk_rnn:abandoned:'
+
+class LocalProgressStore:
+    '''
+    Stand-in for the channel layer's redis, for channel layers without one,
+    e.g. InMemoryChannelLayer, where everything runs in the one process anyway.
+    '''
+    def __init__(self, ttl=FOLKRNN_PROGRESS_TTL):
+        self.ttl = ttl
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def expire(self):
+        now = monotonic()
+        for key in [k for k, v in self.values.items() if v[1] < now]:
+            del self.values[key]
+
+    def get(self, key, default=None):
+        with self.lock:
+            self.expire()
+            return self.values.get(key, (default, None))[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = (value, monotonic() + self.ttl)
+
+    def append(self, key, value):
+        with self.lock:
+            self.expire()
+            self.values[key] = (self.values.get(key, ('', None))[0] + value, monotonic() + self.ttl)
+
+    def touch(self, key):
+        with self.lock:
+            self.expire()
+            if key in self.values:
+                self.values[key] = (self.values[key][0], monotonic() + self.ttl)
+
+    def incr(self, key, amount):
+        with self.lock:
+            self.expire()
+            value = self.values.get(key, (0, None))[0] + amount
+            self.values[key] = (value, monotonic() + self.ttl)
+            return value
+
+    def delete(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+local_progress_store = LocalProgressStore()
+
+async def append_progress(channel_layer, tune_id, abc):
+    '''
+    Append to the tune's ABC generated so far.
+    Held in the channel layer's redis, expiring FOLKRNN_PROGRESS_TTL seconds after the last append.
+    The tune's listener count is kept as long, so it doesn't expire while generating.
+    '''
+    if hasattr(channel_layer, 'connection'):
+        async with channel_layer.connection(0) as connection:
+            transaction = connection.multi_exec()
+            transaction.append(PROGRESS_KEY_PREFIX + str(tune_id), abc.encode())
+            transaction.expire(PROGRESS_KEY_PREFIX + str(tune_id), FOLKRNN_PROGRESS_TTL)
+            transaction.expire(LISTENERS_KEY_PREFIX + str(tune_id), FOLKRNN_PROGRESS_TTL)
+            await transaction.execute()
+    else:
+        local_progress_store.append(PROGRESS_KEY_PREFIX + str(tune_id), abc)
+        local_progress_store.touch(LISTENERS_KEY_PREFIX + str(tune_id))
+
+async def get_progress(channel_layer, tune_id, offset=0):
+    '''
+    Return the tune's ABC generated so far, from offset.
+    Empty if none generated, or generated too long ago.
+    '''
+    if hasattr(channel_layer, 'connection'):
+        async with channel_layer.connection(0) as connection:
+            progress = await connection.get(PROGRESS_KEY_PREFIX + str(tune_id))
+        progress = progress.decode() if progress else ''
+    else:
+        progress = local_progress_store.get(PROGRESS_KEY_PREFIX + str(tune_id), '')
+    return progress[offset:]
+
+async def clear_progress(channel_layer, tune_id):
+    '''
+    Forget the tune's ABC generated so far, e.g. as generation was cancelled.
+    '''
+    if hasattr(channel_layer, 'connection'):
+        async with channel_layer.connection(0) as connection:
+            await connection.delete(PROGRESS_KEY_PREFIX + str(tune_id))
+    else:
+        local_progress_store.delete(PROGRESS_KEY_PREFIX + str(tune_id))
+
+async def add_listener(channel_layer, tune_id):
+    '''
+    Count a websocket registered for the tune, across server processes.
+    A tune with a listener is no longer abandoned.
+    '''
+    if hasattr(channel_layer, 'connection'):
+        async with channel_layer.connection(0) as connection:
+            transaction = connection.multi_exec()
+            transaction.incr(LISTENERS_KEY_PREFIX + str(tune_id))
+            transaction.expire(LISTENERS_KEY_PREFIX + str(tune_id), FOLKRNN_PROGRESS_TTL)
+            transaction.delete(ABANDONED_KEY_PREFIX + str(tune_id))
+            await transaction.execute()
+    else:
+        local_progress_store.incr(LISTENERS_KEY_PREFIX + str(tune_id), 1)
+        local_progress_store.delete(ABANDONED_KEY_PREFIX + str(tune_id))
+
+async def remove_listener(channel_layer, tune_id):
+    '''
+    Count a websocket unregistered from the tune.
+    With the last gone, the tune is marked abandoned, as of now.
+    Below zero, the count had expired, so the listeners are unknown: the count is cleared, not marked abandoned.
+    '''
+    if hasattr(channel_layer, 'connection'):
+        async with channel_layer.connection(0) as connection:
+            listeners = await connection.decr(LISTENERS_KEY_PREFIX + str(tune_id))
+            if listeners < 0:
+                await connection.delete(LISTENERS_KEY_PREFIX + str(tune_id))
+            elif listeners == 0:
+                transaction = connection.multi_exec()
+                transaction.delete(LISTENERS_KEY_PREFIX + str(tune_id))
+                transaction.set(ABANDONED_KEY_PREFIX + str(tune_id), str(time()), expire=FOLKRNN_PROGRESS_TTL)
+                await transaction.execute()
+    else:
+        listeners = local_progress_store.incr(LISTENERS_KEY_PREFIX + str(tune_id), -1)
+        if listeners <= 0:
+            local_progress_store.delete(LISTENERS_KEY_PREFIX + str(tune_id))
+        if listeners == 0:
+            local_progress_store.set(ABANDONED_KEY_PREFIX + str(tune_id), str(time()))
+
+async def is_abandoned(channel_layer, tune_id, grace=FOLKRNN_CANCEL_GRACE):
+    '''
+    True if the tune's last listener went more than grace seconds ago,
+    i.e. allowing a client time to reconnect.
+    '''
+    if hasattr(channel_layer, 'connection'):
+        async with channel_layer.connection(0) as connection:
+            abandoned = await connection.get(ABANDONED_KEY_PREFIX + str(tune_id))
+        abandoned = abandoned.decode() if abandoned else None
+    else:
+        abandoned = local_progress_store.get(ABANDONED_KEY_PREFIX + str(tune_id))
+    return abandoned is not None and float(abandoned) < time() - grace
@@ -0,0 +1,83 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from composer import FOLKRNN_RESULT_CACHE_COUNT
+from composer.models import RNNTune
+from composer.rnn_models import model_registry, model_since
+
+logger = logging.getLogger(__name__)
+
+def result_key(rnn_model_name, seed, temp, prime_tokens):
+    '''
+    The parameters that fully determine a folk-rnn generation, with the model's version, i.e. its hash and quantization.
+    '''
+    return (rnn_model_name, model_registry.version(rnn_model_name), int(seed), float(temp), prime_tokens)
+
+class ResultCache:
+    '''
+    Generation is deterministic for a given model, seed, temperature and prime tokens,
+    so a finished tune's ABC stands for any tune requested with the same parameters.
+    Recent results are held in memory, least recently used evicted first.
+    Otherwise, finished RNNTunes are looked up in the database.
+    Results are of the model's current version, see result_key and model_since. Those of a model
+    changed are dropped, see invalidate.
+    Thread-safe, as lookups run in database threads.
+    '''
+    def __init__(self, maxsize=FOLKRNN_RESULT_CACHE_COUNT):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def put(self, key, abc, tune_id):
+        with self.lock:
+            self.results[key] = (abc, tune_id)
+            self.results.move_to_end(key)
+            while len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+
+    def invalidate(self, rnn_model_names):
+        '''
+        Drop the results of the models, e.g. as changed. A ModelRegistry listener.
+        '''
+        with self.lock:
+            for key in [x for x in self.results if x[0] in rnn_model_names]:
+                del self.results[key]
+
+    def get(self, tune):
+        '''
+        Return (abc, tune_id) of a finished tune generated as per the given tune's parameters, or None.
+        '''
+        key = result_key(tune.rnn_model_name, tune.seed, tune.temp, tune.prime_tokens)
+        with self.lock:
+            result = self.results.get(key)
+            if result:
+                self.results.move_to_end(key)
+        since = model_since(tune.rnn_model_name)
+        if not result and since:
+            # The model, seed index narrows this to a handful of rows
+            cached_tune = RNNTune.objects.filter(
+                                rnn_model_name=tune.rnn_model_name,
+                                seed=tune.seed,
+                                temp=float(tune.temp),
+                                unitnotelength=tune.unitnotelength,
+                                meter=tune.meter,
+                                key=tune.key,
+                                start_abc=tune.start_abc,
+                                rnn_finished__isnull=False,
+                                rnn_truncated=False, # i.e. as truncated on time, may not be reproduced
+                                rnn_started__gte=since,
+                                ).exclude(id=tune.id).exclude(abc='').order_by('id').first()
+            if cached_tune:
+                result = (cached_tune.abc, cached_tune.id)
+                self.put(key, *result)
+
+        with self.lock:
+            if result:
+                self.hits += 1
+            else:
+                self.misses += 1
+        logger.info(f'Result cache {"hit" if result else "miss"} for tune {tune.id}. Hits: {self.hits}, misses: {self.misses}')
+        return result
@@ -1,14 +1,21 @@
 import os
 import pickle
-import functools
+import threading
+import hashlib
 import json
 import logging
 import re
 import random
+from time import monotonic
 from collections import OrderedDict
+from datetime import datetime, timezone
 
-from composer import MODEL_PATH, FOLKRNN_INSTANCE_CACHE_COUNT
+from composer import MODEL_PATH, MODEL_INDEX_PATH, BUNDLE_PATH, FOLKRNN_MODEL_CACHE_BYTES, FOLKRNN_PRIME_CACHE_BYTES
+from composer import FOLKRNN_MODEL_POLL_INTERVAL, FOLKRNN_MAX_TOKENS, FOLKRNN_MAX_SECONDS, FOLKRNN_BATCH_SIZE, FOLKRNN_ENGINES
 from folk_rnn import Folk_RNN
+from composer.generation import BatchedFolkRNN
+from composer.model_bundle import bundle_paths, read_bundle, read_bundle_metadata, dequantized
+from folk_rnn_site.metrics import metrics, process_label
 
 logger = logging.getLogger(__name__)
 
@@ -17,19 +24,318 @@ header_m_regex = re.compile(r"M:(\d+)/(\d+)")
 header_k_regex = re.compile(r"K:[A-G][b#]?[A-Za-z]{3}")
 header_m_sort = lambda x: int(header_m_regex.search(x).group(2)*100) + int(header_m_regex.search(x).group(1))
 
-@functools.lru_cache(maxsize=FOLKRNN_INSTANCE_CACHE_COUNT)
-def folk_rnn_cached(rnn_model_name):
+def load_job_spec(rnn_model_name):
+    '''
+    The model's job spec, from its bundle if up to date, i.e. with memory-mapped weights.
+    Otherwise unpickled from the model file.
+    '''
+    metrics.inc('folkrnn_model_loads_total', model=rnn_model_name.replace('.pickle', ''), worker=process_label())
     model_path = os.path.join(MODEL_PATH, rnn_model_name)
+    metadata_path, weights_path = bundle_paths(BUNDLE_PATH, rnn_model_name)
+    try:
+        if os.path.getmtime(metadata_path) >= os.path.getmtime(model_path):
+            return read_bundle(metadata_path, weights_path)
+    except OSError:
+        pass
     with open(model_path, "rb") as f:
-        job_spec = pickle.load(f)
-    return Folk_RNN(
-        job_spec['token2idx'],
-        job_spec['param_values'], 
-        job_spec['num_layers'],
-        '*' 
-        )
-
-@functools.lru_cache(maxsize=1)
+        return pickle.load(f)
+
+# The engines generating with BatchedFolkRNN, i.e. tunes stepped together
+BATCHED_ENGINES = ('batched', 'gemm')
+
+def engine_for_model(rnn_model_name):
+    '''
+    The engine the model's tunes are generated with, 'batched', 'gemm' or 'folk_rnn'. See FOLKRNN_ENGINES
+    '''
+    return FOLKRNN_ENGINES.get(rnn_model_name, 'batched' if FOLKRNN_BATCH_SIZE else 'folk_rnn')
+
+def load_engine(rnn_model_name):
+    '''
+    The model with its engine as per engine_for_model, and the bytes of its weights as the engine holds them.
+    '''
+    job_spec = load_job_spec(rnn_model_name)
+    engine_name = engine_for_model(rnn_model_name)
+    if engine_name in BATCHED_ENGINES:
+        engine = BatchedFolkRNN.from_job_spec(job_spec, prime_cache_bytes=FOLKRNN_PRIME_CACHE_BYTES, gemm=engine_name == 'gemm')
+        return engine, engine.nbytes
+    # Folk_RNN holds quantized weights at their original dtype
+    param_values = dequantized(job_spec['param_values'])
+    engine = Folk_RNN(job_spec['token2idx'], param_values, job_spec['num_layers'], '*')
+    return engine, sum(x.nbytes for x in param_values)
+
+class ModelCache:
+    '''
+    The models loaded in this process, by model name, as per load(). 
+    Bounded by the total bytes of the models' weights, least recently used evicted first.
+    The model just loaded is always held, even if alone beyond the budget.
+    Hits, misses, load durations and evictions are recorded as metrics.
+    '''
+    def __init__(self, max_bytes=FOLKRNN_MODEL_CACHE_BYTES, load=load_engine):
+        self.max_bytes = max_bytes
+        self.load = load
+        self.models = OrderedDict() # model name: (model, bytes)
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, rnn_model_name):
+        # Held while loading, so a model is loaded once however many ask for it
+        with self.lock:
+            if rnn_model_name in self.models:
+                self.models.move_to_end(rnn_model_name)
+                metrics.inc('folkrnn_model_cache_total', model=rnn_model_name.replace('.pickle', ''), outcome='hit')
+                return self.models[rnn_model_name][0]
+            model, nbytes = self.timed_load(rnn_model_name)
+            self.models[rnn_model_name] = (model, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes and len(self.models) > 1:
+                evicted_name, (_, evicted_nbytes) = self.models.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                metrics.inc('folkrnn_model_cache_total', model=evicted_name.replace('.pickle', ''), outcome='eviction')
+                logger.info(f'ModelCache: evicted {evicted_name} for {rnn_model_name}')
+            return model
+
+    def timed_load(self, rnn_model_name):
+        model_label = rnn_model_name.replace('.pickle', '')
+        metrics.inc('folkrnn_model_cache_total', model=model_label, outcome='miss')
+        start = monotonic()
+        model, nbytes = self.load(rnn_model_name)
+        metrics.observe('folkrnn_model_load_seconds', monotonic() - start, model=model_label)
+        return model, nbytes
+
+    def preload(self, rnn_model_names):
+        '''
+        Load the models in turn, i.e. in order of priority. A model that doesn't fit the budget
+        alongside those before it is not held, rather than evict them.
+        '''
+        for rnn_model_name in rnn_model_names:
+            try:
+                with self.lock:
+                    if rnn_model_name in self.models:
+                        continue
+                    model, nbytes = self.timed_load(rnn_model_name)
+                    if self.models and self.nbytes + nbytes > self.max_bytes:
+                        logger.warning(f'ModelCache: {rnn_model_name} beyond the budget of {self.max_bytes} bytes, not preloaded')
+                        continue
+                    self.models[rnn_model_name] = (model, nbytes)
+                    self.nbytes += nbytes
+            except Exception:
+                logger.exception(f'ModelCache: could not preload {rnn_model_name}')
+
+    def invalidate(self, rnn_model_names):
+        '''
+        Forget the models, i.e. changed, so loaded afresh when next asked for.
+        '''
+        with self.lock:
+            for rnn_model_name in rnn_model_names:
+                if rnn_model_name in self.models:
+                    _, nbytes = self.models.pop(rnn_model_name)
+                    self.nbytes -= nbytes
+                    metrics.inc('folkrnn_model_cache_total', model=rnn_model_name.replace('.pickle', ''), outcome='invalidation')
+                    logger.info(f'ModelCache: invalidated {rnn_model_name}')
+
+    def __contains__(self, rnn_model_name):
+        return rnn_model_name in self.models
+
+# One per process, i.e. per worker, and copy-on-write into the process pool's processes
+model_cache = ModelCache()
+
+def model_metadata(job_spec):
+    '''
+    The model's metadata as used by composer, i.e. everything but the weights. See models()
+    '''
+    model = {}
+    model['tokens'] = set(job_spec['token2idx'].keys())
+    model['tokens'].add('*')
+    model['display_name'] = job_spec['name']
+    model['display_order'] = job_spec['order']
+    model['default_meter'] = job_spec['default_meter']
+    model['default_mode'] = job_spec['default_mode']
+    model['default_tempo'] = job_spec['default_tempo']
+    model['max_tokens'] = job_spec.get('max_tokens')
+    model['max_seconds'] = job_spec.get('max_seconds')
+    
+    try:
+        l_tokens = job_spec['header_l_tokens']
+    except KeyError:
+        l_tokens = [x for x in model['tokens'] if header_l_regex.search(x)]
+    l_tokens = [header_l_regex.search(x).group(0) for x in l_tokens]
+    model['header_l_tokens'] = sorted(l_tokens) + ['*'] if len(l_tokens) else []
+    
+    try:
+        m_tokens = job_spec['header_m_tokens']
+    except KeyError:
+        m_tokens = [x for x in model['tokens'] if header_m_regex.search(x)]
+    m_tokens = [header_m_regex.search(x).group(0) for x in m_tokens]
+    model['header_m_tokens'] = sorted(m_tokens, key=header_m_sort) + ['*']
+    
+    try:
+        k_tokens = job_spec['header_k_tokens']
+    except KeyError:
+        k_tokens = [x for x in model['tokens'] if header_k_regex.search(x)]
+    k_tokens = [header_k_regex.search(x).group(0) for x in k_tokens]
+    model['header_k_tokens'] = sorted(k_tokens) + ['*']
+    
+    try:
+        model['l_freqs'] = {
+            header_m_regex.search(k).group(0): {
+                header_l_regex.search(l).group(0): freq for l, freq in v.items()
+                } for k, v in job_spec['l_freqs'].items()
+            }
+    except KeyError:
+        pass
+    
+    return model
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def model_index():
+    '''
+    The metadata of every model in MODEL_PATH, as persisted in MODEL_INDEX_PATH.
+    Returns dict of model file name to index entry, with keys
+    'mtime', 'size', 'sha1' - of the model file when its entry was made
+    'bundle_mtime' - of its bundle's metadata file, or None without a bundle
+    'quantization' - of its bundle's weights if the bundle is up to date, i.e. as loaded, see load_job_spec
+    'version_time' - the mtime of the file its weights load from when its sha1 and quantization were first indexed,
+        kept as its files are touched or re-provisioned unchanged
+    'model' - its metadata, as per model_metadata() but with tokens as a sorted list
+    A model's entry is remade only if its file or bundle has changed, i.e. their mtimes or size 
+    differ and then so does its hash. Remaking it reads the bundle metadata if up to 
+    date, only otherwise unpickling the model file, weights and all.
+    '''
+    try:
+        with open(MODEL_INDEX_PATH) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    
+    entries = {}
+    changed = False
+    for filename in os.listdir(MODEL_PATH):
+        model_path = os.path.join(MODEL_PATH, filename)
+        try:
+            stat = os.stat(model_path)
+            metadata_path, _ = bundle_paths(BUNDLE_PATH, filename)
+            bundle_mtime = os.path.getmtime(metadata_path) if os.path.exists(metadata_path) else None
+            entry = index.get(filename)
+            if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size and entry.get('bundle_mtime') == bundle_mtime:
+                entries[filename] = entry
+                continue
+            sha1 = file_hash(model_path)
+            bundle_job_spec = read_bundle_metadata(metadata_path) if bundle_mtime is not None and bundle_mtime >= stat.st_mtime else None
+            quantization = bundle_job_spec.get('quantization') if bundle_job_spec else None
+            # i.e. its bundle's, if up to date
+            version_time = max(stat.st_mtime, bundle_mtime or 0) if bundle_job_spec else stat.st_mtime
+            if entry and entry['sha1'] == sha1:
+                if entry.get('quantization') == quantization:
+                    version_time = entry.get('version_time', version_time)
+                entry.update(mtime=stat.st_mtime, size=stat.st_size, bundle_mtime=bundle_mtime, quantization=quantization, version_time=version_time)
+            else:
+                if bundle_job_spec:
+                    job_spec = bundle_job_spec
+                else:
+                    with open(model_path, "rb") as f:
+                        job_spec = pickle.load(f)
+                model = model_metadata(job_spec)
+                model['tokens'] = sorted(model['tokens'])
+                entry = {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': sha1, 'bundle_mtime': bundle_mtime, 'quantization': quantization, 'version_time': version_time, 'model': model}
+            entries[filename] = entry
+            changed = True
+        except:
+            logger.warning(f'Error parsing {filename}')
+    
+    if changed or entries.keys() != index.keys():
+        # Of this process and thread, as others may be writing it too
+        tmp_path = f'{MODEL_INDEX_PATH}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, MODEL_INDEX_PATH)
+        except OSError:
+            logger.warning(f'Could not write model index {MODEL_INDEX_PATH}')
+    return entries
+
+class ModelRegistry:
+    '''
+    The models in MODEL_PATH, as per models(), kept up to date without restarting.
+    MODEL_PATH and BUNDLE_PATH are polled as models() is called, at most every FOLKRNN_MODEL_POLL_INTERVAL 
+    seconds, comparing the names, mtimes and sizes of their files. On a change, the model index is remade
+    and the models swapped in whole, so a reader has either the old models or the new.
+    A model has changed if its hash or the quantization it loads with has, see version().
+    The listeners are then called with the names of the models added, changed or removed, 
+    to invalidate what was made from them, e.g. the model cache.
+    '''
+    def __init__(self, interval=FOLKRNN_MODEL_POLL_INTERVAL):
+        self.interval = interval
+        self.models = None
+        self.versions = {} # model name: (sha1, quantization)
+        self.since = {} # model name: version_time of its index entry, i.e. generations before are stale
+        self.signature = None
+        self.polled = None
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def get(self):
+        self.refresh()
+        return self.models
+
+    def refresh(self, force=False):
+        '''
+        Poll MODEL_PATH if due, swapping in the models if changed.
+        Returns the names of the models changed.
+        '''
+        with self.lock:
+            if not force and self.polled is not None and monotonic() - self.polled < self.interval:
+                return []
+            self.polled = monotonic()
+            signature = [sorted((x.name, x.stat().st_mtime, x.stat().st_size) for x in os.scandir(path)) for path in (MODEL_PATH, BUNDLE_PATH)]
+            if signature == self.signature:
+                return []
+            index = model_index()
+            models = {}
+            for filename, entry in index.items():
+                model = dict(entry['model'])
+                model['tokens'] = set(model['tokens'])
+                model['max_tokens'] = model.get('max_tokens') or FOLKRNN_MAX_TOKENS
+                model['max_seconds'] = model.get('max_seconds') or FOLKRNN_MAX_SECONDS
+                models[filename] = model
+            versions = {k: (v['sha1'], v.get('quantization')) for k, v in index.items()}
+            changed = sorted(x for x in versions.keys() | self.versions.keys() if versions.get(x) != self.versions.get(x))
+            first = self.models is None
+            self.models = OrderedDict(sorted(models.items(), key=lambda x: x[1]['display_order']))
+            self.versions = versions
+            self.since = {k: v.get('version_time', v['mtime']) for k, v in index.items()}
+            self.signature = signature
+        if first or not changed:
+            return []
+        logger.info(f'ModelRegistry: models changed {changed}')
+        for listener in self.listeners:
+            try:
+                listener(changed)
+            except Exception:
+                logger.exception(f'ModelRegistry: listener failed for {changed}')
+        return changed
+
+    def version(self, rnn_model_name):
+        '''
+        The model's (sha1, quantization), i.e. what its generations depend on beyond their parameters.
+        None if there is no such model.
+        '''
+        self.refresh()
+        return self.versions.get(rnn_model_name)
+
+# One per process, polling independently
+model_registry = ModelRegistry()
+# Generations in progress hold their model, so finish with it
+model_registry.add_listener(model_cache.invalidate)
+
 def models():
     '''
     The RNN models, in a form usable by composer.
@@ -44,64 +350,21 @@ def models():
     header_m_tokens - as above
     header_k_tokens - as above
     l_freqs - corpora with L, M, K headers require appropriate L values to be generated for any given M value, this supplies the frequencies from which a weighted random choice can be made
+    max_tokens - the limit on tokens generated per tune, beyond which it is truncated
+    max_seconds - the limit on seconds generating per tune, as above
+    Read from the model index, i.e. without loading any model weights, and kept up to date
+    as models are added to MODEL_PATH, changed or removed. See ModelRegistry
     '''
-    models = {}
-    for filename in os.listdir(MODEL_PATH):
-        try:
-            with open(os.path.join(MODEL_PATH, filename), "rb") as f:
-                job_spec = pickle.load(f)
-            model = {}
-            model['tokens'] = set(job_spec['token2idx'].keys())
-            model['tokens'].add('*')
-            model['display_name'] = job_spec['name']
-            model['display_order'] = job_spec['order']
-            model['default_meter'] = job_spec['default_meter']
-            model['default_mode'] = job_spec['default_mode']
-            model['default_tempo'] = job_spec['default_tempo']
-            
-            try:
-                l_tokens = job_spec['header_l_tokens']
-            except KeyError:
-                l_tokens = [x for x in model['tokens'] if header_l_regex.search(x)]
-            l_tokens = [header_l_regex.search(x).group(0) for x in l_tokens]
-            model['header_l_tokens'] = sorted(l_tokens) + ['*'] if len(l_tokens) else []
-            
-            try:
-                m_tokens = job_spec['header_m_tokens']
-            except KeyError:
-                m_tokens = [x for x in model['tokens'] if header_m_regex.search(x)]
-            m_tokens = [header_m_regex.search(x).group(0) for x in m_tokens]
-            model['header_m_tokens'] = sorted(m_tokens, key=header_m_sort) + ['*']
-            
-            try:
-                k_tokens = job_spec['header_k_tokens']
-            except KeyError:
-                k_tokens = [x for x in model['tokens'] if header_k_regex.search(x)]
-            k_tokens = [header_k_regex.search(x).group(0) for x in k_tokens]
-            model['header_k_tokens'] = sorted(k_tokens) + ['*']
-            
-            try:
-                model['l_freqs'] = {
-                    header_m_regex.search(k).group(0): {
-                        header_l_regex.search(l).group(0): freq for l, freq in v.items()
-                        } for k, v in job_spec['l_freqs'].items()
-                    }
-            except KeyError:
-                pass
-            
-            models[filename] = model
-        except:
-            logger.warning(f'Error parsing {filename}')
-            pass
-    return OrderedDict(sorted(models.items(), key=lambda x: x[1]['display_order']))
+    return model_registry.get()
 
-def models_json():
-    def set_encoder(obj):
-        if isinstance(obj, set):
-           return list(obj)
-        else:
-            raise TypeError
-    return json.dumps(models(), default=set_encoder)
+def model_since(rnn_model_name):
+    '''
+    When tunes started being generated with the model's current version, or None if there is no such model.
+    i.e. as made, plus as long as the workers take to see it, see ModelRegistry.
+    '''
+    if model_registry.version(rnn_model_name) is None:
+        return None
+    return datetime.fromtimestamp(model_registry.since[rnn_model_name] + FOLKRNN_MODEL_POLL_INTERVAL, timezone.utc)
 
 def choices():
     return ((x, models()[x]['display_name']) for x in models())
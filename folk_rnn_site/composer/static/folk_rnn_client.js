@@ -15,6 +15,7 @@ folkrnn.initialise = function() {
     folkrnn.fieldStartABC = document.getElementById("id_start_abc");
     folkrnn.seedAutoButton = document.getElementById("seed_auto");
     folkrnn.composeButton = document.getElementById("compose_button");
+    folkrnn.composeVariationsButton = document.getElementById("compose_variations_button");
     
     folkrnn.div_tune = document.getElementById("tune");
     
@@ -49,7 +50,14 @@ folkrnn.initialise = function() {
         folkrnn.handleSeedAuto(true);
     });
     
-    folkrnn.composeButton.addEventListener("click", folkrnn.generateRequest);
+    folkrnn.composeButton.addEventListener("click", function() {
+        folkrnn.generateRequest(1);
+    });
+    if (folkrnn.composeVariationsButton) {
+        folkrnn.composeVariationsButton.addEventListener("click", function() {
+            folkrnn.generateRequest(folkrnn.composeVariationsCount);
+        });
+    }
     
     folkrnn.div_tune.setAttribute('hidden', '');
     
@@ -173,7 +181,7 @@ folkrnn.tuneManager = {
         div_tune_new.querySelector('#remove_button').addEventListener("click", function () {
             folkrnn.stateManager.removeTune(tune_id);
         });
-        folkrnn.tuneManager.tunes[tune_id] = { 'div': div_tune_new };
+        folkrnn.tuneManager.tunes[tune_id] = { 'div': div_tune_new, 'abcOffset': 0 };
         
         // Place on page
         folkrnn.div_tune.parentNode.insertBefore(div_tune_new, folkrnn.div_tune);
@@ -186,6 +194,17 @@ folkrnn.tuneManager = {
                     tune_id: tune_id
                     });
     },
+    'registerTunes': function () {
+        "use strict";
+        // Register for updates, with the abc received so far
+        for (const tune_id of Object.keys(folkrnn.tuneManager.tunes)) {
+            folkrnn.websocketSend({
+                        command: "register_for_tune", 
+                        tune_id: tune_id,
+                        offset: folkrnn.tuneManager.tunes[tune_id].abcOffset
+                        });
+        }
+    },
     'tuneDiv': function (tune_id) {
         "use strict";
         return folkrnn.tuneManager.tunes[tune_id].div;
@@ -276,7 +295,10 @@ folkrnn.tuneManager = {
     },
 };
 
-folkrnn.generateRequest = function () {
+// Tunes requested by the compose variations button, differing only by seed
+folkrnn.composeVariationsCount = 4;
+
+folkrnn.generateRequest = function (count) {
     "use strict";
     let valid = true;
     valid = valid && folkrnn.fieldModel.reportValidity();
@@ -291,15 +313,24 @@ folkrnn.generateRequest = function () {
         formData.model = folkrnn.fieldModel.value;
         formData.temp = folkrnn.fieldTemp.value;
         formData.seed = folkrnn.fieldSeed.value;
+        formData.auto_seed = Boolean(folkrnn.fieldSeed.dataset.autoseed);
         formData.unitnotelength = parsedStartABC.header.l || ''
         formData.meter = parsedStartABC.header.m || folkrnn.fieldMeter.value;
         formData.key = parsedStartABC.header.k || folkrnn.fieldKey.value;
         formData.start_abc = parsedStartABC.tokens.join(' ');
         
-        folkrnn.websocketSend({
-                    'command': 'compose',
-                    'data': formData,
-        });
+        if (count > 1) {
+            folkrnn.websocketSend({
+                        'command': 'compose_batch',
+                        'data': formData,
+                        'count': count,
+            });
+        } else {
+            folkrnn.websocketSend({
+                        'command': 'compose',
+                        'data': formData,
+            });
+        }
         
         folkrnn.setComposeParametersFromTune = false;
     }
@@ -364,6 +395,8 @@ folkrnn.updateKeyMeter = function() {
     // If the meter, mode tokens in new model are the same as the old, don't do anything.
     // Else update key, meter options per new model's vocabset and defaults.
     
+    folkrnn.loadModelTokens(folkrnn.fieldModel.value, folkrnn.validateStartABC);
+    
     const m_values_old = Array.from(folkrnn.fieldMeter.childNodes).map(x => x.value);
     const m_values_new = folkrnn.models[folkrnn.fieldModel.value].header_m_tokens;
     const k_values_old = Array.from(folkrnn.fieldKey.childNodes).map(x => x.value);
@@ -425,6 +458,10 @@ folkrnn.updateTuneDiv = function(tune) {
     el_tempo_input.value = folkrnn.models[tune.rnn_model_name].default_tempo;
     if (tune.rnn_finished) {
         el_generated.textContent = new Date(tune.rnn_finished).toLocaleString();
+        if (tune.rnn_truncated) {
+            const model = folkrnn.models[tune.rnn_model_name];
+            el_generated.textContent += ', truncated to its last bar as it reached the limit of ' + model.max_tokens + ' tokens or ' + model.max_seconds + ' seconds';
+        }
         el_requested.parentNode.setAttribute('hidden', '');
         el_generated.parentNode.removeAttribute('hidden');
         
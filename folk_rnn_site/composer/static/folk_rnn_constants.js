@@ -4,4 +4,6 @@
 if (typeof folkrnn == 'undefined')
     folkrnn = {};
     
-folkrnn.waitingABC = 'Waiting for folk-rnn...';
\ No newline at end of file
+folkrnn.waitingABC = 'Waiting for folk-rnn...';
+folkrnn.rejectedABC = 'folk-rnn is busy, please try again later.';
+folkrnn.failedABC = 'folk-rnn could not generate this tune, please try again.';
\ No newline at end of file
@@ -17,10 +17,29 @@ folkrnn.invalidHeaders = function(l, m, k, modelFileName) {
     return invalidTokens;
 };
 
+folkrnn.loadModelTokens = function(modelFileName, callback) {
+    "use strict";
+    // A model's vocabulary is a separate, cacheable file. Fetch once, on first use.
+    const model = folkrnn.models[modelFileName];
+    if (model.tokens) {
+        return;
+    }
+    if (!model.tokensRequest) {
+        model.tokensRequest = fetch(model.tokens_url)
+            .then(response => response.json())
+            .then(tokens => { model.tokens = tokens; });
+    }
+    model.tokensRequest.then(callback);
+};
+
 folkrnn.invalidTokens = function(userTokens, modelFileName) {
     "use strict";
     const modelTokens = folkrnn.models[modelFileName].tokens;
     let invalidTokens = [];
+    if (!modelTokens) {
+        // Not loaded yet, see loadModelTokens
+        return invalidTokens;
+    }
     for (const token of userTokens) {
         if (token==='') 
             continue;
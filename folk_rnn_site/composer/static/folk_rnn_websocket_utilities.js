@@ -22,6 +22,10 @@ folkrnn.websocketSend = function(json) {
         // Empty queue once connected
         folkrnn.socket.socket.addEventListener('open', function() {
             console.log("Connected to WebSocket");
+            // On reconnect, register again, picking up generation where it left off
+            if (folkrnn.websocketSend.connected)
+                folkrnn.tuneManager.registerTunes();
+            folkrnn.websocketSend.connected = true;
             folkrnn.websocketSend();
         });
     }
@@ -60,11 +64,27 @@ folkrnn.websocketReceive = function(action, stream) {
             folkrnn.updateTuneDiv(action.tune);
             folkrnn.tuneManager.enableABCJS(action.tune.id);
         }
+        if (action.status == "queue_position") {
+            const el_abc = folkrnn.tuneManager.tuneDiv(action.tune_id).querySelector('#abc-'+action.tune_id);
+            el_abc.value = folkrnn.waitingABC + ' Queue position: ' + action.position;
+        }
+        if (action.status == "rejected") {
+            const el_abc = folkrnn.tuneManager.tuneDiv(action.tune_id).querySelector('#abc-'+action.tune_id);
+            el_abc.value = folkrnn.rejectedABC;
+        }
+        if (action.status == "failed") {
+            const el_abc = folkrnn.tuneManager.tuneDiv(action.tune_id).querySelector('#abc-'+action.tune_id);
+            el_abc.value = folkrnn.failedABC;
+        }
     }
     if (action.command == "add_token") {
+        const tune = folkrnn.tuneManager.tunes[action.tune_id];
+        if (action.offset != tune.abcOffset)
+            return;
+        tune.abcOffset += action.token.length;
         const el_tune = folkrnn.tuneManager.tuneDiv(action.tune_id);
         const el_abc = el_tune.querySelector('#abc-'+action.tune_id);
-        if (el_abc.value == folkrnn.waitingABC)
+        if (el_abc.value.startsWith(folkrnn.waitingABC))
             el_abc.value = "";
         el_abc.value += action.token;
         if (action.token.includes("|")) 
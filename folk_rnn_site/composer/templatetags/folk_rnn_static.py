@@ -0,0 +1,13 @@
+from django import template
+from django.conf import settings
+
+from composer.models_js import models_js_filename
+
+register = template.Library()
+
+@register.simple_tag
+def folk_rnn_models_js():
+    '''
+    The URL of the content-hashed folk_rnn_models.js, see models_js.py
+    '''
+    return settings.STATIC_URL + models_js_filename()
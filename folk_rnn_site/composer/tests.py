@@ -1,12 +1,24 @@
+import os
+import shutil
 from django.test import TestCase 
 from django.utils.timezone import now
 from datetime import timedelta
 from time import sleep
-from tempfile import SpooledTemporaryFile
+from tempfile import SpooledTemporaryFile, TemporaryDirectory
+from unittest.mock import patch
 
-from folk_rnn_site.tests import ABC_TITLE, ABC_BODY, mint_abc
-from composer.models import RNNTune
+from folk_rnn_site.tests import ABC_TITLE, ABC_BODY, mint_abc, FOLKRNN_IN, FOLKRNN_OUT_RAW
+from composer.models import RNNTune, PregeneratedTune
 from composer.dataset import rnntune_dataset, dataset_as_csv
+from composer import MODEL_PATH
+from composer.rnn_models import ModelCache, ModelRegistry, load_job_spec, model_index, model_metadata, model_since
+from composer.result_cache import ResultCache, result_key
+from composer.models_js import build_models_js, models_js_filename
+from composer.fair_queue import FairShareQueue
+from composer.consumers import create_variations
+from composer.worker_routing import model_channel, assigned_channels, group_models, group_channels
+from composer.management.commands.bench_generate import Command as BenchGenerateCommand
+from composer.pregeneration import default_parameters, claim_pregenerated, models_to_pregenerate
 from archiver.models import Tune, User
 
 def folk_rnn_create_tune(seed=123, temp=0.1, start_abc='a b c'):
@@ -140,4 +152,214 @@ class RNNTuneModelTest(TestCase):
         self.assertEqual(tune.prime_tokens, 'M:4/4 K:Cmaj')
         
         tune = RNNTune(rnn_model_name='thesession_with_repeats.pickle', meter='M:4/4', key='K:Cmaj', start_abc='a b c')
-        self.assertEqual(tune.prime_tokens, 'M:4/4 K:Cmaj a b c')     
\ No newline at end of file
+        self.assertEqual(tune.prime_tokens, 'M:4/4 K:Cmaj a b c')
+
+class ModelIndexTest(TestCase):
+    
+    def test_model_index_as_per_model(self):
+        entry = model_index()[FOLKRNN_IN['rnn_model_name']]
+        metadata = model_metadata(load_job_spec(FOLKRNN_IN['rnn_model_name']))
+        self.assertEqual(set(entry['model'].pop('tokens')), metadata.pop('tokens'))
+        self.assertEqual(entry['model'], metadata)
+    
+    def test_model_index_does_not_reload_unchanged_models(self):
+        model_index()
+        with patch('composer.rnn_models.pickle.load', side_effect=AssertionError):
+            self.assertIn(FOLKRNN_IN['rnn_model_name'], model_index())
+
+class ModelRegistryTest(TestCase):
+    
+    def test_models_added_and_removed(self):
+        model = FOLKRNN_IN['rnn_model_name']
+        with TemporaryDirectory() as model_path, TemporaryDirectory() as index_path, \
+                patch('composer.rnn_models.MODEL_PATH', model_path), \
+                patch('composer.rnn_models.MODEL_INDEX_PATH', os.path.join(index_path, 'model_index.json')):
+            registry = ModelRegistry(interval=0)
+            changes = []
+            registry.add_listener(changes.append)
+            self.assertEqual(len(registry.get()), 0)
+            shutil.copy(os.path.join(MODEL_PATH, model), model_path)
+            self.assertIn(model, registry.get())
+            self.assertEqual(registry.refresh(), [])
+            os.remove(os.path.join(model_path, model))
+            self.assertNotIn(model, registry.get())
+            self.assertEqual(changes, [[model], [model]])
+    
+    def test_since_kept_as_model_reprovisioned(self):
+        model = FOLKRNN_IN['rnn_model_name']
+        with TemporaryDirectory() as model_path, TemporaryDirectory() as index_path, \
+                patch('composer.rnn_models.MODEL_PATH', model_path), \
+                patch('composer.rnn_models.MODEL_INDEX_PATH', os.path.join(index_path, 'model_index.json')):
+            registry = ModelRegistry(interval=0)
+            shutil.copy(os.path.join(MODEL_PATH, model), model_path)
+            registry.get()
+            since = registry.since[model]
+            # Copied again, i.e. same hash, later mtime
+            os.utime(os.path.join(model_path, model), (since + 100, since + 100))
+            self.assertEqual(registry.refresh(), [])
+            self.assertEqual(registry.signature[0][0][1], since + 100)
+            self.assertEqual(registry.since[model], since)
+
+class ResultCacheTest(TestCase):
+    
+    def test_result_of_model_version(self):
+        tune = folk_rnn_create_tune()
+        key = result_key(tune.rnn_model_name, tune.seed, tune.temp, tune.prime_tokens)
+        with patch('composer.rnn_models.model_registry.version', return_value=('0' * 40, 'float16')):
+            self.assertNotEqual(result_key(tune.rnn_model_name, tune.seed, tune.temp, tune.prime_tokens), key)
+        
+        result_cache = ResultCache()
+        result_cache.put(key, mint_abc(), tune.id)
+        result_cache.invalidate([tune.rnn_model_name])
+        self.assertEqual(len(result_cache.results), 0)
+    
+    def test_result_not_of_previous_model_version(self):
+        cached_tune = folk_rnn_create_tune()
+        cached_tune.rnn_started = model_since(cached_tune.rnn_model_name) - timedelta(seconds=1)
+        cached_tune.rnn_finished = now()
+        cached_tune.abc = mint_abc()
+        cached_tune.save()
+        self.assertIsNone(ResultCache().get(folk_rnn_create_tune()))
+        
+        cached_tune.rnn_started = now()
+        cached_tune.save()
+        self.assertEqual(ResultCache().get(folk_rnn_create_tune()), (cached_tune.abc, cached_tune.id))
+
+class ModelsJSTest(TestCase):
+    
+    def test_build_models_js(self):
+        with TemporaryDirectory() as static_path, TemporaryDirectory() as static_root, \
+                patch('composer.models_js.STATIC_PATH', static_path), \
+                patch('composer.models_js.MANIFEST_PATH', os.path.join(static_path, 'manifest.json')), \
+                self.settings(STATIC_ROOT=static_root):
+            written = build_models_js()
+            self.assertIn(models_js_filename(), written)
+            self.assertEqual(build_models_js(), [])
+            with open(os.path.join(static_path, models_js_filename())) as f:
+                js = f.read()
+            self.assertIn('tokens_url', js)
+            self.assertNotIn('"tokens"', js)
+            # As served, without collectstatic
+            self.assertTrue(os.path.exists(os.path.join(static_root, models_js_filename())))
+            
+            # The manifest is made again, even with the build already there
+            os.remove(os.path.join(static_path, 'manifest.json'))
+            self.assertEqual(build_models_js(), [])
+            self.assertTrue(os.path.exists(os.path.join(static_path, 'manifest.json')))
+
+class FairShareQueueTest(TestCase):
+    
+    def test_sessions_take_turns(self):
+        queue = FairShareQueue(max_in_flight=3, session_max_in_flight=2, max_depth=10, in_flight_timeout=60)
+        for tune_id in [1, 2, 3, 4]:
+            queue.enqueue('spammer', tune_id)
+        queue.enqueue('other', 5)
+        self.assertEqual(queue.positions(), {1: 1, 5: 2, 2: 3, 3: 4, 4: 5})
+        self.assertEqual(queue.dispatch(), [1, 5, 2])
+        self.assertEqual(queue.positions(), {3: 1, 4: 2})
+        # Capacity, but spammer at its cap
+        queue.finished(5)
+        self.assertEqual(queue.dispatch(), [])
+        queue.finished(1)
+        self.assertEqual(queue.dispatch(), [3])
+    
+    def test_rejects_when_full(self):
+        queue = FairShareQueue(max_in_flight=1, session_max_in_flight=1, max_depth=2, in_flight_timeout=60)
+        self.assertTrue(queue.enqueue('a', 1))
+        self.assertTrue(queue.enqueue('b', 2))
+        self.assertFalse(queue.enqueue('c', 3))
+        queue.dispatch()
+        self.assertTrue(queue.enqueue('c', 3))
+    
+    def test_batch_rejected_whole(self):
+        queue = FairShareQueue(max_in_flight=1, session_max_in_flight=1, max_depth=4, in_flight_timeout=60)
+        self.assertTrue(queue.enqueue('a', 1, 2))
+        self.assertFalse(queue.enqueue('b', 3, 4, 5))
+        self.assertEqual(len(queue), 2)
+        self.assertTrue(queue.enqueue('b', 3, 4))
+        self.assertEqual(len(queue), 4)
+    
+    def test_batch_dispatched_together(self):
+        queue = FairShareQueue(max_in_flight=4, session_max_in_flight=1, max_depth=10, in_flight_timeout=60)
+        queue.enqueue('batcher', 1, 2, 3)
+        queue.enqueue('batcher', 4)
+        queue.enqueue('other', 5)
+        # The batch counts as one against the session cap
+        self.assertEqual(queue.dispatch(), [1, 2, 3, 5])
+        self.assertEqual(queue.batch_of(2), 1)
+        for tune_id in [1, 2, 3]:
+            queue.finished(tune_id)
+        self.assertEqual(queue.dispatch(), [4])
+
+class ComposeBatchTest(TestCase):
+    
+    def test_create_variations(self):
+        tune = RNNTune(rnn_model_name=FOLKRNN_IN['rnn_model_name'], seed=42, temp=1.0, meter='M:4/4', key='K:Cmaj', unitnotelength='', start_abc='')
+        tunes = create_variations(tune, 4)
+        self.assertEqual(RNNTune.objects.count(), 4)
+        self.assertEqual(tunes[0].seed, 42)
+        self.assertEqual(len({x.seed for x in tunes}), 4)
+        for variation in RNNTune.objects.all():
+            self.assertEqual(variation.temp, 1.0)
+            self.assertTrue(variation.unitnotelength.startswith('L:'))
+
+class WorkerRoutingTest(TestCase):
+    
+    def test_routing(self):
+        model = FOLKRNN_IN['rnn_model_name']
+        self.assertEqual(model_channel(model), 'folk_rnn')
+        self.assertIn(model, group_models())
+        with patch.dict('composer.worker_routing.FOLKRNN_WORKER_GROUPS', {'2': [model]}):
+            self.assertEqual(model_channel(model), 'folk_rnn.thesession_with_repeats')
+            self.assertEqual(assigned_channels(), ['folk_rnn.thesession_with_repeats'])
+            self.assertEqual(group_channels('2'), ['folk_rnn.thesession_with_repeats'])
+            self.assertEqual(group_channels('1'), ['folk_rnn'])
+            self.assertNotIn(model, group_models('1'))
+
+class ModelCacheTest(TestCase):
+
+    def test_evicts_by_bytes(self):
+        loaded = []
+        def load(rnn_model_name):
+            loaded.append(rnn_model_name)
+            return rnn_model_name.upper(), 40
+        cache = ModelCache(max_bytes=100, load=load)
+        cache.preload(['a', 'b', 'c', 'd'])
+        self.assertEqual(list(cache.models), ['a', 'b']) # c, d beyond the budget, not held
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(cache.get('d'), 'D')
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache) # least recently used
+        self.assertEqual(cache.nbytes, 80)
+        self.assertEqual(loaded, ['a', 'b', 'c', 'd', 'd'])
+        cache.invalidate(['d'])
+        self.assertNotIn('d', cache)
+        self.assertEqual(cache.nbytes, 40)
+
+class PregenerationTest(TestCase):
+    
+    def test_claim_pregenerated(self):
+        model = 'thesession_with_repeats.pickle'
+        meter, key = default_parameters(model)
+        PregeneratedTune.objects.create(rnn_model_name=model, seed=123, temp=1.0, unitnotelength='L:1/8', meter=meter, key=key, abc=mint_abc(), raw=FOLKRNN_OUT_RAW)
+        
+        tune = RNNTune(rnn_model_name=model, seed=42, temp=1.0, meter=meter, key=key, start_abc='a b c')
+        self.assertIsNone(claim_pregenerated(tune))
+        tune = RNNTune(rnn_model_name=model, seed=42, temp=0.5, meter=meter, key=key)
+        self.assertIsNone(claim_pregenerated(tune))
+        
+        tune = RNNTune(rnn_model_name=model, seed=42, temp=1.0, meter=meter, key=key)
+        pregenerated = claim_pregenerated(tune)
+        self.assertEqual(pregenerated.seed, 123)
+        self.assertEqual(PregeneratedTune.objects.count(), 0)
+        self.assertIsNone(claim_pregenerated(tune))
+        self.assertIn(model, models_to_pregenerate())
+
+class BenchGenerateTest(TestCase):
+    
+    def test_compare(self):
+        baseline = {'tunes_per_second': 10.0, 'models': {'m': {'token_latency_seconds_p50': 0.010, 'cold_load_seconds': 1.0}}}
+        results = {'tunes_per_second': 9.5, 'models': {'m': {'token_latency_seconds_p50': 0.012, 'cold_load_seconds': 0.5}}}
+        regressions = BenchGenerateCommand.compare(baseline, results, 0.1)
+        self.assertEqual(len(regressions), 1)
+        self.assertIn('token_latency_seconds_p50', regressions[0])
@@ -4,11 +4,13 @@ from channels.testing import ApplicationCommunicator, WebsocketCommunicator
 from channels.layers import get_channel_layer
 from channels.db import database_sync_to_async
 from datetime import timedelta
+from django.utils.timezone import now
 from asyncio import sleep
 
-from composer import TUNE_PATH
 from composer.consumers import FolkRNNConsumer, ComposerConsumer
+from composer.progress import append_progress, add_listener, remove_listener, is_abandoned, local_progress_store, LISTENERS_KEY_PREFIX
 from composer.models import RNNTune
+from composer.tune_store import tune_store
 from folk_rnn_site.tests import FOLKRNN_IN, FOLKRNN_OUT, FOLKRNN_OUT_RAW
 
 @pytest.mark.django_db(transaction=True)  
@@ -28,14 +30,13 @@ async def test_folkrnn_consumer():
     await communicator.send_input({'type': 'stop'})
     await communicator.wait()
 
-    with open(TUNE_PATH + f'/thesession_with_repeats_{tune.id}_raw') as f:
-        assert f.read() == FOLKRNN_OUT_RAW
+    raw, abc = tune_store.get(tune.id)
+    assert raw == FOLKRNN_OUT_RAW
 
     correct_out = FOLKRNN_OUT\
                     .replace('X:1', f'X:{tune.id}')\
                     .replace('№1', f'№{tune.id}')
-    with open(TUNE_PATH + f'/thesession_with_repeats_{tune.id}') as f:
-        assert f.read() == correct_out
+    assert abc == correct_out
 
     tune = RNNTune.objects.last()
     assert tune.rnn_started is not None
@@ -67,19 +68,19 @@ async def test_generation_status():
         'tune_id': tune_b.id,
         }))
     
-    # This sleep is critical. The design of the consumer means the add_token command
-    # will have all pending abc, but testing output based on the non-deterministic point 
+    # This sleep is critical. Testing output based on the non-deterministic point 
     # of first receiving the group messages muddies the procedural test logic.
     await sleep(3)
     
     channel_layer = get_channel_layer()
      
-    # Send the consumer complete ABC via tune group. 
+    # Send the consumer ABC deltas via tune group. 
     # Check it gets back incremental ABC.
     # And do this for two tunes, to check isolation.
     await channel_layer.group_send('tune_1', {
         'type': 'generation_status',
         'status': 'new_abc',
+        'offset': 0,
         'abc': 'a b c',
         'tune_id': tune_a.id,
         })
@@ -87,12 +88,14 @@ async def test_generation_status():
     assert json.loads(response) == {
         'command': 'add_token',
         'token': 'a b c',
+        'offset': 0,
         'tune_id': tune_a.id,
     }
     
     await channel_layer.group_send('tune_2', {
         'type': 'generation_status',
         'status': 'new_abc',
+        'offset': 0,
         'abc': 'A B C',
         'tune_id': tune_b.id,
         })
@@ -100,36 +103,129 @@ async def test_generation_status():
     assert json.loads(response) == {
         'command': 'add_token',
         'token': 'A B C',
+        'offset': 0,
         'tune_id': tune_b.id,
     }
     
     await channel_layer.group_send('tune_1', {
         'type': 'generation_status',
         'status': 'new_abc',
-        'abc': 'a b c d e f',
+        'offset': 5,
+        'abc': ' d e f',
         'tune_id': tune_a.id,
         })
     response = await communicator.receive_from()
     assert json.loads(response) == {
         'command': 'add_token',
         'token': ' d e f',
+        'offset': 5,
         'tune_id': tune_a.id,
     }
     
     await channel_layer.group_send('tune_2', {
         'type': 'generation_status',
         'status': 'new_abc',
-        'abc': 'A B C D E F',
+        'offset': 5,
+        'abc': ' D E F',
         'tune_id': tune_b.id,
         })
     response = await communicator.receive_from()
     assert json.loads(response) == {
         'command': 'add_token',
         'token': ' D E F',
+        'offset': 5,
         'tune_id': tune_b.id,
     }
     
+    # Check overlapping abc is only sent once, and missed abc stops the stream.
+    await channel_layer.group_send('tune_1', {
+        'type': 'generation_status',
+        'status': 'new_abc',
+        'offset': 9,
+        'abc': ' f g h',
+        'tune_id': tune_a.id,
+        })
+    response = await communicator.receive_from()
+    assert json.loads(response) == {
+        'command': 'add_token',
+        'token': ' g h',
+        'offset': 11,
+        'tune_id': tune_a.id,
+    }
+    
+    await channel_layer.group_send('tune_2', {
+        'type': 'generation_status',
+        'status': 'new_abc',
+        'offset': 13,
+        'abc': ' H',
+        'tune_id': tune_b.id,
+        })
+    assert await communicator.receive_nothing()
+    
+    await communicator.disconnect()
+
+@pytest.mark.django_db()
+@pytest.mark.asyncio
+async def test_register_for_tune_mid_generation():
+    communicator = WebsocketCommunicator(ComposerConsumer, '/')
+    communicator.scope['client'] = ['composer.tests_aync']
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    response = await communicator.receive_from()
+    assert json.loads(response)['command'] == 'set_session'
+    
+    # Register for a tune part-generated, having some of its abc already (i.e. reconnecting).
+    # Check it gets back the abc it doesn't have.
+    tune = await database_sync_to_async(RNNTune.objects.create)(rnn_started=now(), **FOLKRNN_IN)
+    channel_layer = get_channel_layer()
+    await append_progress(channel_layer, tune.id, 'a b c')
+    await append_progress(channel_layer, tune.id, ' d e f')
+    await communicator.send_to(json.dumps({
+        'command': 'register_for_tune',
+        'tune_id': tune.id,
+        'offset': 5,
+        }))
+    response = await communicator.receive_from()
+    assert json.loads(response) == {
+        'command': 'add_token',
+        'token': ' d e f',
+        'offset': 5,
+        'tune_id': tune.id,
+    }
+    
     await communicator.disconnect()
+
+@pytest.mark.asyncio
+async def test_abandoned_with_last_listener():
+    channel_layer = get_channel_layer()
+    tune_id = 'test_abandoned'
+    await add_listener(channel_layer, tune_id)
+    await add_listener(channel_layer, tune_id)
+    await remove_listener(channel_layer, tune_id)
+    assert not await is_abandoned(channel_layer, tune_id, grace=-1)
+    await remove_listener(channel_layer, tune_id)
+    assert await is_abandoned(channel_layer, tune_id, grace=-1)
+    assert not await is_abandoned(channel_layer, tune_id, grace=60) # i.e. time to reconnect
+    await add_listener(channel_layer, tune_id)
+    assert not await is_abandoned(channel_layer, tune_id, grace=-1)
+
+@pytest.mark.asyncio
+async def test_listener_count_expired():
+    channel_layer = get_channel_layer()
+    tune_id = 'test_listener_count_expired'
+    await add_listener(channel_layer, tune_id)
+    await add_listener(channel_layer, tune_id)
+    # i.e. as if FOLKRNN_PROGRESS_TTL passed without progress
+    if hasattr(channel_layer, 'connection'):
+        async with channel_layer.connection(0) as connection:
+            await connection.delete(LISTENERS_KEY_PREFIX + tune_id)
+    else:
+        local_progress_store.delete(LISTENERS_KEY_PREFIX + tune_id)
+    await remove_listener(channel_layer, tune_id)
+    assert not await is_abandoned(channel_layer, tune_id, grace=-1)
+    await add_listener(channel_layer, tune_id)
+    await remove_listener(channel_layer, tune_id)
+    assert await is_abandoned(channel_layer, tune_id, grace=-1)
     
 @pytest.mark.django_db()    
 @pytest.mark.asyncio
@@ -223,3 +319,63 @@ async def test_receive_json_compose_invalid():
     
     await communicator.disconnect()
     
+@pytest.mark.django_db()    
+@pytest.mark.asyncio
+async def test_receive_json_compose_cached():
+    cached_tune = RNNTune.objects.create(
+                        rnn_model_name='thesession_with_repeats.pickle', 
+                        seed=123, 
+                        temp=0.1, 
+                        meter='M:4/4', 
+                        key='K:Cmaj', 
+                        start_abc='a b c',
+                        abc='X:1\nM:4/4\nK:Cmaj\nabc|\n',
+                        )
+    cached_tune.rnn_started = cached_tune.requested
+    cached_tune.rnn_finished = cached_tune.requested
+    cached_tune.save()
+    
+    communicator = WebsocketCommunicator(ComposerConsumer, '/')
+    communicator.scope['client'] = ['composer.tests_aync']
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    response = await communicator.receive_from()
+    response_data = json.loads(response)
+    assert response_data['command'] == 'set_session'
+    
+    content = {
+        'command': 'compose',
+        'data': {
+            'model': 'thesession_with_repeats.pickle',
+            'temp': 0.1,
+            'seed': 123,
+            'meter': 'M:4/4',
+            'key': 'K:Cmaj',
+            'start_abc': 'a b c',
+            }
+    }
+    await communicator.send_to(json.dumps(content))
+    
+    # The tune as added, i.e. not whichever was created last
+    response_data = json.loads(await communicator.receive_from())
+    assert response_data['command'] == 'add_tune'
+    tune = RNNTune.objects.get(id=response_data['tune']['id'])
+    assert tune.id != cached_tune.id
+    response_data = json.loads(await communicator.receive_from())
+    assert response_data['command'] == 'generation_status'
+    assert response_data['status'] == 'start'
+    response_data = json.loads(await communicator.receive_from())
+    assert response_data == {
+        'command': 'add_token',
+        'token': f'X:{tune.id}\nM:4/4\nK:Cmaj\nabc|\n',
+        'offset': 0,
+        'tune_id': tune.id,
+    }
+    response_data = json.loads(await communicator.receive_from())
+    assert response_data['command'] == 'generation_status'
+    assert response_data['status'] == 'finish'
+    assert response_data['tune']['abc'] == f'X:{tune.id}\nM:4/4\nK:Cmaj\nabc|\n'
+    tune = RNNTune.objects.get(id=tune.id)
+    assert tune.rnn_finished is not None
+    
+    await communicator.disconnect()
@@ -0,0 +1,174 @@
+from django.test import TestCase
+from time import sleep
+from unittest.mock import patch
+
+import numpy as np
+from folk_rnn import Folk_RNN
+
+from folk_rnn_site.tests import FOLKRNN_IN, FOLKRNN_OUT_RAW
+from composer.rnn_models import model_cache, load_job_spec
+from composer.model_bundle import dequantized
+from composer.generation import BatchedFolkRNN, Generation, GenerationBudget, generate, truncate_to_bar
+
+class GenerationTest(TestCase):
+    
+    def test_generation_as_per_folk_rnn(self):
+        folk_rnn = model_cache.get(FOLKRNN_IN['rnn_model_name'])
+        generation = Generation(folk_rnn, seed=FOLKRNN_IN['seed'], temperature=FOLKRNN_IN['temp'])
+        tune_tokens = generate([generation])[0]
+        self.assertEqual(' '.join(tune_tokens), FOLKRNN_OUT_RAW)
+    
+    def test_batched_generation_as_per_sequential(self):
+        folk_rnn = model_cache.get(FOLKRNN_IN['rnn_model_name'])
+        parameters = [
+            (None, 42, 1.0),
+            ('M:4/4 K:Cmaj a b c *', 123, 0.1),
+            ('M:4/4 * c', 7, 2.0),
+            ('M:4/4 K:Cmaj', 42, 1.0),
+            ]
+        sequential = [generate([Generation(folk_rnn, *x)])[0] for x in parameters]
+        batched = generate([Generation(folk_rnn, *x) for x in parameters])
+        self.assertEqual(sequential, batched)
+    
+    def test_step_rows_as_per_alone(self):
+        folk_rnn = model_cache.get(FOLKRNN_IN['rnn_model_name'])
+        rng = np.random.RandomState(0)
+        units = folk_rnn.initial_state()[0][0].shape[1]
+        dtype = folk_rnn.initial_state()[0][0].dtype
+        state = [(rng.uniform(-1, 1, (8, units)).astype(dtype), rng.uniform(-1, 1, (8, units)).astype(dtype)) for _ in range(folk_rnn.num_layers)]
+        token_idxs = rng.randint(folk_rnn.vocab_size, size=8)
+        batch_state = folk_rnn.step(token_idxs, state)
+        batch_logits = folk_rnn.logits(batch_state[-1][0])
+        for row in range(8):
+            row_state = folk_rnn.step(token_idxs[row:row+1], [(hid[row:row+1], cell[row:row+1]) for hid, cell in state])
+            for (hid, cell), (row_hid, row_cell) in zip(batch_state, row_state):
+                self.assertTrue(np.array_equal(hid[row:row+1], row_hid))
+                self.assertTrue(np.array_equal(cell[row:row+1], row_cell))
+            self.assertTrue(np.array_equal(batch_logits[row:row+1], folk_rnn.logits(row_state[-1][0])))
+    
+    def test_mixed_batches_as_per_alone(self):
+        folk_rnn = model_cache.get(FOLKRNN_IN['rnn_model_name'])
+        rng = np.random.RandomState(0)
+        tokens = sorted(set(folk_rnn.token2idx) - {'<s>', '</s>'})
+        parameters = []
+        for _ in range(24):
+            prime = [rng.choice(tokens + ['*']) for _ in range(rng.randint(6))]
+            parameters.append((' '.join(prime) or None, int(rng.randint(1000000)), float(rng.choice([0.1, 0.5, 1.0, 2.0]))))
+        alone = [generate([Generation(folk_rnn, *x)])[0] for x in parameters]
+        for batch_size in (3, 8):
+            order = rng.permutation(len(parameters))
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                batched = generate([Generation(folk_rnn, *parameters[x]) for x in batch])
+                self.assertEqual([alone[x] for x in batch], batched)
+    
+    def test_gemm_step_close_to_per_row(self):
+        job_spec = load_job_spec(FOLKRNN_IN['rnn_model_name'])
+        folk_rnn = BatchedFolkRNN.from_job_spec(job_spec)
+        folk_rnn_gemm = BatchedFolkRNN.from_job_spec(job_spec, gemm=True)
+        rng = np.random.RandomState(0)
+        units = folk_rnn.initial_state()[0][0].shape[1]
+        dtype = folk_rnn.initial_state()[0][0].dtype
+        state = [(rng.uniform(-1, 1, (8, units)).astype(dtype), rng.uniform(-1, 1, (8, units)).astype(dtype)) for _ in range(folk_rnn.num_layers)]
+        token_idxs = rng.randint(folk_rnn.vocab_size, size=8)
+        batch_state = folk_rnn.step(token_idxs, state)
+        gemm_state = folk_rnn_gemm.step(token_idxs, state)
+        # Not bit for bit, as BLAS accumulates a matrix-matrix product in its own order
+        for (hid, cell), (gemm_hid, gemm_cell) in zip(batch_state, gemm_state):
+            self.assertTrue(np.allclose(hid, gemm_hid, rtol=1e-4, atol=1e-5))
+            self.assertTrue(np.allclose(cell, gemm_cell, rtol=1e-4, atol=1e-5))
+        self.assertTrue(np.allclose(folk_rnn.logits(batch_state[-1][0]), folk_rnn_gemm.logits(gemm_state[-1][0]), rtol=1e-4, atol=1e-4))
+        # Deterministic for the same batch
+        for (hid, cell), (again_hid, again_cell) in zip(gemm_state, folk_rnn_gemm.step(token_idxs, state)):
+            self.assertTrue(np.array_equal(hid, again_hid))
+            self.assertTrue(np.array_equal(cell, again_cell))
+    
+    def test_primed_generation_as_per_folk_rnn(self):
+        job_spec = load_job_spec(FOLKRNN_IN['rnn_model_name'])
+        folk_rnn = Folk_RNN(job_spec['token2idx'], dequantized(job_spec['param_values']), job_spec['num_layers'], '*')
+        batched_folk_rnn = BatchedFolkRNN.from_job_spec(job_spec)
+        parameters = [
+            ('M:4/4 K:Cmaj', 42, 1.0),
+            ('M:4/4 K:Cmaj a b c', 123, 0.1),
+            ('M:6/8 K:Cdor', 7, 2.0),
+            ('M:4/4 K:Cmaj a b c *', 42, 1.0),
+            ('M:4/4 * c', 7, 1.0),
+            ('* K:Cmaj', 123, 0.5),
+            ('*', 42, 1.0),
+            ]
+        for prime_tokens, seed, temperature in parameters:
+            folk_rnn.seed_tune(prime_tokens)
+            tune_tokens = folk_rnn.generate_tune(random_number_generator_seed=seed, temperature=temperature)
+            self.assertEqual(generate([Generation(batched_folk_rnn, prime_tokens, seed, temperature)])[0], tune_tokens)
+    
+    def test_forced_prime_tokens_do_not_sample(self):
+        folk_rnn = model_cache.get(FOLKRNN_IN['rnn_model_name'])
+        prime_tokens = 'M:4/4 K:Cmaj a b * c'
+        generation = Generation(folk_rnn, prime_tokens, seed=42)
+        with patch.object(generation.rng, 'choice', wraps=generation.rng.choice) as choice:
+            tune_tokens = generate([generation])[0]
+        # The wildcard and every token after the prime are sampled, the end token included
+        self.assertEqual(tune_tokens[:6], ['M:4/4', 'K:Cmaj', 'a', 'b', tune_tokens[4], 'c'])
+        self.assertEqual(choice.call_count, 1 + len(tune_tokens) - 6 + 1)
+    
+    def test_generation_with_prime_cache_as_per_without(self):
+        job_spec = load_job_spec(FOLKRNN_IN['rnn_model_name'])
+        folk_rnn = BatchedFolkRNN.from_job_spec(job_spec)
+        folk_rnn_cached = BatchedFolkRNN.from_job_spec(job_spec, prime_cache_bytes=1024*1024)
+        parameters = [
+            ('M:4/4 K:Cmaj', 42, 1.0),
+            ('M:4/4 K:Cmaj', 123, 0.5),
+            ('M:4/4 K:Cmaj a b c', 42, 1.0), # extends cached header
+            ('M:4/4 K:Cmaj a b c * d', 7, 2.0),
+            ]
+        for x in parameters:
+            tokens = []
+            tune_tokens = generate([Generation(folk_rnn_cached, *x, on_token=tokens.append)])[0]
+            self.assertEqual(generate([Generation(folk_rnn, *x)])[0], tune_tokens)
+            self.assertEqual(tokens, tune_tokens)
+        self.assertIn((folk_rnn.start_idx, folk_rnn.token2idx['M:4/4'], folk_rnn.token2idx['K:Cmaj']), folk_rnn_cached.prime_cache.states)
+    
+    def test_ingested_prime_close_to_stepped(self):
+        job_spec = load_job_spec(FOLKRNN_IN['rnn_model_name'])
+        folk_rnn = BatchedFolkRNN.from_job_spec(job_spec)
+        folk_rnn_gemm = BatchedFolkRNN.from_job_spec(job_spec, gemm=True)
+        tokens = []
+        tune_tokens = generate([Generation(folk_rnn_gemm, 'M:4/4 K:Cmaj a b c * d', 7, 2.0, on_token=tokens.append)])[0]
+        self.assertEqual(tokens, tune_tokens)
+        self.assertEqual(tune_tokens[:5], 'M:4/4 K:Cmaj a b c'.split())
+        self.assertEqual(tune_tokens[6], 'd')
+        
+        # Where it diverges: the state after the prime, not bit for bit as stepped, as per gemm
+        token_idxs = [folk_rnn.start_idx] + [folk_rnn.token2idx[x] for x in 'M:4/4 K:Cmaj a b c d e f'.split()]
+        ingested = folk_rnn_gemm.ingest(np.array(token_idxs), folk_rnn.initial_state())
+        stepped = folk_rnn.initial_state()
+        for token_idx in token_idxs:
+            stepped = folk_rnn.step(np.array([token_idx]), stepped)
+        for (hid, cell), (stepped_hid, stepped_cell) in zip(ingested, stepped):
+            self.assertTrue(np.allclose(hid, stepped_hid, rtol=1e-4, atol=1e-5))
+            self.assertTrue(np.allclose(cell, stepped_cell, rtol=1e-4, atol=1e-5))
+    
+    def test_failed_generation_finishes_with_none(self):
+        folk_rnn = model_cache.get(FOLKRNN_IN['rnn_model_name'])
+        def on_token(token):
+            raise ValueError
+        finished = []
+        generations = [
+            Generation(folk_rnn, seed=FOLKRNN_IN['seed'], temperature=FOLKRNN_IN['temp'], on_token=on_token, on_finish=finished.append),
+            Generation(folk_rnn, seed=FOLKRNN_IN['seed'], temperature=FOLKRNN_IN['temp'], on_finish=finished.append),
+            ]
+        generate(generations)
+        self.assertEqual(finished[0], None)
+        self.assertEqual(' '.join(finished[1]), FOLKRNN_OUT_RAW)
+    
+    def test_truncate_to_bar(self):
+        self.assertEqual(truncate_to_bar(['M:4/4', 'K:Cmaj', 'a', 'b', '|', 'c', 'd', ':|', 'e']), ['M:4/4', 'K:Cmaj', 'a', 'b', '|', 'c', 'd', ':|'])
+        self.assertEqual(truncate_to_bar(['M:4/4', 'K:Cmaj', 'a', '|:', 'b']), ['M:4/4', 'K:Cmaj'])
+        self.assertEqual(truncate_to_bar(['M:4/4', 'K:Cmaj', 'a', 'b']), ['M:4/4', 'K:Cmaj'])
+    
+    def test_generation_budget(self):
+        budget = GenerationBudget(max_tokens=10, max_seconds=0.1)
+        self.assertFalse(budget.exceeded(9))
+        self.assertTrue(budget.exceeded(10))
+        sleep(0.2)
+        self.assertTrue(budget.exceeded(0))
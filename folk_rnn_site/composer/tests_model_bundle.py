@@ -0,0 +1,58 @@
+from django.test import TestCase
+from tempfile import TemporaryDirectory
+
+from folk_rnn_site.tests import FOLKRNN_IN, FOLKRNN_OUT_RAW
+from composer.rnn_models import load_job_spec
+from composer.generation import BatchedFolkRNN, Generation, generate
+from composer.model_bundle import bundle_paths, write_bundle, read_bundle, read_bundle_metadata, dequantized
+
+class ModelBundleTest(TestCase):
+    
+    def test_bundle_as_per_pickle(self):
+        job_spec = load_job_spec(FOLKRNN_IN['rnn_model_name'])
+        with TemporaryDirectory() as tmp:
+            paths = bundle_paths(tmp, FOLKRNN_IN['rnn_model_name'])
+            write_bundle(job_spec, *paths)
+            bundle_job_spec = read_bundle(*paths)
+            
+            self.assertEqual(bundle_job_spec['token2idx'], job_spec['token2idx'])
+            self.assertEqual(bundle_job_spec['num_layers'], job_spec['num_layers'])
+            for bundle_param, param in zip(bundle_job_spec['param_values'], job_spec['param_values']):
+                self.assertEqual(bundle_param.dtype, param.dtype)
+                self.assertTrue((bundle_param == param).all())
+            
+            folk_rnn = BatchedFolkRNN.from_job_spec(bundle_job_spec)
+            generation = Generation(folk_rnn, seed=FOLKRNN_IN['seed'], temperature=FOLKRNN_IN['temp'])
+            self.assertEqual(' '.join(generate([generation])[0]), FOLKRNN_OUT_RAW)
+    
+    def test_quantized_bundle(self):
+        job_spec = load_job_spec(FOLKRNN_IN['rnn_model_name'])
+        with TemporaryDirectory() as tmp:
+            paths = bundle_paths(tmp, FOLKRNN_IN['rnn_model_name'])
+            write_bundle(job_spec, *paths, quantization='int8')
+            self.assertEqual(read_bundle_metadata(paths[0])['quantization'], 'int8')
+            bundle_job_spec = read_bundle(*paths)
+            
+            for bundle_param, param in zip(dequantized(bundle_job_spec['param_values']), job_spec['param_values']):
+                self.assertEqual(bundle_param.dtype, param.dtype)
+                # Within half a step of the int8 scale
+                self.assertTrue((abs(bundle_param - param) <= abs(param).max() / 254 + 1e-6).all())
+            
+            folk_rnn = BatchedFolkRNN.from_job_spec(bundle_job_spec)
+            generation = Generation(folk_rnn, seed=FOLKRNN_IN['seed'], temperature=FOLKRNN_IN['temp'])
+            self.assertTrue(generate([generation])[0])
+    
+    def test_quantized_weights_held_quantized(self):
+        job_spec = load_job_spec(FOLKRNN_IN['rnn_model_name'])
+        with TemporaryDirectory() as tmp:
+            paths = bundle_paths(tmp, FOLKRNN_IN['rnn_model_name'])
+            write_bundle(job_spec, *paths, quantization='int8')
+            bundle_job_spec = read_bundle(*paths)
+            folk_rnn = BatchedFolkRNN.from_job_spec(bundle_job_spec)
+            dequantized_folk_rnn = BatchedFolkRNN.from_job_spec(dict(bundle_job_spec, param_values=dequantized(bundle_job_spec['param_values'])))
+            self.assertLess(folk_rnn.nbytes, dequantized_folk_rnn.nbytes / 3)
+            
+            # Dequantized per product as per dequantized as loaded
+            generation = Generation(folk_rnn, seed=FOLKRNN_IN['seed'], temperature=FOLKRNN_IN['temp'])
+            dequantized_generation = Generation(dequantized_folk_rnn, seed=FOLKRNN_IN['seed'], temperature=FOLKRNN_IN['temp'])
+            self.assertEqual(generate([generation]), generate([dequantized_generation]))
@@ -0,0 +1,60 @@
+from django.test import TestCase
+import os
+from threading import Event
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from folk_rnn_site.tests import FOLKRNN_IN, FOLKRNN_OUT_RAW
+from composer.process_pool import GenerationProcessPool
+
+def exit_in_process(*args):
+    # As per a pool process killed, e.g. out of memory
+    os._exit(1)
+
+class GenerationProcessPoolTest(TestCase):
+    
+    def test_process_pool_generation_as_per_folk_rnn(self):
+        pool = GenerationProcessPool(processes=2)
+        tune = SimpleNamespace(id=1, rnn_model_name=FOLKRNN_IN['rnn_model_name'], prime_tokens='', seed=FOLKRNN_IN['seed'], temp=FOLKRNN_IN['temp'])
+        tokens = []
+        result = {}
+        finished = Event()
+        def on_finish(tune_tokens):
+            result['tune_tokens'] = tune_tokens
+            finished.set()
+        pool.submit(tune, tokens.append, on_finish)
+        self.assertTrue(finished.wait(60))
+        self.assertEqual(' '.join(result['tune_tokens']), FOLKRNN_OUT_RAW)
+        self.assertEqual(tokens, result['tune_tokens'])
+    
+    def test_process_pool_lost_process_fails_tune_and_exits(self):
+        pool = GenerationProcessPool(processes=1)
+        tune = SimpleNamespace(id=1, rnn_model_name=FOLKRNN_IN['rnn_model_name'], prime_tokens='', seed=FOLKRNN_IN['seed'], temp=FOLKRNN_IN['temp'])
+        result = {}
+        exited = Event()
+        def on_finish(tune_tokens):
+            result['tune_tokens'] = tune_tokens
+        with patch('composer.process_pool.generate_in_process', exit_in_process), \
+                patch('composer.process_pool.exit_worker', side_effect=exited.set) as exit_worker:
+            pool.submit(tune, lambda token: None, on_finish)
+            self.assertTrue(exited.wait(60))
+        # Finished before exiting, and not re-forked
+        self.assertIsNone(result['tune_tokens'])
+        self.assertEqual(exit_worker.call_count, 1)
+        self.assertEqual(pool.callbacks, {})
+    
+    def test_process_pool_budget_checked_in_process(self):
+        pool = GenerationProcessPool(processes=1)
+        tune = SimpleNamespace(id=1, rnn_model_name=FOLKRNN_IN['rnn_model_name'], prime_tokens='', seed=FOLKRNN_IN['seed'], temp=FOLKRNN_IN['temp'])
+        tokens = []
+        result = {}
+        finished = Event()
+        def on_finish(tune_tokens, over_budget=False):
+            result['over_budget'] = over_budget
+            finished.set()
+        # The parent, not checking, would relay the whole tune
+        with patch('composer.process_pool.models', return_value={tune.rnn_model_name: {'max_tokens': 10, 'max_seconds': 20}}):
+            pool.submit(tune, tokens.append, on_finish)
+            self.assertTrue(finished.wait(60))
+        self.assertTrue(result['over_budget'])
+        self.assertEqual(tokens, FOLKRNN_OUT_RAW.split()[:10])
@@ -0,0 +1,23 @@
+from django.test import TestCase
+from tempfile import TemporaryDirectory
+
+from folk_rnn_site.tests import FOLKRNN_OUT_RAW, mint_abc
+from composer.tune_store import TuneStore
+
+class TuneStoreTest(TestCase):
+    
+    def test_put_get_across_segments(self):
+        with TemporaryDirectory() as tmp:
+            store = TuneStore(path=tmp, segment_bytes=100)
+            store.put(1, 'thesession_with_repeats', FOLKRNN_OUT_RAW, mint_abc())
+            store.put(2, 'thesession_with_repeats', 'M:4/4 K:Cmaj a b c', '')
+            self.assertEqual(store.segments(), [1, 2])
+            self.assertEqual(store.sealed_segments(), [1])
+            self.assertEqual(store.get(1), (FOLKRNN_OUT_RAW, mint_abc()))
+            self.assertIsNone(store.get(3))
+            
+            # As per another process, reading the index files
+            other_store = TuneStore(path=tmp, segment_bytes=100)
+            self.assertIn(2, other_store)
+            self.assertEqual(other_store.get(2), ('M:4/4 K:Cmaj a b c', ''))
+            self.assertEqual([x[0] for x in other_store.items()], [1, 2])
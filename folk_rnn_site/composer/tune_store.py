@@ -0,0 +1,151 @@
+'''
+The generated tune files, i.e. folk-rnn's raw output and the formatted ABC of each tune,
+packed into segments rather than two files per tune in TUNE_PATH.
+A segment is a pack file, appended with a record per tune, and an index file of
+(tune id, offset) pairs. The highest numbered segment is the active one, appended to
+until it reaches TUNE_STORE_SEGMENT_BYTES. The others are sealed, and never change.
+Appends from all processes are serialised by a lock file. Lookup by tune id is via an
+in-memory index, built from the index files and kept up to date by reading their tails.
+'''
+import os
+import re
+import struct
+import fcntl
+import threading
+from contextlib import contextmanager
+
+from composer import TUNE_PATH, TUNE_STORE_PATH, TUNE_STORE_SEGMENT_BYTES
+
+# pack record: tune id, then lengths of model name, raw, abc; then those as utf-8
+RECORD_HEADER = struct.Struct('<QHII')
+# index record: tune id, offset of its record in the pack
+INDEX_RECORD = struct.Struct('<QQ')
+
+segment_regex = re.compile(r'^segment_(\d{6})\.pack$')
+
+class TuneStore:
+
+    def __init__(self, path=TUNE_STORE_PATH, segment_bytes=TUNE_STORE_SEGMENT_BYTES):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.index = {} # tune id: (segment number, offset)
+        self.index_read = {} # segment number: bytes of its index read
+        self.lock = threading.Lock()
+
+    def segment_paths(self, number):
+        stem = os.path.join(self.path, f'segment_{number:06}')
+        return stem + '.pack', stem + '.index'
+
+    def segments(self):
+        '''
+        Return the segment numbers, ascending. The last is the active segment.
+        '''
+        return sorted(int(m.group(1)) for m in (segment_regex.match(x) for x in os.listdir(self.path)) if m)
+
+    def sealed_segments(self):
+        return self.segments()[:-1]
+
+    @contextmanager
+    def locked(self):
+        '''
+        Hold the lock file, i.e. no process appends meanwhile, e.g. as the active segment is read whole.
+        '''
+        with open(os.path.join(self.path, 'store.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def put(self, tune_id, model_name, raw, abc):
+        '''
+        Append the tune's files to the active segment, starting a new segment if it is full.
+        '''
+        payload = model_name.encode() + raw.encode() + abc.encode()
+        record = RECORD_HEADER.pack(tune_id, len(model_name.encode()), len(raw.encode()), len(abc.encode())) + payload
+        with self.locked():
+            segments = self.segments()
+            number = segments[-1] if segments else 1
+            pack_path, index_path = self.segment_paths(number)
+            if os.path.exists(pack_path) and os.path.getsize(pack_path) >= self.segment_bytes:
+                number += 1
+                pack_path, index_path = self.segment_paths(number)
+            with open(pack_path, 'ab') as f:
+                offset = f.tell()
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+            with open(index_path, 'ab') as f:
+                f.write(INDEX_RECORD.pack(tune_id, offset))
+        with self.lock:
+            self.index[tune_id] = (number, offset)
+
+    def refresh_index(self):
+        '''
+        Read any index records written since last read, e.g. by other processes.
+        '''
+        with self.lock:
+            for number in self.segments():
+                _, index_path = self.segment_paths(number)
+                read = self.index_read.get(number, 0)
+                try:
+                    with open(index_path, 'rb') as f:
+                        f.seek(read)
+                        data = f.read()
+                except OSError:
+                    continue
+                data = data[:len(data) - len(data) % INDEX_RECORD.size] # a record part written
+                for tune_id, offset in INDEX_RECORD.iter_unpack(data):
+                    self.index[tune_id] = (number, offset)
+                self.index_read[number] = read + len(data)
+
+    def read_record(self, number, offset):
+        '''
+        Return (tune id, model name, raw, abc) of the record.
+        '''
+        pack_path, _ = self.segment_paths(number)
+        with open(pack_path, 'rb') as f:
+            f.seek(offset)
+            tune_id, model_length, raw_length, abc_length = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+            payload = f.read(model_length + raw_length + abc_length)
+        return (
+            tune_id,
+            payload[:model_length].decode(),
+            payload[model_length:model_length + raw_length].decode(),
+            payload[model_length + raw_length:].decode(),
+            )
+
+    def get(self, tune_id, model_name=None):
+        '''
+        Return (raw, abc) of the tune, or None.
+        Given the model name, falls back to the tune's files in TUNE_PATH, i.e. not yet packed.
+        '''
+        location = self.index.get(tune_id)
+        if location is None:
+            self.refresh_index()
+            location = self.index.get(tune_id)
+        if location is not None:
+            _, _, raw, abc = self.read_record(*location)
+            return raw, abc
+        if model_name:
+            try:
+                with open(os.path.join(TUNE_PATH, f'{model_name}_{tune_id}_raw')) as f:
+                    raw = f.read()
+                with open(os.path.join(TUNE_PATH, f'{model_name}_{tune_id}')) as f:
+                    abc = f.read()
+                return raw, abc
+            except OSError:
+                pass
+        return None
+
+    def __contains__(self, tune_id):
+        if tune_id not in self.index:
+            self.refresh_index()
+        return tune_id in self.index
+
+    def items(self):
+        '''
+        Return a generator of (tune id, model name, raw, abc) of every tune in the store.
+        '''
+        self.refresh_index()
+        for tune_id, location in sorted(self.index.items()):
+            yield self.read_record(*location)
+
+tune_store = TuneStore()
@@ -22,5 +22,6 @@ urlpatterns = [
     url(r'^tune/(?P<tune_id>[0-9]+)$', views.tune_page, name='tune'),
     url(r'^tune/(?P<tune_id>[0-9]+)/archive$', views.archive_tune, name='archive_tune'),
     url(r'^dataset$', views.dataset_download),
+    url(r'^metrics$', views.metrics_page),
     url(r'^competition/$', views.competition_page, name='competition')
 ]
@@ -9,6 +9,7 @@ from django_hosts.resolvers import reverse
 from tempfile import TemporaryFile
 
 from folk_rnn_site.models import conform_abc
+from folk_rnn_site.metrics import merged_snapshots, prometheus_text
 from composer.models import RNNTune
 from composer.rnn_models import models
 from composer.forms import ComposeForm, ArchiveForm
@@ -70,4 +71,10 @@ def dataset_download(request):
         return response
 
 def competition_page(request):
-    return render(request, 'composer/competition.html', {})
\ No newline at end of file
+    return render(request, 'composer/competition.html', {})
+
+def metrics_page(request):
+    '''
+    Generation metrics in the Prometheus text format, see folk_rnn_site/metrics.py
+    '''
+    return HttpResponse(prometheus_text(merged_snapshots()), content_type='text/plain; version=0.0.4')
@@ -0,0 +1,52 @@
+'''
+Model-affinity routing of generations to the folk_rnn workers, as per FOLKRNN_WORKER_GROUPS.
+A model in a worker group has a channel of its own, e.g. folk_rnn.thesession_with_repeats,
+so only that group's workers load it. Other models share the folk_rnn channel.
+'''
+import re
+
+from composer import FOLKRNN_WORKER_GROUPS, FOLKRNN_PRELOAD_MODELS
+from composer.rnn_models import models
+
+SHARED_CHANNEL = 'folk_rnn'
+
+def model_channel(rnn_model_name):
+    '''
+    The channel the model's generations are sent to.
+    '''
+    if not any(rnn_model_name in x for x in FOLKRNN_WORKER_GROUPS.values()):
+        return SHARED_CHANNEL
+    # Channel names are limited to ASCII alphanumerics, hyphen, underscore and period
+    stem = re.sub(r'[^a-zA-Z\d\-_.]', '_', rnn_model_name.replace('.pickle', ''))
+    return f'{SHARED_CHANNEL}.{stem}'
+
+def assigned_channels():
+    '''
+    The channels of the models in worker groups, i.e. to route as well as the shared channel.
+    '''
+    return sorted({model_channel(x) for group in FOLKRNN_WORKER_GROUPS.values() for x in group})
+
+def group_models(group=None):
+    '''
+    The models a worker of the group generates. Not a group, the models not in any group.
+    '''
+    if group in FOLKRNN_WORKER_GROUPS:
+        return list(FOLKRNN_WORKER_GROUPS[group])
+    return [x for x in models() if model_channel(x) == SHARED_CHANNEL]
+
+def preload_models(group=None):
+    '''
+    The models a worker of the group loads at start, i.e. FOLKRNN_PRELOAD_MODELS of the group's models.
+    '''
+    rnn_model_names = group_models(group)
+    if FOLKRNN_PRELOAD_MODELS is None:
+        return rnn_model_names
+    return [x for x in FOLKRNN_PRELOAD_MODELS if x in rnn_model_names]
+
+def group_channels(group=None):
+    '''
+    The channels a worker of the group listens to.
+    '''
+    if group in FOLKRNN_WORKER_GROUPS:
+        return sorted({model_channel(x) for x in FOLKRNN_WORKER_GROUPS[group]})
+    return [SHARED_CHANNEL]
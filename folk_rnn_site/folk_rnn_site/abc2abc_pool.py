@@ -0,0 +1,190 @@
+'''
+Running the command-line tool `abc2abc` with many tunes per invocation.
+abc2abc reads its input to the end before formatting, so a process can't be kept
+running between tunes. Instead, a pool of threads each run one abc2abc invocation
+at a time, taking all the tunes queued with the same options as one multi-tune
+input, and splitting the output back per tune by X: reference number.
+'''
+import re
+import subprocess
+import threading
+import logging
+from collections import OrderedDict, deque
+from time import monotonic
+
+from composer import ABC2ABC_PATH, ABC2ABC_POOL_SIZE, ABC2ABC_BATCH_SIZE, ABC2ABC_TIMEOUT
+from folk_rnn_site.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+header_x_line_regex = re.compile(r'^X:.*$', re.MULTILINE)
+
+def abc2abc_command(respace=False, bars_per_line=None, check_errors=True):
+    command = [ABC2ABC_PATH, 'stdin'] # a special filename revealed by looking at the source code!
+    if not check_errors:
+        command += ['-e']
+    if respace:
+        command += ['-s']
+    if bars_per_line:
+        command += ['-n', str(bars_per_line)]
+    return command
+
+def run_abc2abc(command, abcs, timeout=ABC2ABC_TIMEOUT):
+    '''
+    Format the tunes with one abc2abc invocation. Returns the output per tune.
+    Each tune is renumbered so the output can be split back by X: line, then its X: line restored.
+    '''
+    if len(abcs) == 1:
+        result = subprocess.run(command, input=abcs[0].encode(), stdout=subprocess.PIPE, timeout=timeout)
+        return [result.stdout.decode()]
+    x_lines = []
+    tunes = []
+    for index, abc in enumerate(abcs):
+        match = header_x_line_regex.search(abc)
+        x_lines.append(match.group(0).rstrip() if match else None)
+        if match:
+            tunes.append(header_x_line_regex.sub(f'X:{index + 1}', abc, count=1).strip())
+        else:
+            tunes.append(f'X:{index + 1}\n{abc.strip()}')
+    result = subprocess.run(command, input='\n\n'.join(tunes).encode() + b'\n', stdout=subprocess.PIPE, timeout=timeout)
+    output = result.stdout.decode()
+    starts = [m.start() for m in re.finditer(r'^X:\d+\s*$', output, re.MULTILINE)]
+    if len(starts) != len(abcs):
+        raise ValueError(f'abc2abc output has {len(starts)} tunes, not {len(abcs)}')
+    starts[0] = 0 # anything before the first tune is the first tune's
+    outputs = []
+    for index, (start, end) in enumerate(zip(starts, starts[1:] + [len(output)])):
+        tune_output = output[start:end].rstrip('\n') + '\n'
+        if x_lines[index] is None:
+            tune_output = header_x_line_regex.sub('', tune_output, count=1).lstrip('\n')
+        else:
+            tune_output = header_x_line_regex.sub(x_lines[index], tune_output, count=1)
+        outputs.append(tune_output)
+    return outputs
+
+class ABC2ABCPool:
+    '''
+    Threads running abc2abc, each invocation formatting up to batch_size queued tunes.
+    Metrics as per metrics(), and recorded as per folk_rnn_site/metrics.py
+    '''
+    def __init__(self, size=ABC2ABC_POOL_SIZE, batch_size=ABC2ABC_BATCH_SIZE, timeout=ABC2ABC_TIMEOUT):
+        self.size = size
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.queues = OrderedDict() # command tuple: deque of requests
+        self.condition = threading.Condition()
+        self.threads = []
+        self.stats = {
+            'calls': 0,
+            'tunes': 0,
+            'invocations': 0,
+            'timeouts': 0,
+            'failures': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0,
+        }
+
+    def metrics(self):
+        '''
+        Return the pool size, counts and per-call latency (seconds) so far.
+        '''
+        with self.condition:
+            metrics = dict(self.stats)
+            metrics['pool_size'] = self.size
+            metrics['queued'] = sum(len(x) for x in self.queues.values())
+        metrics['latency_mean'] = metrics['latency_total'] / metrics['calls'] if metrics['calls'] else 0.0
+        return metrics
+
+    def format(self, abc, **options):
+        '''
+        Format a tune with abc2abc, options as per abc2abc_command.
+        Blocks until formatted. Raises on abc2abc failure or timeout.
+        '''
+        request = {'abc': abc, 'done': threading.Event(), 'result': None, 'error': None}
+        start = monotonic()
+        with self.condition:
+            self.queues.setdefault(tuple(abc2abc_command(**options)), deque()).append(request)
+            if len(self.threads) < self.size:
+                thread = threading.Thread(target=self.run, name='ABC2ABCPool', daemon=True)
+                self.threads.append(thread)
+                thread.start()
+            self.condition.notify()
+        request['done'].wait()
+        self.record_call(monotonic() - start, 1)
+        if request['error']:
+            raise request['error']
+        return request['result']
+
+    def format_many(self, abcs, **options):
+        '''
+        Format many tunes with abc2abc, in the calling thread, batch_size tunes per invocation.
+        For bulk callers, e.g. a pass over the archive.
+        '''
+        command = abc2abc_command(**options)
+        outputs = []
+        for index in range(0, len(abcs), self.batch_size):
+            start = monotonic()
+            batch = abcs[index:index + self.batch_size]
+            outputs += self.run_batch(command, batch)
+            self.record_call(monotonic() - start, len(batch))
+        return outputs
+
+    def record_call(self, latency, tunes):
+        with self.condition:
+            self.stats['calls'] += 1
+            self.stats['tunes'] += tunes
+            self.stats['latency_total'] += latency
+            self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+        metrics.observe('abc2abc_call_seconds', latency)
+
+    def run_batch(self, command, abcs):
+        '''
+        Returns the output per tune, falling back to an invocation per tune if the batch output can't be split.
+        '''
+        with self.condition:
+            self.stats['invocations'] += 1
+        metrics.inc('abc2abc_invocations_total')
+        try:
+            return run_abc2abc(command, abcs, self.timeout)
+        except subprocess.TimeoutExpired:
+            with self.condition:
+                self.stats['timeouts'] += 1
+            metrics.inc('abc2abc_failures_total')
+            if len(abcs) == 1:
+                raise
+        except ValueError as e:
+            with self.condition:
+                self.stats['failures'] += 1
+            metrics.inc('abc2abc_failures_total')
+            logger.warning(f'ABC2ABCPool: {e}, formatting tunes individually')
+        outputs = []
+        for abc in abcs:
+            with self.condition:
+                self.stats['invocations'] += 1
+            metrics.inc('abc2abc_invocations_total')
+            outputs += run_abc2abc(command, [abc], self.timeout)
+        return outputs
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queues:
+                    self.condition.wait()
+                command, requests = next(iter(self.queues.items()))
+                batch = [requests.popleft() for _ in range(min(self.batch_size, len(requests)))]
+                if requests:
+                    self.queues.move_to_end(command)
+                else:
+                    del self.queues[command]
+            try:
+                outputs = self.run_batch(list(command), [x['abc'] for x in batch])
+                for request, output in zip(batch, outputs):
+                    request['result'] = output
+            except Exception as e:
+                logger.warning(f'ABC2ABCPool: abc2abc failed for {len(batch)} tunes, {e!r}')
+                for request in batch:
+                    request['error'] = e
+            for request in batch:
+                request['done'].set()
+
+abc2abc_pool = ABC2ABCPool()
@@ -0,0 +1,341 @@
+'''
+In-process ABC formatting, as per the command-line tool `abc2abc`.
+Covers the single-tune ABC folk-rnn generates and users typically enter: the
+respacing of notes into beat groups (abc2abc -s), a newline every n bars (-n)
+and bar length errors (i.e. without -e). Anything else raises
+ABCFormatUnsupported, for the caller to fall back to abc2abc.
+'''
+import re
+import logging
+from fractions import Fraction
+
+from composer import ABC_FORMAT_IN_PROCESS
+from folk_rnn_site.abc2abc_pool import abc2abc_pool
+
+logger = logging.getLogger(__name__)
+
+field_regex = re.compile(r'^([A-Za-z]):\s*(.*?)\s*$')
+fraction_regex = re.compile(r'^(\d+)/(\d+)$')
+note_length_regex = re.compile(r"((?:\^\^|__|\^|_|=)?[A-Ga-gzx][,']*)(\d*(?:/+\d*)?)")
+chord_regex = re.compile(r"\[((?:(?:\^\^|__|\^|_|=)?[A-Ga-gzx][,']*\d*(?:/+\d*)?-?)+)\](\d*(?:/+\d*)?)")
+bar_regex = re.compile(r'\[\||:*\|\]|:*\|\|?:*|::+')
+ending_regex = re.compile(r'\[?\d+(?:[,-]\d+)*')
+inline_field_regex = re.compile(r'\[([A-Za-z]):([^\]]*)\]')
+tuplet_regex = re.compile(r'\((\d)(?::(\d)?)?(?::(\d)?)?')
+
+# Information fields that can appear in the body without changing how it is formatted, other than M: and L:
+BODY_FIELDS = 'MLKPNRQ'
+
+class ABCFormatUnsupported(Exception):
+    '''
+    The ABC has constructs the in-process formatter doesn't handle.
+    '''
+
+def parse_fraction(value, field):
+    match = fraction_regex.match(value)
+    if not match:
+        raise ABCFormatUnsupported(f'{field}:{value}')
+    return Fraction(int(match.group(1)), int(match.group(2)))
+
+def parse_meter(value):
+    '''
+    Return (bar length, beat group length) for an M: information field value.
+    Zero for M:none, i.e. no bar length checks or beaming.
+    The beat group is as per abc2abc: half a bar for even numerators, a third for 9, otherwise the bar.
+    '''
+    if value == 'none':
+        return Fraction(0), Fraction(0)
+    if value == 'C':
+        value = '4/4'
+    if value == 'C|':
+        value = '2/2'
+    barlen = parse_fraction(value, 'M')
+    n, m = (int(x) for x in value.split('/'))
+    if n == 9:
+        return barlen, Fraction(3, m)
+    if n % 2 == 0:
+        return barlen, Fraction(n // 2, m)
+    return barlen, barlen
+
+def parse_length(text):
+    '''
+    Return the multiplier of a note length, e.g. 2, 3/2, /, //
+    '''
+    if '/' not in text:
+        return Fraction(int(text)) if text else Fraction(1)
+    numerator, _, denominator = text.partition('/')
+    numerator = int(numerator) if numerator else 1
+    if not denominator or denominator.startswith('/'):
+        return Fraction(numerator, 2 ** text.count('/'))
+    return Fraction(numerator, int(denominator))
+
+def format_fraction(value):
+    return f'{value.numerator}/{value.denominator}'
+
+class TuneState:
+    '''
+    Position through the bars of a tune, as notes are parsed.
+    '''
+    def __init__(self, check_errors):
+        self.check_errors = check_errors
+        self.barlen = Fraction(0)
+        self.breakpoint = Fraction(0)
+        self.unitlen = None
+        self.count = Fraction(0)
+        self.barno = 0
+        self.last_length = Fraction(0)
+        self.broken_mult = Fraction(1)
+        self.tuplet_mult = Fraction(1)
+        self.tuplet_notes = 0
+        self.errors = []
+
+    def field(self, key, value):
+        if key == 'M':
+            self.barlen, self.breakpoint = parse_meter(value)
+        elif key == 'L':
+            self.unitlen = parse_fraction(value, 'L')
+
+    def at_beat(self):
+        '''
+        True if part way through a bar, at the end of a beat group.
+        '''
+        return bool(self.breakpoint and self.count and (self.count / self.breakpoint).denominator == 1)
+
+    def note(self, length):
+        if self.unitlen is None:
+            # As per ABC standard, default unit note length is 1/16 for meters less than 3/4
+            self.unitlen = Fraction(1, 16) if self.barlen and self.barlen < Fraction(3, 4) else Fraction(1, 8)
+        length *= self.unitlen * self.broken_mult
+        self.broken_mult = Fraction(1)
+        if self.tuplet_notes:
+            length *= self.tuplet_mult
+            self.tuplet_notes -= 1
+        self.count += length
+        self.last_length = length
+
+    def broken(self, symbol):
+        # a>b: a is dotted, b shortened to match. a<b the reverse. >> double dotted, etc.
+        shorten = Fraction(1, 2 ** len(symbol))
+        if symbol[0] == '>':
+            self.count += self.last_length * (1 - shorten)
+            self.broken_mult = shorten
+        else:
+            self.count -= self.last_length * (1 - shorten)
+            self.broken_mult = 2 - shorten
+
+    def tuplet(self, p, q, r):
+        if q is None:
+            compound = self.barlen.numerator % 3 == 0 and self.barlen.numerator > 3
+            q = {2: 3, 3: 2, 4: 3, 6: 2, 8: 3}.get(p, 3 if compound else 2)
+        self.tuplet_mult = Fraction(q, p)
+        self.tuplet_notes = r if r is not None else p
+
+    def bar(self):
+        # The first bar may be an anacrusis, so isn't checked
+        if self.check_errors and self.count and self.barno and self.barlen and self.count != self.barlen:
+            self.errors.append(f'Bar {self.barno} is {format_fraction(self.count)} not {format_fraction(self.barlen)}')
+        self.barno += 1
+        self.count = Fraction(0)
+
+def parse_body_line(line, state):
+    '''
+    Parse a line of the tune body into a list of (kind, text, at_beat), where kind is one of
+    'space', 'prefix' (guitar chord, decoration, grace notes, slur or tuplet start, ending),
+    'note' (including rests and chords), 'suffix' (tie, slur end, broken rhythm), 'bar', 'field'.
+    at_beat is whether the item starts at the end of a beat group.
+    '''
+    items = []
+    i = 0
+    while i < len(line):
+        c = line[i]
+        at_beat = state.at_beat()
+        if c in ' \t':
+            match = re.compile(r'[ \t]+').match(line, i)
+            items.append(('space', match.group(0), at_beat))
+            i = match.end()
+            continue
+        if c in '"!{':
+            j = line.find('"' if c == '"' else '!' if c == '!' else '}', i + 1)
+            if j == -1:
+                raise ABCFormatUnsupported(f'unterminated {c}')
+            items.append(('prefix', line[i:j+1], at_beat))
+            i = j + 1
+            continue
+        if c in '~.':
+            items.append(('prefix', c, at_beat))
+            i += 1
+            continue
+        if c == '(':
+            match = tuplet_regex.match(line, i)
+            if match:
+                state.tuplet(*(int(x) if x else None for x in match.groups()))
+                items.append(('prefix', match.group(0), at_beat))
+                i = match.end()
+            else:
+                items.append(('prefix', c, at_beat))
+                i += 1
+            continue
+        if c in ')-':
+            items.append(('suffix', c, at_beat))
+            i += 1
+            continue
+        if c in '<>':
+            match = re.compile(re.escape(c) + '+').match(line, i)
+            state.broken(match.group(0))
+            items.append(('suffix', match.group(0), at_beat))
+            i = match.end()
+            continue
+        match = inline_field_regex.match(line, i)
+        if match:
+            key, value = match.group(1), match.group(2).strip()
+            if key not in BODY_FIELDS:
+                raise ABCFormatUnsupported(f'[{key}:')
+            state.field(key, value)
+            items.append(('field', match.group(0), at_beat))
+            i = match.end()
+            continue
+        match = bar_regex.match(line, i)
+        if match:
+            j = match.end()
+            ending = ending_regex.match(line, j)
+            if ending and line[j] != '[':
+                j = ending.end()
+            state.bar()
+            items.append(('bar', line[i:j], at_beat))
+            i = j
+            continue
+        match = ending_regex.match(line, i)
+        if c == '[' and match and match.end() > i + 1:
+            items.append(('prefix', match.group(0), at_beat))
+            i = match.end()
+            continue
+        match = chord_regex.match(line, i)
+        if match:
+            first_length = note_length_regex.match(match.group(1)).group(2)
+            state.note(parse_length(first_length) * parse_length(match.group(2)))
+            items.append(('note', match.group(0), at_beat))
+            i = match.end()
+            continue
+        match = note_length_regex.match(line, i)
+        if match:
+            state.note(parse_length(match.group(2)))
+            items.append(('note', match.group(0), at_beat))
+            i = match.end()
+            continue
+        raise ABCFormatUnsupported(f'unrecognised character {c}')
+    return items
+
+def format_abc(abc, respace=False, bars_per_line=None, check_errors=True):
+    '''
+    Format a tune as per `abc2abc stdin`.
+    respace - as per abc2abc -s, notes beamed by beat group
+    bars_per_line - as per abc2abc -n, a newline every n bars
+    check_errors - bar length errors are reported on `%Error : ` lines preceding
+    the line with the bar, False as per abc2abc -e
+    Raises ABCFormatUnsupported for ABC not handled.
+    '''
+    lines = abc.replace('\r\n', '\n').replace('\r', '\n').rstrip().split('\n')
+    state = TuneState(check_errors)
+    output = []
+
+    def flush(out_line):
+        output.extend(f'%Error : {x}' for x in state.errors)
+        state.errors = []
+        if out_line:
+            output.append(out_line)
+
+    # Header, up to and including K:
+    for index, line in enumerate(lines):
+        match = field_regex.match(line)
+        if not match:
+            raise ABCFormatUnsupported('expected information field in header')
+        key, value = match.groups()
+        state.field(key, value)
+        output.append(line.rstrip())
+        if key == 'K':
+            break
+    else:
+        raise ABCFormatUnsupported('missing K information field')
+
+    # Body
+    out_line = ''
+    bar_count = 0
+    for line in lines[index + 1:]:
+        if not line.strip():
+            raise ABCFormatUnsupported('blank line in body, i.e. multiple tunes')
+        if line.rstrip().endswith('\\'):
+            raise ABCFormatUnsupported('line continuation')
+        match = field_regex.match(line)
+        if match:
+            key, value = match.groups()
+            if key not in BODY_FIELDS:
+                raise ABCFormatUnsupported(f'{key}: in body')
+            state.field(key, value)
+            if out_line:
+                flush(out_line)
+                out_line = ''
+            output.append(line.rstrip())
+            continue
+
+        items = parse_body_line(line, state)
+        if not respace:
+            flush(line.rstrip())
+            continue
+
+        # Drop spaces, instead spacing at the start of each beat group
+        unit_start = True
+        for kind, text, at_beat in items:
+            if kind == 'space':
+                continue
+            if kind in ['prefix', 'note'] and unit_start:
+                if at_beat:
+                    out_line += ' '
+                unit_start = False
+            out_line += text
+            if kind in ['note', 'bar', 'field']:
+                unit_start = True
+            if kind == 'bar' and bars_per_line:
+                bar_count += 1
+                if bar_count % bars_per_line == 0:
+                    flush(out_line)
+                    out_line = ''
+        # With bars per line, line breaks are only made as per that
+        if not bars_per_line:
+            flush(out_line)
+            out_line = ''
+    if out_line or state.errors:
+        flush(out_line)
+    return '\n'.join(output) + '\n'
+
+def abc2abc(abc, respace=False, bars_per_line=None, check_errors=True):
+    '''
+    Format a tune as per `abc2abc stdin`, in-process if handled, otherwise with abc2abc itself.
+    Options as per format_abc.
+    '''
+    options = {'respace': respace, 'bars_per_line': bars_per_line, 'check_errors': check_errors}
+    if ABC_FORMAT_IN_PROCESS:
+        try:
+            return format_abc(abc, **options)
+        except ABCFormatUnsupported as e:
+            logger.debug(f'abc2abc: in-process formatting unsupported, {e}')
+    return abc2abc_pool.format(abc, **options)
+
+def abc2abc_many(abcs, respace=False, bars_per_line=None, check_errors=True):
+    '''
+    Format many tunes as per abc2abc, those not handled in-process with abc2abc run over many tunes at a time.
+    Returns the formatted tunes, in order.
+    '''
+    options = {'respace': respace, 'bars_per_line': bars_per_line, 'check_errors': check_errors}
+    outputs = [None] * len(abcs)
+    unsupported = []
+    for index, abc in enumerate(abcs):
+        if ABC_FORMAT_IN_PROCESS:
+            try:
+                outputs[index] = format_abc(abc, **options)
+                continue
+            except ABCFormatUnsupported:
+                pass
+        unsupported.append(index)
+    for index, output in zip(unsupported, abc2abc_pool.format_many([abcs[x] for x in unsupported], **options)):
+        outputs[index] = output
+    return outputs
@@ -0,0 +1,210 @@
+'''
+Counters and latency histograms, across the server and worker processes.
+Each process records in memory, and writes a snapshot of its metrics to METRICS_PATH
+at most every METRICS_SNAPSHOT_INTERVAL seconds. Readers merge the snapshots,
+i.e. the /metrics endpoint in Prometheus text format, and the generation_metrics command.
+A forked process starts its metrics afresh, and the snapshots of processes gone are pruned.
+'''
+import os
+import json
+import threading
+import socket
+import logging
+from bisect import bisect_left
+from time import monotonic, time
+
+from composer import METRICS_PATH, METRICS_SNAPSHOT_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Snapshots not written for this many intervals are pruned, unless of a process still running, i.e. idle
+STALE_SNAPSHOT_INTERVALS = 6
+
+# Upper bounds of histogram buckets, the last being +Inf
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf'))
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float('inf'))
+
+# name: (type, help, buckets)
+METRICS = {
+    'folkrnn_queue_wait_seconds': ('histogram', 'Time from compose request to generation start', SECONDS_BUCKETS),
+    'folkrnn_first_token_seconds': ('histogram', 'Time from generation start to the first token', SECONDS_BUCKETS),
+    'folkrnn_tokens_per_second': ('histogram', 'Tokens generated per second, per tune', RATE_BUCKETS),
+    'folkrnn_format_seconds': ('histogram', 'Time formatting a generated tune\'s ABC', SECONDS_BUCKETS),
+    'folkrnn_publish_seconds': ('histogram', 'Time publishing ABC to the channel layer', SECONDS_BUCKETS),
+    'abc2abc_call_seconds': ('histogram', 'Time for an abc2abc pool call, queueing included', SECONDS_BUCKETS),
+    'folkrnn_tunes_total': ('counter', 'Tunes by outcome, i.e. finished, truncated, cancelled, failed, cached, pregenerated', None),
+    'folkrnn_tokens_total': ('counter', 'Tokens generated', None),
+    'abc2abc_invocations_total': ('counter', 'abc2abc processes run', None),
+    'abc2abc_failures_total': ('counter', 'abc2abc invocations failed or timed out', None),
+    'folkrnn_model_loads_total': ('counter', 'Models loaded, by worker process, i.e. cache misses', None),
+    'folkrnn_model_cache_total': ('counter', 'Model cache lookups and evictions, by outcome, i.e. hit, miss, eviction, invalidation', None),
+    'folkrnn_model_load_seconds': ('histogram', 'Time loading a model into the model cache', SECONDS_BUCKETS),
+}
+
+def process_label():
+    '''
+    This process, as a label value. Made afresh if forked.
+    '''
+    return f'{socket.gethostname()}_{os.getpid()}'
+
+def label_key(labels):
+    return ','.join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+
+class Metrics:
+    '''
+    This process's metrics.
+    Counters are {label key: value}, histograms {label key: [bucket counts..., sum, count]}
+    '''
+    def __init__(self, path=METRICS_PATH, interval=METRICS_SNAPSHOT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.after_fork()
+
+    def after_fork(self):
+        '''
+        Start afresh, as in a forked process the parent's values would be counted twice.
+        '''
+        self.pid = os.getpid()
+        self.values = {}
+        self.lock = threading.Lock()
+        self.snapshot_time = monotonic()
+
+    def check_fork(self):
+        # Where os.register_at_fork isn't, i.e. before Python 3.7
+        if os.getpid() != self.pid:
+            self.after_fork()
+
+    def inc(self, name, amount=1, **labels):
+        self.check_fork()
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            key = label_key(labels)
+            series[key] = series.get(key, 0) + amount
+        self.snapshot_if_due()
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        self.check_fork()
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            histogram = series.setdefault(label_key(labels), [0] * len(buckets) + [0.0, 0])
+            histogram[bisect_left(buckets, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+        self.snapshot_if_due()
+
+    def snapshot_if_due(self):
+        if monotonic() - self.snapshot_time >= self.interval:
+            self.snapshot()
+
+    def snapshot(self):
+        '''
+        Write this process's metrics to its snapshot file.
+        '''
+        with self.lock:
+            self.snapshot_time = monotonic()
+            # Named per process, and made afresh if forked
+            filename = f'{process_label()}.json'
+            data = json.dumps({'time': time(), 'values': self.values})
+        try:
+            with open(os.path.join(self.path, filename + '.tmp'), 'w') as f:
+                f.write(data)
+            os.replace(os.path.join(self.path, filename + '.tmp'), os.path.join(self.path, filename))
+        except OSError:
+            logger.warning(f'Could not write metrics snapshot to {self.path}')
+
+metrics = Metrics()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=metrics.after_fork)
+
+def is_running(label):
+    '''
+    False if the process, as per process_label, is of this host and not running.
+    '''
+    hostname, _, pid = label.rpartition('_')
+    if hostname != socket.gethostname():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (ValueError, PermissionError):
+        pass
+    return True
+
+def merged_snapshots(path=METRICS_PATH, interval=METRICS_SNAPSHOT_INTERVAL):
+    '''
+    Return the metrics of every process, summed.
+    Stale snapshots, i.e. of processes gone, are removed, see STALE_SNAPSHOT_INTERVALS.
+    '''
+    merged = {}
+    for filename in os.listdir(path):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(path, filename)) as f:
+                snapshot = json.load(f)
+            values = snapshot['values']
+            stale = time() - snapshot['time'] > STALE_SNAPSHOT_INTERVALS * interval
+        except (OSError, ValueError, KeyError):
+            continue
+        if stale and not is_running(filename[:-len('.json')]):
+            try:
+                os.remove(os.path.join(path, filename))
+            except OSError:
+                pass
+            continue
+        for name, series in values.items():
+            if name not in METRICS:
+                continue
+            merged_series = merged.setdefault(name, {})
+            for key, value in series.items():
+                if isinstance(value, list):
+                    merged_value = merged_series.setdefault(key, [0] * len(value))
+                    merged_series[key] = [a + b for a, b in zip(merged_value, value)]
+                else:
+                    merged_series[key] = merged_series.get(key, 0) + value
+    return merged
+
+def prometheus_text(merged):
+    '''
+    Return the metrics in the Prometheus text exposition format.
+    '''
+    lines = []
+    for name, (metric_type, help_text, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for key, value in sorted(merged.get(name, {}).items()):
+            if metric_type == 'counter':
+                lines.append(f'{name}{{{key}}} {value}' if key else f'{name} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, value):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                labels = f'{key},le="{le}"' if key else f'le="{le}"'
+                lines.append(f'{name}_bucket{{{labels}}} {cumulative}')
+            suffix = f'{{{key}}}' if key else ''
+            lines.append(f'{name}_sum{suffix} {value[-2]}')
+            lines.append(f'{name}_count{suffix} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+def percentile(buckets, histogram, q):
+    '''
+    Estimate the q (0-1) percentile of a histogram, interpolating within its bucket as Prometheus does.
+    '''
+    counts = histogram[:len(buckets)]
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    cumulative = 0
+    lower = 0
+    for bound, count in zip(buckets, counts):
+        if cumulative + count >= rank and count:
+            if bound == float('inf'):
+                return lower
+            return lower + (bound - lower) * (rank - cumulative) / count
+        cumulative += count
+        lower = bound
+    return lower
@@ -1,10 +1,9 @@
 from django.db import models
 from unidecode import unidecode
-import subprocess
 import re
 import collections
 
-from composer import ABC2ABC_PATH
+from folk_rnn_site.abc_format import abc2abc
 header_x_regex = re.compile(r'^X:\s*(\d+)\s*\n', re.MULTILINE)
 header_t_regex = re.compile(r'^T:\s*(.*?)\s*\n', re.MULTILINE)
 header_s_regex = re.compile(r'^S:\s*(.*?)\s*\n', re.MULTILINE)
@@ -20,7 +19,7 @@ def conform_abc(abc):
     '''
     Attempt to conform ABC as per standard.
     Raises exception on detecting invalid ABC.
-    Uses command-line tool `abc2abc`.
+    Formats as per command-line tool `abc2abc`, see abc_format.py
     '''
     # Add X if missing; needed for abc2abc
     if not header_x_regex.search(abc):
@@ -33,18 +32,17 @@ def conform_abc(abc):
     # Parse through abc2abc
     try:
         abc_safe = unidecode(abc) # convert smart quotes to ASCII straight quotes etc.
-        abc_bytes = abc_safe.encode()
-        result = subprocess.run([ABC2ABC_PATH, 'stdin'], input=abc_bytes, stdout=subprocess.PIPE)
+        result = abc2abc(abc_safe)
     except:
         raise AttributeError('Parsing ABC failed')
     errors = []
-    for prefix, pos in [(x, len(x)) for x in [b'%Warning : ', b'%Error : ']]:
-        for line in result.stdout.splitlines():
+    for prefix, pos in [(x, len(x)) for x in ['%Warning : ', '%Error : ']]:
+        for line in result.splitlines():
             if line[:pos] == prefix:
-                errors.append(line[pos:].decode())
+                errors.append(line[pos:])
     if errors:
         raise AttributeError('Invalid ABC: ' + ', '.join(errors))
-    return result.stdout.decode()
+    return result
 
 class ABCModel(models.Model):
     '''
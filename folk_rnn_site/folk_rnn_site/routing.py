@@ -1,11 +1,15 @@
 from channels.routing import ProtocolTypeRouter, ChannelNameRouter
 
 from composer import consumers
+from composer.worker_routing import assigned_channels
 
 application = ProtocolTypeRouter({
     # Empty for now (http->django views is added by default)
     'websocket': consumers.ComposerConsumer,
     'channel': ChannelNameRouter({
         'folk_rnn': consumers.FolkRNNConsumer,
+        'folk_rnn_queue': consumers.FolkRNNQueueConsumer,
+        # Models with workers of their own, see composer/worker_routing.py
+        **{x: consumers.FolkRNNConsumer for x in assigned_channels()},
         })
 })
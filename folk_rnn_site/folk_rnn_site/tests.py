@@ -1,8 +1,15 @@
+import os
+import json
+from socket import gethostname
+from unittest.mock import patch
 from django.test import TestCase
 from django.db import models
 from django.contrib.staticfiles import finders
+from tempfile import TemporaryDirectory
 
 from folk_rnn_site.models import ABCModel
+from folk_rnn_site.abc_format import format_abc, ABCFormatUnsupported
+from folk_rnn_site.metrics import Metrics, merged_snapshots, prometheus_text, percentile, SECONDS_BUCKETS
 
 # Input, output as per https://github.com/tobyspark/folk-rnn/commit/381184a2d6659a47520cedd6d4dfa7bb1c5189f7
 FOLKRNN_IN = {'rnn_model_name': 'thesession_with_repeats.pickle', 'seed': 42, 'temp': 1, 'meter': '', 'key': '', 'start_abc': ''}
@@ -189,6 +196,69 @@ K:Cmaj
             self.assertEqual(tune.header_k, example.get('k', None))
             self.assertEqual(tune.body, example['body'])
         
+class ABCFormatTest(TestCase):
+    
+    def test_format_as_folk_rnn_worker(self):
+        abc = 'X:1\nM:4/4\nK:Cdor\n' + ''.join(FOLKRNN_OUT_RAW.split()[2:])
+        formatted = format_abc(abc, respace=True, bars_per_line=4, check_errors=False)
+        self.assertEqual(formatted, FOLKRNN_OUT.replace('T:Folk RNN Tune №1\n', ''))
+    
+    def test_bar_length_errors(self):
+        self.assertNotIn('%Error', format_abc(mint_abc(body='G|ABcd efga|bagf edcB|')))
+        self.assertIn('%Error : Bar 2 is 7/8 not 1/1', format_abc(mint_abc(body='G|ABcd efga|bagf edc|')))
+    
+    def test_unsupported(self):
+        with self.assertRaises(ABCFormatUnsupported):
+            format_abc(mint_abc(body='ABcd|\nw: lyrics'))
+
+class MetricsTest(TestCase):
+    
+    def test_snapshots_merged(self):
+        with TemporaryDirectory() as path:
+            for process in ['a', 'b']:
+                metrics = Metrics(path=path)
+                metrics.inc('folkrnn_tunes_total', model='m', outcome='finished')
+                metrics.observe('folkrnn_format_seconds', 0.03)
+                metrics.snapshot()
+                # i.e. as if from another process
+                os.rename(os.path.join(path, f'{gethostname()}_{os.getpid()}.json'), os.path.join(path, f'{process}.json'))
+            merged = merged_snapshots(path)
+        self.assertEqual(merged['folkrnn_tunes_total'], {'model="m",outcome="finished"': 2})
+        text = prometheus_text(merged)
+        self.assertIn('folkrnn_tunes_total{model="m",outcome="finished"} 2', text)
+        self.assertIn('folkrnn_format_seconds_bucket{le="0.05"} 2', text)
+        self.assertIn('folkrnn_format_seconds_count 2', text)
+    
+    def test_stale_snapshots_pruned(self):
+        with TemporaryDirectory() as path:
+            metrics = Metrics(path=path, interval=1)
+            metrics.inc('folkrnn_tunes_total', model='m', outcome='finished')
+            metrics.snapshot()
+            running = f'{gethostname()}_{os.getpid()}.json'
+            with open(os.path.join(path, running)) as f:
+                snapshot = json.load(f)
+            snapshot['time'] -= 60
+            for filename in [running, 'gone_1.json']:
+                with open(os.path.join(path, filename), 'w') as f:
+                    json.dump(snapshot, f)
+            merged = merged_snapshots(path, interval=1)
+            # i.e. of this process, idle, only
+            self.assertEqual(merged['folkrnn_tunes_total'], {'model="m",outcome="finished"': 1})
+            self.assertEqual(os.listdir(path), [running])
+    
+    def test_forked_metrics_afresh(self):
+        metrics = Metrics()
+        metrics.inc('folkrnn_tunes_total', model='m', outcome='finished')
+        with patch('folk_rnn_site.metrics.os.getpid', return_value=metrics.pid + 1):
+            metrics.inc('folkrnn_tunes_total', model='m', outcome='finished')
+        self.assertEqual(metrics.values['folkrnn_tunes_total'], {'model="m",outcome="finished"': 1})
+    
+    def test_percentile(self):
+        histogram = [0] * len(SECONDS_BUCKETS) + [0.0, 0]
+        histogram[SECONDS_BUCKETS.index(1)] = 10 # i.e. 10 values in (0.5, 1]
+        self.assertAlmostEqual(percentile(SECONDS_BUCKETS, histogram, 0.5), 0.75)
+        self.assertIsNone(percentile(SECONDS_BUCKETS, [0] * (len(SECONDS_BUCKETS) + 2), 0.5))
+
 class ABCJSTest(TestCase):
 
     def test_abcjs_available(self):
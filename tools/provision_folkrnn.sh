@@ -31,6 +31,8 @@ if [ ! -d /var/opt/folk_rnn_task ]; then
     chown vagrant:vagrant /var/opt/folk_rnn_task
 fi
 su vagrant -c /folk_rnn_webapp/tools/create_model_from_config_meta.py
+su vagrant -c "python3.6 /folk_rnn_webapp/folk_rnn_site/manage.py bundle_models"
+su vagrant -c "python3.6 /folk_rnn_webapp/folk_rnn_site/manage.py build_models_js"
 
 # folk_rnn webapp log dir
 mkdir -p /var/log/folk_rnn_webapp
@@ -111,11 +113,13 @@ cat ./tools/systemd/daphne.service \
 > /etc/systemd/system/daphne.service
 
 cp ./tools/systemd/worker-folkrnn@.service /etc/systemd/system/worker-folkrnn@.service
+cp ./tools/systemd/worker-folkrnn-queue.service /etc/systemd/system/worker-folkrnn-queue.service
 cp ./tools/systemd/folkrnn-backup.service /etc/systemd/system/folkrnn-backup.service
 cp ./tools/systemd/folkrnn-backup.timer /etc/systemd/system/folkrnn-backup.timer
 
 systemctl enable nginx
 systemctl enable daphne
 systemctl enable redis-server
+systemctl enable worker-folkrnn-queue
 systemctl enable worker-folkrnn\@{1..1} # Worker numbers should scale with CPU cores.
 systemctl enable --now folkrnn-backup.timer # Now as `runserver` won't start it.
\ No newline at end of file